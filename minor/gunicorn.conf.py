@@ -0,0 +1,90 @@
+"""
+Gunicorn configuration for the minor project.
+
+With ML_PRELOAD_MODEL=1 (the default) the Django application, and with it
+the global MLModelService, is imported once in the gunicorn master before
+the workers are forked. The ResNet50 weights are memory-mapped read-only
+(see ML_MMAP_WEIGHTS), so every worker shares the same physical pages
+copy-on-write instead of each one holding its own copy of the state dict.
+
+Each worker is told its index and the worker count so the thread planner
+(myapp.thread_planner) can give it its own share of the CPUs, and then loads
+(unless preloaded) and warms up the model before it accepts requests. Warmup
+runs in the workers, never the master: torch's OpenMP thread pool does not
+survive fork.
+
+Each worker serves GUNICORN_THREADS requests at once (gthread workers), so
+requests can queue in the admission controller, get a 429 when it is full, and
+meet in the micro-batcher; the admission limits themselves are shared by all
+workers through ML_ADMISSION_LOCK_DIR.
+
+Every process writes its metrics to ML_METRICS_DIR so /metrics reports the
+sum over all workers rather than whichever one answers the scrape.
+"""
+
+import gc
+import itertools
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 4))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+preload_app = os.environ.get('ML_PRELOAD_MODEL', '1') == '1'
+
+os.environ.setdefault('ML_METRICS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'metrics'))
+
+
+def on_starting(server):
+    """Runs in the master before the app is loaded"""
+    # Counters left by a previous run's workers must not be added to this run's
+    metrics_dir = os.environ['ML_METRICS_DIR']
+    if metrics_dir and os.path.isdir(metrics_dir):
+        for name in os.listdir(metrics_dir):
+            if name.endswith('.json'):
+                os.remove(os.path.join(metrics_dir, name))
+
+
+def when_ready(server):
+    """Runs in the master once the app is loaded, before any worker is forked"""
+    if preload_app and not os.environ.get('ML_INFERENCE_SOCKET'):
+        from myapp.ml_service import ml_service
+
+        # Django imports the views (and would load the model) lazily, so load
+        # it explicitly here or every worker would read its own copy
+        if not ml_service.preload():
+            server.log.warning("Model could not be preloaded; workers will load it themselves")
+            return
+
+        # Move everything allocated so far into the permanent generation so
+        # the workers' garbage collector never writes to (and un-shares) the
+        # pages holding the preloaded model objects.
+        gc.freeze()
+        server.log.info("Model preloaded in master; workers will share it copy-on-write")
+
+
+def pre_fork(server, worker):
+    """Runs in the master before each worker is forked"""
+    # The lowest index no live worker holds, so a replacement for a dead
+    # worker takes over its CPU share instead of doubling up on another's
+    taken = {getattr(other, 'ml_index', None) for other in server.WORKERS.values()}
+    worker.ml_index = next(index for index in itertools.count() if index not in taken)
+
+
+def post_fork(server, worker):
+    """Runs in each worker right after it is forked"""
+    os.environ['ML_WORKER_INDEX'] = str(worker.ml_index)
+    os.environ['ML_WORKER_PROCESSES'] = str(server.cfg.workers)
+
+
+def post_worker_init(worker):
+    """Runs in each worker once the Django application is loaded"""
+    from django.conf import settings
+    from myapp.ml_service import ml_service
+
+    if ml_service.model is not None:
+        # Preloaded in the master, which leaves thread planning to the workers
+        ml_service.configure_threads()
+    if getattr(settings, 'ML_LOAD_ON_BOOT', True) and not getattr(settings, 'ML_INFERENCE_SOCKET', ''):
+        ready = ml_service.prepare()
+        worker.log.info("Worker %s model %s", worker.pid, "ready" if ready else "NOT ready")
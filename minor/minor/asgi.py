@@ -3,6 +3,11 @@ ASGI config for minor project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+The async prediction endpoint (/predict-api/async) needs an ASGI server, e.g.
+
+    uvicorn minor.asgi:application --workers 2
+    gunicorn minor.asgi:application -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -48,8 +49,8 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
-    'myapp.middleware.SessionTimeoutMiddleware',  # Custom session timeout middleware
     'django.contrib.messages.middleware.MessageMiddleware',
+    'myapp.middleware.SessionTimeoutMiddleware',  # Custom session timeout middleware (uses messages)
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
@@ -121,7 +122,234 @@ USE_TZ = True
 # Session Configuration
 SESSION_COOKIE_AGE = 1800  # 30 minutes in seconds
 SESSION_EXPIRE_AT_BROWSER_CLOSE = True
-SESSION_SAVE_EVERY_REQUEST = True
+# Sessions are only saved when modified. SessionTimeoutMiddleware refreshes
+# last_activity (and with it the cookie and stored expiry) at most once per
+# SESSION_ACTIVITY_UPDATE_INTERVAL seconds, so the 30-minute idle timeout
+# still slides without a session write on every request.
+SESSION_SAVE_EVERY_REQUEST = False
+SESSION_IDLE_TIMEOUT = SESSION_COOKIE_AGE
+SESSION_ACTIVITY_UPDATE_INTERVAL = int(os.environ.get('SESSION_ACTIVITY_UPDATE_INTERVAL', 60))
+# Session storage: 'db' (default), 'cached_db' (reads served from the cache,
+# writes still go to the database), 'cache' (set CACHES['default'] to a
+# shared cache such as Redis when running several workers) or
+# 'signed_cookies' (no server-side storage at all)
+SESSION_ENGINE = 'django.contrib.sessions.backends.' + os.environ.get('SESSION_BACKEND', 'db')
+
+# ML inference configuration
+# Memory-map the model weights read-only so preloaded gunicorn workers share them
+ML_MMAP_WEIGHTS = os.environ.get('ML_MMAP_WEIGHTS', '1') == '1'
+# Inference backend: 'eager' (fp32), 'torchscript' (traced + frozen), 'int8'
+# (statically quantized model written by `manage.py calibrate_model`) or
+# 'onnx' (ONNX Runtime over the model written by `manage.py export_onnx`).
+# The int8 model of best_model.pth is ML_QUANTIZED_MODEL_PATH; registry
+# versions keep theirs next to their weights, so a hot-swap never serves the
+# previous version's int8 model.
+ML_INFERENCE_BACKEND = os.environ.get('ML_INFERENCE_BACKEND', 'eager')
+ML_QUANTIZED_MODEL_PATH = os.environ.get(
+    'ML_QUANTIZED_MODEL_PATH', str(BASE_DIR.parent / 'best_model_int8.pt')
+)
+# Versioned weights managed with `manage.py model_registry`; when the registry
+# has an active version it takes precedence over best_model.pth. Workers check
+# the manifest every ML_MODEL_WATCH_INTERVAL seconds (0 = never) and hot-swap
+# to a newly activated version.
+ML_MODEL_REGISTRY_DIR = os.environ.get('ML_MODEL_REGISTRY_DIR', str(BASE_DIR.parent / 'models'))
+ML_MODEL_WATCH_INTERVAL = float(os.environ.get('ML_MODEL_WATCH_INTERVAL', 10))
+ML_ONNX_MODEL_PATH = os.environ.get('ML_ONNX_MODEL_PATH', str(BASE_DIR.parent / 'best_model.onnx'))
+ML_ONNX_THREADS = int(os.environ.get('ML_ONNX_THREADS', 0))  # 0 = let ONNX Runtime decide
+# Concurrent predictions are collected for up to ML_BATCH_MAX_WAIT_MS (or until
+# ML_BATCH_MAX_SIZE images are pending) and run as a single forward pass.
+ML_BATCHING_ENABLED = os.environ.get('ML_BATCHING_ENABLED', '1') == '1'
+ML_BATCH_MAX_SIZE = int(os.environ.get('ML_BATCH_MAX_SIZE', 8))
+ML_BATCH_MAX_WAIT_MS = float(os.environ.get('ML_BATCH_MAX_WAIT_MS', 5))
+# The model is loaded lazily (never by migrate/collectstatic/other commands).
+# Gunicorn workers load and warm it at boot when ML_LOAD_ON_BOOT is on; the
+# warmup runs ML_WARMUP_ITERATIONS dummy passes at each ML_WARMUP_BATCH_SIZES
+# before /ready reports the worker as ready.
+ML_LOAD_ON_BOOT = os.environ.get('ML_LOAD_ON_BOOT', '1') == '1'
+ML_WARMUP_ENABLED = os.environ.get('ML_WARMUP_ENABLED', '1') == '1'
+ML_WARMUP_BATCH_SIZES = [
+    int(size) for size in os.environ.get('ML_WARMUP_BATCH_SIZES', f'1,{ML_BATCH_MAX_SIZE}').split(',') if size
+]
+ML_WARMUP_ITERATIONS = int(os.environ.get('ML_WARMUP_ITERATIONS', 2))
+# Decode JPEGs at a reduced DCT scale (still >= 224px) instead of full resolution
+ML_JPEG_DRAFT_DECODE = os.environ.get('ML_JPEG_DRAFT_DECODE', '1') == '1'
+# Multi-image uploads to /predict-api/batch
+ML_BATCH_UPLOAD_MAX_FILES = int(os.environ.get('ML_BATCH_UPLOAD_MAX_FILES', 50))
+ML_DECODE_WORKERS = int(os.environ.get('ML_DECODE_WORKERS', 4))
+# Prediction cache keyed by a digest of the uploaded image bytes. Set
+# ML_PREDICTION_CACHE_ALIAS to a CACHES alias (e.g. 'predictions') to share
+# cached predictions between gunicorn workers.
+ML_PREDICTION_CACHE_SIZE = int(os.environ.get('ML_PREDICTION_CACHE_SIZE', 1024))
+ML_PREDICTION_CACHE_TTL = int(os.environ.get('ML_PREDICTION_CACHE_TTL', 3600))
+ML_PREDICTION_CACHE_ALIAS = os.environ.get('ML_PREDICTION_CACHE_ALIAS', '')
+# Out-of-process inference: when set, views send images to the
+# `manage.py run_inference_server` process listening on this Unix socket
+ML_INFERENCE_SOCKET = os.environ.get('ML_INFERENCE_SOCKET', '')
+ML_INFERENCE_TIMEOUT = float(os.environ.get('ML_INFERENCE_TIMEOUT', 60))
+# Async (ASGI) prediction endpoint: size of the thread pool that runs decode +
+# inference, independent of the intra-op threads used by each forward pass
+# (ML_TORCH_THREADS, 0 = torch default)
+ML_ASYNC_EXECUTOR_WORKERS = int(os.environ.get('ML_ASYNC_EXECUTOR_WORKERS', 4))
+ML_TORCH_THREADS = int(os.environ.get('ML_TORCH_THREADS', 0))
+
+# Thread planner: split the usable CPUs (affinity mask capped by the cgroup
+# quota) between the WEB_CONCURRENCY workers instead of every worker using
+# all cores. ML_TORCH_THREADS, when set, overrides the computed per-worker
+# count; ML_PIN_CPUS=1 also pins each worker to its own core set.
+ML_THREAD_PLANNER = os.environ.get('ML_THREAD_PLANNER', '1') == '1'
+ML_PIN_CPUS = os.environ.get('ML_PIN_CPUS', '0') == '1'
+ML_TORCH_INTEROP_THREADS = int(os.environ.get('ML_TORCH_INTEROP_THREADS', 1))
+
+# Admission control: at most ML_ADMISSION_MAX_IN_FLIGHT predictions run at
+# once and ML_ADMISSION_MAX_QUEUE more may wait up to ML_ADMISSION_QUEUE_TIMEOUT
+# seconds; the rest get 429 with Retry-After. The limits are shared by every
+# worker on the host through lock files in ML_ADMISSION_LOCK_DIR ('' = per
+# process). The default lets every worker fill a micro-batch (WEB_CONCURRENCY
+# x ML_BATCH_MAX_SIZE, or one per worker without batching); the batcher runs as
+# soon as every admitted prediction of its process is pending. Set
+# ML_ADMISSION_MAX_IN_FLIGHT=0 to disable.
+ML_ADMISSION_MAX_IN_FLIGHT = int(os.environ.get(
+    'ML_ADMISSION_MAX_IN_FLIGHT',
+    int(os.environ.get('WEB_CONCURRENCY', 4)) * (ML_BATCH_MAX_SIZE if ML_BATCHING_ENABLED else 1),
+))
+ML_ADMISSION_MAX_QUEUE = int(os.environ.get('ML_ADMISSION_MAX_QUEUE', 8))
+ML_ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ML_ADMISSION_QUEUE_TIMEOUT', 10))
+ML_ADMISSION_RETRY_AFTER = int(os.environ.get('ML_ADMISSION_RETRY_AFTER', 1))
+ML_ADMISSION_LOCK_DIR = os.environ.get('ML_ADMISSION_LOCK_DIR', str(BASE_DIR / 'cache' / 'admission'))
+
+# Asynchronous prediction jobs (/predict-api/jobs), used by the prediction
+# page. Jobs are queued in the database and run in batches by `manage.py
+# run_prediction_worker`, or by a background thread in each web process while
+# ML_JOB_INLINE_WORKER is on. ML_JOB_POLL_INTERVAL bounds how long a job queued by another process
+# waits; the submitting process's own worker is woken immediately.
+ML_JOB_INLINE_WORKER = os.environ.get('ML_JOB_INLINE_WORKER', '1') == '1'
+ML_JOB_RESULT_TTL = int(os.environ.get('ML_JOB_RESULT_TTL', 3600))  # seconds results are kept
+ML_JOB_POLL_INTERVAL = float(os.environ.get('ML_JOB_POLL_INTERVAL', 0.5))
+# Longest a status poll may wait server-side; under WSGI (gthread) each
+# waiting poll holds a worker thread, so keep this to a few hundred ms
+ML_JOB_LONG_POLL_MAX = float(os.environ.get('ML_JOB_LONG_POLL_MAX', 0.5))
+ML_JOB_STALE_SECONDS = int(os.environ.get('ML_JOB_STALE_SECONDS', 300))  # requeue after a worker dies
+ML_JOB_MAX_ATTEMPTS = int(os.environ.get('ML_JOB_MAX_ATTEMPTS', 3))
+
+# Two-tier cascade: a small first-stage classifier (see `manage.py
+# distill_first_stage`) answers first and only images it is less than
+# ML_CASCADE_THRESHOLD confident about are escalated to ResNet50.
+ML_CASCADE_ENABLED = os.environ.get('ML_CASCADE_ENABLED', '0') == '1'
+ML_CASCADE_ARCH = os.environ.get('ML_CASCADE_ARCH', 'mobilenet_v3_small')
+ML_CASCADE_MODEL_PATH = os.environ.get('ML_CASCADE_MODEL_PATH', str(BASE_DIR.parent / 'first_stage_model.pth'))
+ML_CASCADE_THRESHOLD = float(os.environ.get('ML_CASCADE_THRESHOLD', 0.9))
+
+# Test-time augmentation: images whose confidence is below ML_TTA_THRESHOLD
+# (the "Clinical verification recommended" cut-off) are re-scored as the mean
+# over flipped and cropped views, all run in one extra batched forward pass.
+ML_TTA_ENABLED = os.environ.get('ML_TTA_ENABLED', '0') == '1'
+ML_TTA_THRESHOLD = float(os.environ.get('ML_TTA_THRESHOLD', 0.70))
+
+# Prediction history: served predictions are queued in memory and written to
+# the Prediction table by a background thread in bulk batches, so requests
+# never wait on the database. Rows are dropped (and counted) when the queue
+# is full.
+ML_PREDICTION_LOG_ENABLED = os.environ.get('ML_PREDICTION_LOG_ENABLED', '1') == '1'
+ML_PREDICTION_LOG_BATCH_SIZE = int(os.environ.get('ML_PREDICTION_LOG_BATCH_SIZE', 100))
+ML_PREDICTION_LOG_FLUSH_INTERVAL = float(os.environ.get('ML_PREDICTION_LOG_FLUSH_INTERVAL', 1.0))  # seconds
+ML_PREDICTION_LOG_QUEUE_SIZE = int(os.environ.get('ML_PREDICTION_LOG_QUEUE_SIZE', 10000))
+# The result_id returned with each prediction resolves through this shared
+# cache (written by the log's background thread, never the request) until,
+# and for ML_RESULT_CACHE_TTL seconds even if never, its row is written. A
+# process-local cache such as LocMem cannot be shared by the workers, so no
+# result ids are returned with one.
+ML_RESULT_CACHE_ALIAS = os.environ.get('ML_RESULT_CACHE_ALIAS', 'results')
+ML_RESULT_CACHE_TTL = int(os.environ.get('ML_RESULT_CACHE_TTL', 86400))
+# History and analytics API responses are cached in this CACHES alias until
+# new predictions are written (or ML_ANALYTICS_CACHE_TTL seconds pass). The
+# alias must be shared by every worker to see the invalidation; with a
+# process-local one (LocMem) nothing is cached.
+ML_ANALYTICS_CACHE_ALIAS = os.environ.get('ML_ANALYTICS_CACHE_ALIAS', 'analytics')
+ML_ANALYTICS_CACHE_TTL = int(os.environ.get('ML_ANALYTICS_CACHE_TTL', 300))
+ML_HISTORY_PAGE_SIZE = int(os.environ.get('ML_HISTORY_PAGE_SIZE', 20))
+ML_HISTORY_MAX_PAGE_SIZE = int(os.environ.get('ML_HISTORY_MAX_PAGE_SIZE', 100))
+
+# Uploads are stored once, named by content digest, under ML_UPLOAD_DIR and
+# served from /uploads/ with long-lived cache headers; WebP thumbnails at
+# ML_THUMBNAIL_SIZES pixels are rendered in the background.
+ML_UPLOAD_STORAGE_ENABLED = os.environ.get('ML_UPLOAD_STORAGE_ENABLED', '1') == '1'
+ML_UPLOAD_DIR = os.environ.get('ML_UPLOAD_DIR', str(BASE_DIR / 'media' / 'uploads'))
+ML_THUMBNAIL_SIZES = [
+    int(size) for size in os.environ.get('ML_THUMBNAIL_SIZES', '256,768').split(',') if size
+]
+ML_UPLOAD_CACHE_MAX_AGE = int(os.environ.get('ML_UPLOAD_CACHE_MAX_AGE', 31536000))  # seconds
+
+# Image quality gate: uploads that are too small, blurred (Laplacian variance
+# of a 256px grayscale copy below ML_QUALITY_MIN_SHARPNESS) or badly exposed
+# get a 422 "retake" response instead of a prediction.
+ML_QUALITY_GATE_ENABLED = os.environ.get('ML_QUALITY_GATE_ENABLED', '1') == '1'
+ML_QUALITY_MIN_SIDE = int(os.environ.get('ML_QUALITY_MIN_SIDE', 224))  # pixels, shorter side
+ML_QUALITY_MIN_SHARPNESS = float(os.environ.get('ML_QUALITY_MIN_SHARPNESS', 20))
+ML_QUALITY_MIN_BRIGHTNESS = float(os.environ.get('ML_QUALITY_MIN_BRIGHTNESS', 40))  # mean, 0-255
+ML_QUALITY_MAX_BRIGHTNESS = float(os.environ.get('ML_QUALITY_MAX_BRIGHTNESS', 225))
+ML_QUALITY_MAX_CLIPPED = float(os.environ.get('ML_QUALITY_MAX_CLIPPED', 0.5))  # share of black/white pixels
+
+# Bearer token for scraping /metrics; without it (or when unset) only staff
+# users can read the metrics
+ML_METRICS_TOKEN = os.environ.get('ML_METRICS_TOKEN', '')
+# Directory where each process writes its metrics every ML_METRICS_FLUSH_INTERVAL
+# seconds so /metrics can add up all workers ('' = this process only).
+# gunicorn.conf.py sets it for the web workers; leave it unset for the
+# inference server, whose metrics /metrics fetches over its socket.
+ML_METRICS_DIR = os.environ.get('ML_METRICS_DIR', '')
+ML_METRICS_FLUSH_INTERVAL = float(os.environ.get('ML_METRICS_FLUSH_INTERVAL', 5))
+
+# Logging: per-request prediction details are logged at DEBUG
+# (set ML_LOG_LEVEL=DEBUG to see them)
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'myapp': {
+            'handlers': ['console'],
+            'level': os.environ.get('ML_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'predictions': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache' / 'predictions',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+    # Separate aliases so culling one kind of entry never evicts another
+    'results': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache' / 'results',
+        'OPTIONS': {'MAX_ENTRIES': 50000},
+    },
+    'analytics': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache' / 'analytics',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+
+if os.environ.get('REDIS_URL'):
+    for alias in ('predictions', 'results', 'analytics'):
+        CACHES[alias] = {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+            'KEY_PREFIX': alias,
+        }
 
 
 # Static files (CSS, JavaScript, Images)
@@ -112,4 +112,11 @@ LOGGING = {
         'handlers': ['console'],
         'level': 'INFO',
     },
+    'loggers': {
+        'myapp': {
+            'handlers': ['console'],
+            'level': os.environ.get('ML_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
 }
@@ -43,8 +43,19 @@ urlpatterns = [
     path('predict', views.predict, name='predict'),
     path('camera-capture', views.camera_capture, name='camera_capture'),
     path('predict-api', views.predict_api, name='predict_api'),
+    path('predict-api/batch', views.predict_batch_api, name='predict_batch_api'),
+    path('predict-api/async', views.predict_api_async, name='predict_api_async'),
+    path('predict-api/jobs', views.prediction_job_submit, name='prediction_job_submit'),
+    path('predict-api/jobs/<uuid:job_id>', views.prediction_job_status, name='prediction_job_status'),
+    path('predict-api/cache-stats', views.prediction_cache_stats, name='prediction_cache_stats'),
+    path('predict-api/history', views.prediction_history, name='prediction_history'),
+    path('predict-api/analytics', views.prediction_analytics, name='prediction_analytics'),
+    path('predict-api/results/<str:result_id>', views.prediction_result, name='prediction_result'),
+    path('uploads/<str:name>', views.serve_upload, name='serve_upload'),
     path('result', views.result, name='result'),
     path('check-auth', views.check_auth_status, name='check_auth'),
+    path('ready', views.ready, name='ready'),
+    path('metrics', views.metrics, name='metrics'),
     path('admin/', admin.site.urls),
     # Handle Chrome DevTools requests silently
     re_path(r'^\.well-known/.*', chrome_devtools_handler),
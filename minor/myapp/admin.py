@@ -1,3 +1,19 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import Prediction, PredictionJob
+
+
+@admin.register(PredictionJob)
+class PredictionJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'status', 'filename', 'attempts', 'created_at', 'finished_at')
+    list_filter = ('status',)
+    exclude = ('image',)
+    readonly_fields = ('result', 'error', 'created_at', 'started_at', 'finished_at', 'expires_at')
+
+
+@admin.register(Prediction)
+class PredictionAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'user', 'predicted_class', 'confidence', 'model_version', 'model_tier', 'source')
+    list_filter = ('predicted_class', 'model_version', 'source')
+    date_hierarchy = 'created_at'
+    raw_id_fields = ('user',)
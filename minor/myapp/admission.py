@@ -0,0 +1,286 @@
+# myapp/admission.py
+"""
+Concurrency governor for the prediction endpoints.
+
+At most ``max_in_flight`` predictions run at once; up to ``max_queue`` more
+wait for a slot (for at most ``queue_timeout`` seconds). Anything beyond that
+is rejected immediately with ``Overloaded`` so views can answer 429 instead of
+letting every request's latency grow without bound.
+
+The limits are host-wide when ``ML_ADMISSION_LOCK_DIR`` is set: every gunicorn
+worker takes its queue places and running slots from the same set of
+``flock``-ed files in that directory, and the kernel frees a slot as soon as
+the process holding it closes the file or dies. Without a lock directory (or
+on platforms without ``fcntl``) the limits apply to each process separately.
+"""
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from .metrics import ADMISSION_IN_FLIGHT, ADMISSION_QUEUE_DEPTH, ADMISSION_REJECTED, ADMISSION_WAIT_SECONDS
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """Raised when a prediction cannot be admitted; ``retry_after`` is in seconds"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Server busy ({reason}), retry after {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class LocalSlots:
+    """``size`` slots shared by the threads of this process"""
+
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def try_acquire(self):
+        with self._cond:
+            if self.used >= self.size:
+                return None
+            self.used += 1
+            return True
+
+    def acquire(self, deadline):
+        """Wait until ``deadline`` (``time.monotonic()``) for a slot; returns a token or None"""
+        with self._cond:
+            while self.used >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            self.used += 1
+            return True
+
+    def release(self, token):
+        with self._cond:
+            self.used -= 1
+            self._cond.notify()
+
+
+class FileSlots:
+    """``size`` slots shared by every process on the host, one ``flock``-ed file each"""
+
+    poll_interval = 0.05
+
+    def __init__(self, directory, name, size):
+        os.makedirs(directory, exist_ok=True)
+        self.size = size
+        self.paths = [os.path.join(directory, f"{name}-{index}.lock") for index in range(size)]
+
+    def try_acquire(self):
+        # Start at a random slot so processes do not all contend for slot 0
+        start = random.randrange(self.size)
+        for path in self.paths[start:] + self.paths[:start]:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, "O_CLOEXEC", 0), 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                continue
+            return fd
+        return None
+
+    def acquire(self, deadline):
+        """Poll until ``deadline`` (``time.monotonic()``) for a slot; returns a token or None"""
+        delay = 0.002
+        while True:
+            fd = self.try_acquire()
+            if fd is not None:
+                return fd
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, self.poll_interval)
+
+    def release(self, token):
+        # Closing the descriptor drops the lock
+        os.close(token)
+
+
+class _Ticket:
+    """A reserved place in the queue, turned into a running slot by ``wait()``"""
+
+    def __init__(self, controller, place=None):
+        self.controller = controller
+        self.place = place
+        self.slot = None
+        self.state = "queued"
+        self.yielded = False
+
+    def wait(self):
+        self.controller._wait(self)
+
+    def release(self):
+        self.controller._release(self)
+
+    @contextmanager
+    def running(self):
+        """Hold a running slot for one ``with`` block, then go back to waiting in the queue.
+
+        Requests that run several forward passes (batch uploads) take a slot
+        per pass, so they are charged like that many requests and others get
+        a turn in between.
+        """
+        self.wait()
+        try:
+            yield
+        finally:
+            self.controller._requeue(self)
+
+
+class AdmissionController:
+    """Bounded in-flight count plus a bounded, time-limited wait queue.
+
+    ``max_in_flight=0`` disables the governor. ``reserve()`` never blocks, so
+    async views can call it on the event loop and ``wait()`` later on the
+    inference pool. With ``lock_dir`` the limits are shared by every process
+    using the same directory; ``in_flight`` and ``queued`` (and the metrics)
+    count this process's share.
+    """
+
+    def __init__(self, max_in_flight, max_queue=0, queue_timeout=10.0, retry_after=1, lock_dir=""):
+        self.max_in_flight = max(0, int(max_in_flight))
+        self.max_queue = max(0, int(max_queue))
+        self.queue_timeout = float(queue_timeout)
+        self.retry_after = max(1, int(retry_after))
+        self.in_flight = 0
+        self.queued = 0
+        self._lock = threading.Lock()
+        self.shared = bool(lock_dir) and fcntl is not None
+        if lock_dir and fcntl is None:
+            logger.warning("No fcntl on this platform; admission limits apply per process")
+        if not self.enabled:
+            self.places = self.slots = None
+        elif self.shared:
+            self.places = FileSlots(lock_dir, "place", self.max_in_flight + self.max_queue)
+            self.slots = FileSlots(lock_dir, "slot", self.max_in_flight)
+        else:
+            self.places = LocalSlots(self.max_in_flight + self.max_queue)
+            self.slots = LocalSlots(self.max_in_flight)
+
+    @property
+    def enabled(self):
+        return self.max_in_flight > 0
+
+    def _count(self, in_flight=0, queued=0):
+        with self._lock:
+            self.in_flight += in_flight
+            self.queued += queued
+            ADMISSION_IN_FLIGHT.set(self.in_flight)
+            ADMISSION_QUEUE_DEPTH.set(self.queued)
+
+    def reserve(self):
+        """Take a place in the queue or raise ``Overloaded`` if it is full"""
+        if not self.enabled:
+            ticket = _Ticket(self)
+            ticket.state = "running"
+            return ticket
+        place = self.places.try_acquire()
+        if place is None:
+            ADMISSION_REJECTED.inc(reason="queue_full")
+            raise Overloaded("queue full", self.retry_after)
+        self._count(queued=1)
+        return _Ticket(self, place)
+
+    def _wait(self, ticket):
+        if ticket.state != "queued":
+            return
+        if ticket.yielded and self.shared:
+            # Give processes polling for a slot a chance to take the one this
+            # ticket just returned before it asks again
+            time.sleep(FileSlots.poll_interval)
+        started = time.monotonic()
+        slot = self.slots.acquire(started + self.queue_timeout)
+        ADMISSION_WAIT_SECONDS.observe(time.monotonic() - started)
+        if slot is None:
+            ADMISSION_REJECTED.inc(reason="timeout")
+            raise Overloaded("queue timeout", self.retry_after)
+        ticket.slot = slot
+        ticket.state = "running"
+        self._count(in_flight=1, queued=-1)
+
+    def _requeue(self, ticket):
+        if ticket.state != "running" or not self.enabled:
+            return
+        self.slots.release(ticket.slot)
+        ticket.slot = None
+        ticket.state = "queued"
+        ticket.yielded = True
+        self._count(in_flight=-1, queued=1)
+
+    def _release(self, ticket):
+        if not self.enabled or ticket.state == "released":
+            ticket.state = "released"
+            return
+        if ticket.state == "running":
+            self.slots.release(ticket.slot)
+            self._count(in_flight=-1)
+        else:
+            # Reserved but never started (e.g. the request failed before inference)
+            self._count(queued=-1)
+        self.places.release(ticket.place)
+        ticket.state = "released"
+
+    def call(self, ticket, fn, *args, **kwargs):
+        """Wait for ``ticket``'s slot, run ``fn`` and release the slot"""
+        try:
+            ticket.wait()
+            return fn(*args, **kwargs)
+        finally:
+            ticket.release()
+
+    @contextmanager
+    def admit(self):
+        """Hold a running slot for the duration of a ``with`` block"""
+        ticket = self.reserve()
+        try:
+            ticket.wait()
+            yield
+        finally:
+            ticket.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": self.in_flight,
+                "queued": self.queued,
+                "max_in_flight": self.max_in_flight,
+                "max_queue": self.max_queue,
+                "shared": self.shared,
+            }
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_admission_controller():
+    """This process's controller, configured from the ``ML_ADMISSION_*`` settings"""
+    global _controller
+    with _controller_lock:
+        if _controller is None:
+            _controller = AdmissionController(
+                max_in_flight=getattr(settings, "ML_ADMISSION_MAX_IN_FLIGHT", 0),
+                max_queue=getattr(settings, "ML_ADMISSION_MAX_QUEUE", 0),
+                queue_timeout=getattr(settings, "ML_ADMISSION_QUEUE_TIMEOUT", 10),
+                retry_after=getattr(settings, "ML_ADMISSION_RETRY_AFTER", 1),
+                lock_dir=getattr(settings, "ML_ADMISSION_LOCK_DIR", ""),
+            )
+        return _controller
@@ -0,0 +1,207 @@
+# myapp/analytics.py
+"""
+Prediction history and dashboard analytics over the ``Prediction`` table.
+
+* History pages use keyset pagination on ``(created_at, id)`` through the
+  ``(user, -created_at)`` index, so page N costs the same as page 1. The
+  cursor is an opaque string handed back as ``next_cursor``.
+* Dashboard counts come from ``DailyPredictionRollup`` rows, which
+  ``update_rollups`` increments each time the write-behind logger inserts a
+  batch, instead of ``COUNT``/``GROUP BY`` over every prediction.
+* Both responses are cached under a version number that is bumped whenever
+  new predictions are written (per user for history, globally for the
+  rollups), so stale entries are never read and nothing has to be deleted.
+  A process-local ``ML_ANALYTICS_CACHE_ALIAS`` would only see its own
+  worker's bumps, so nothing is cached unless the alias is shared.
+"""
+import base64
+import binascii
+import hashlib
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q, Sum
+from django.utils import timezone
+
+from .models import DailyPredictionRollup, Prediction
+from .prediction_cache import shared_cache
+from .uploads import upload_urls
+
+HISTORY_FIELDS = (
+    "id", "created_at", "predicted_class", "confidence", "stage_info", "symptom_start_date",
+    "model_version", "model_tier", "image_digest", "source", "result_id", "image_name",
+)
+
+
+def _cache():
+    """The analytics cache, or None when the configured alias is not shared by the workers"""
+    return shared_cache(getattr(settings, "ML_ANALYTICS_CACHE_ALIAS", "analytics"))
+
+
+def _timeout():
+    return getattr(settings, "ML_ANALYTICS_CACHE_TTL", 300)
+
+
+def cache_version(cache, scope):
+    """Current version number of a cached scope ("rollups" or "history:<user id>")"""
+    return cache.get_or_set(f"prediction-analytics-version:{scope}", 1, None)
+
+
+def bump_version(scope):
+    cache = _cache()
+    if cache is None:
+        return
+    key = f"prediction-analytics-version:{scope}"
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 2, None)
+
+
+def severity_of(stage_info):
+    return ((stage_info or {}).get("severity") or "")[:50]
+
+
+def update_rollups(rows):
+    """Add a freshly inserted batch of ``Prediction`` rows to the daily rollups"""
+    totals = defaultdict(lambda: [0, 0.0])
+    for row in rows:
+        key = (timezone.localdate(row.created_at), row.predicted_class, severity_of(row.stage_info))
+        totals[key][0] += 1
+        totals[key][1] += row.confidence
+
+    for (day, predicted_class, severity), (count, confidence_sum) in totals.items():
+        match = DailyPredictionRollup.objects.filter(date=day, predicted_class=predicted_class, severity=severity)
+        if match.update(count=F("count") + count, confidence_sum=F("confidence_sum") + confidence_sum):
+            continue
+        try:
+            with transaction.atomic():
+                DailyPredictionRollup.objects.create(date=day, predicted_class=predicted_class, severity=severity,
+                                                     count=count, confidence_sum=confidence_sum)
+        except IntegrityError:
+            # Another process created the row first
+            match.update(count=F("count") + count, confidence_sum=F("confidence_sum") + confidence_sum)
+
+
+def invalidate_caches(rows):
+    """Retire cached analytics and the history of every user in ``rows`` (call after commit)"""
+    bump_version("rollups")
+    for user_id in {row.user_id for row in rows if row.user_id is not None}:
+        bump_version(f"history:{user_id}")
+
+
+def rebuild_rollups():
+    """Recompute every rollup row from the ``Prediction`` table (one full scan, for backfills)"""
+    totals = defaultdict(lambda: [0, 0.0])
+    for created_at, predicted_class, confidence, stage_info in Prediction.objects.values_list(
+        "created_at", "predicted_class", "confidence", "stage_info",
+    ).iterator(chunk_size=5000):
+        key = (timezone.localdate(created_at), predicted_class, severity_of(stage_info))
+        totals[key][0] += 1
+        totals[key][1] += confidence
+
+    with transaction.atomic():
+        DailyPredictionRollup.objects.all().delete()
+        DailyPredictionRollup.objects.bulk_create([
+            DailyPredictionRollup(date=day, predicted_class=predicted_class, severity=severity,
+                                  count=count, confidence_sum=confidence_sum)
+            for (day, predicted_class, severity), (count, confidence_sum) in totals.items()
+        ], batch_size=1000)
+    bump_version("rollups")
+    return len(totals)
+
+
+def encode_cursor(prediction):
+    raw = f"{prediction['created_at'].isoformat()}|{prediction['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """``(created_at, id)`` from a cursor; raises ValueError if it is malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, pk = raw.split("|")
+        return datetime.fromisoformat(created_at), int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError("Invalid cursor")
+
+
+def history_page(user_id, cursor=None, limit=20, predicted_class=None):
+    """One page of a user's predictions, newest first, plus the cursor of the next page"""
+    # Class names contain spaces, which memcached keys cannot
+    params = hashlib.blake2b(f"{cursor}|{limit}|{predicted_class}".encode(), digest_size=12).hexdigest()
+    cache = _cache()
+    if cache is not None:
+        cache_key = f"prediction-history:{user_id}:v{cache_version(cache, f'history:{user_id}')}:{params}"
+        page = cache.get(cache_key)
+        if page is not None:
+            return page
+
+    queryset = Prediction.objects.filter(user_id=user_id)
+    if predicted_class:
+        queryset = queryset.filter(predicted_class=predicted_class)
+    if cursor:
+        created_at, pk = decode_cursor(cursor)
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+    items = list(queryset.order_by("-created_at", "-id").values(*HISTORY_FIELDS)[:limit + 1])
+
+    has_more = len(items) > limit
+    items = items[:limit]
+    page = {
+        "results": [
+            dict(item, created_at=item["created_at"].isoformat(), **upload_urls(item["image_name"]))
+            for item in items
+        ],
+        "next_cursor": encode_cursor(items[-1]) if has_more else None,
+    }
+    if cache is not None:
+        cache.set(cache_key, page, _timeout())
+    return page
+
+
+def daily_summary(days=30):
+    """Per-day and overall counts by class and severity over the last ``days`` days, from the rollups"""
+    today = timezone.localdate()
+    since = today - timedelta(days=max(1, days) - 1)
+    cache = _cache()
+    if cache is not None:
+        cache_key = f"prediction-analytics:v{cache_version(cache, 'rollups')}:{today.isoformat()}:{days}"
+        summary = cache.get(cache_key)
+        if summary is not None:
+            return summary
+
+    rows = DailyPredictionRollup.objects.filter(date__gte=since)
+    daily = defaultdict(dict)
+    for day, predicted_class, count in rows.values("date", "predicted_class").annotate(
+        total=Sum("count"),
+    ).values_list("date", "predicted_class", "total"):
+        daily[day.isoformat()][predicted_class] = count
+
+    by_class = [
+        {
+            "predicted_class": item["predicted_class"],
+            "count": item["total"],
+            "mean_confidence": round(item["confidence"] / item["total"], 4) if item["total"] else None,
+        }
+        for item in rows.values("predicted_class").annotate(
+            total=Sum("count"), confidence=Sum("confidence_sum"),
+        ).order_by("-total")
+    ]
+    by_severity = {
+        item["severity"] or "unknown": item["total"]
+        for item in rows.values("severity").annotate(total=Sum("count"))
+    }
+
+    summary = {
+        "since": since.isoformat(),
+        "until": today.isoformat(),
+        "total": sum(item["count"] for item in by_class),
+        "by_class": by_class,
+        "by_severity": by_severity,
+        "daily": [{"date": day, "counts": counts} for day, counts in sorted(daily.items())],
+    }
+    if cache is not None:
+        cache.set(cache_key, summary, _timeout())
+    return summary
@@ -0,0 +1,96 @@
+# myapp/batching.py
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """Collects concurrent inference requests and runs them as one batch.
+
+    Callers ``submit()`` a single preprocessed item and get back a Future.
+    A background thread waits until ``max_batch_size`` items are pending or
+    the oldest item has waited ``max_wait_ms``, then hands the whole list to
+    ``run_batch`` and resolves each Future with its own row of the output.
+
+    Items submitted with different ``context`` objects (the model bundle a
+    request started with) are never mixed: each batch holds items of the
+    oldest pending item's context and is run as ``run_batch(items, context)``.
+
+    ``expected`` optionally returns how many callers of this process are
+    about to submit (e.g. the admitted predictions); once that many items are
+    pending the batch runs at once instead of waiting for the deadline. It
+    returns None when the number is unknown.
+    """
+
+    def __init__(self, run_batch, max_batch_size=8, max_wait_ms=5, expected=None):
+        self.run_batch = run_batch
+        self.expected = expected
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pid = None
+
+    def submit(self, item, context=None):
+        """Queue one item for the next batch of its ``context`` and return its Future"""
+        future = Future()
+        with self._cond:
+            self._ensure_worker()
+            self._pending.append((item, future, time.monotonic(), context))
+            self._cond.notify()
+        return future
+
+    def _ensure_worker(self):
+        # Threads do not survive fork(), so a batcher created in the gunicorn
+        # master has to start its own worker thread again in each child.
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._worker, name="ml-microbatcher", daemon=True)
+        self._thread.start()
+
+    def _matching(self, context):
+        return sum(1 for entry in self._pending if entry[3] is context)
+
+    def _target(self):
+        """Pending items that close a batch: ``max_batch_size``, or fewer if no more are coming"""
+        expected = self.expected() if self.expected is not None else None
+        if expected is None:
+            return self.max_batch_size
+        return min(self.max_batch_size, max(1, expected))
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            _, _, enqueued, context = self._pending[0]
+            deadline = enqueued + self.max_wait
+            while self._matching(context) < self._target():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch, rest = [], deque()
+            for entry in self._pending:
+                if entry[3] is context and len(batch) < self.max_batch_size:
+                    batch.append(entry)
+                else:
+                    rest.append(entry)
+            self._pending = rest
+            return context, batch
+
+    def _worker(self):
+        while True:
+            context, batch = self._next_batch()
+            items = [entry[0] for entry in batch]
+            try:
+                outputs = self.run_batch(items, context)
+            except Exception as e:
+                for entry in batch:
+                    entry[1].set_exception(e)
+                continue
+            for entry, output in zip(batch, outputs):
+                entry[1].set_result(output)
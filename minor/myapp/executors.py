@@ -0,0 +1,40 @@
+# myapp/executors.py
+"""
+Dedicated thread pool for running decode + inference off the event loop.
+
+Async views await ``run_in_inference_pool`` so one ASGI worker can hold many
+in-flight uploads while at most ``ML_ASYNC_EXECUTOR_WORKERS`` predictions
+execute at once. PIL decoding and the model forward pass release the GIL,
+so threads give real parallelism here. The pool size is independent of the
+intra-op threads each forward pass uses (``ML_TORCH_THREADS``).
+"""
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+_executor = None
+_executor_pid = None
+_lock = threading.Lock()
+
+
+def get_inference_executor():
+    """Return this process's inference pool, creating it on first use (and after fork)"""
+    global _executor, _executor_pid
+    with _lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(
+                max_workers=max(1, getattr(settings, "ML_ASYNC_EXECUTOR_WORKERS", 4)),
+                thread_name_prefix="ml-inference",
+            )
+            _executor_pid = os.getpid()
+        return _executor
+
+
+async def run_in_inference_pool(fn, *args, **kwargs):
+    """Run ``fn(*args, **kwargs)`` on the inference pool and await its result"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_inference_executor(), functools.partial(fn, *args, **kwargs))
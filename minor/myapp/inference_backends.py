@@ -0,0 +1,185 @@
+# myapp/inference_backends.py
+"""
+Inference backends for the ResNet50 scalp classifier.
+
+``eager``        plain fp32 PyTorch module (the original behaviour)
+``torchscript``  traced, frozen and optimized-for-inference TorchScript graph
+``int8``         statically quantized int8 model produced by
+                 ``manage.py calibrate_model``; falls back to dynamic int8
+                 quantization of the ``fc`` layer if no calibrated artifact
+                 exists yet
+``onnx``         ONNX Runtime CPU session over the model written by
+                 ``manage.py export_onnx`` (see ``myapp.onnx_backend``)
+
+Every backend is wrapped in an object that takes a float32 NumPy batch of
+shape (N, 3, 224, 224) and returns NumPy logits, so ``MLModelService`` never
+has to touch torch tensors itself.
+"""
+import logging
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torchvision import models
+
+BACKENDS = ("eager", "torchscript", "int8", "onnx")
+
+logger = logging.getLogger(__name__)
+
+
+class TorchModel:
+    """Callable wrapper running a torch module on NumPy batches"""
+
+    def __init__(self, module, device):
+        self.module = module
+        self.device = device
+
+    def __call__(self, batch):
+        inputs = torch.from_numpy(np.ascontiguousarray(batch)).to(self.device)
+        with torch.no_grad():
+            return self.module(inputs).float().cpu().numpy()
+
+
+def default_device():
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def build_resnet50(num_classes, quantizable=False):
+    """ResNet50 with an ``num_classes``-way ``fc`` head, matching best_model.pth"""
+    if quantizable:
+        from torchvision.models.quantization import resnet50 as quantizable_resnet50
+        model = quantizable_resnet50(weights=None, quantize=False)
+    else:
+        model = models.resnet50(weights=None)
+    model.fc = nn.Linear(model.fc.in_features, num_classes)
+    return model
+
+
+FIRST_STAGE_ARCHS = ("mobilenet_v3_small", "mobilenet_v3_large")
+
+
+def build_first_stage(arch, num_classes, pretrained=False):
+    """A small MobileNetV3 classifier with the same ``num_classes`` outputs as ResNet50"""
+    if arch not in FIRST_STAGE_ARCHS:
+        raise ValueError(f"Unknown first-stage architecture '{arch}'")
+    weights = "DEFAULT" if pretrained else None
+    model = getattr(models, arch)(weights=weights)
+    model.classifier[-1] = nn.Linear(model.classifier[-1].in_features, num_classes)
+    return model
+
+
+def load_first_stage_model(model_path, num_classes, arch, device):
+    """Load the cascade's first-stage classifier (written by ``manage.py distill_first_stage``)"""
+    model = build_first_stage(arch, num_classes)
+    if model_path is not None:
+        model.load_state_dict(torch.load(model_path, map_location=device, weights_only=True), strict=True)
+    model = model.to(device)
+    model.eval()
+    model.requires_grad_(False)
+    return TorchModel(model, device)
+
+
+def trace_for_inference(model, device):
+    """Trace, freeze and optimize an eval-mode model into a TorchScript graph"""
+    example = torch.zeros(1, 3, 224, 224, device=device)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+        return torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+
+def quantize_static_int8(state_dict, num_classes, calibration_batches, engine="fbgemm"):
+    """Post-training static int8 quantization of the ResNet50 classifier.
+
+    Conv/BN/ReLU blocks are fused, observers are calibrated on
+    ``calibration_batches`` (an iterable of (N, 3, 224, 224) float tensors)
+    and the converted model is returned as a scripted module ready for
+    ``torch.jit.save``.
+    """
+    torch.backends.quantized.engine = engine
+    model = build_resnet50(num_classes, quantizable=True)
+    model.load_state_dict(state_dict, strict=True)
+    model.eval()
+    model.fuse_model(is_qat=False)
+    model.qconfig = torch.ao.quantization.get_default_qconfig(engine)
+    torch.ao.quantization.prepare(model, inplace=True)
+    with torch.no_grad():
+        for batch in calibration_batches:
+            model(batch)
+    torch.ao.quantization.convert(model, inplace=True)
+    return torch.jit.script(model)
+
+
+def quantize_dynamic_int8(model):
+    """Dynamic int8 quantization; only affects the Linear ``fc`` head of ResNet50"""
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def load_fp32_model(model_path, num_classes, device, mmap=True):
+    """Build the fp32 ResNet50 and load ``model_path`` into it (strict).
+
+    With ``model_path=None`` the randomly initialised network is returned,
+    which is only useful for benchmarks on machines without best_model.pth.
+    """
+    model = build_resnet50(num_classes)
+
+    # On CPU the checkpoint is memory-mapped and assigned in place, so the
+    # parameters are backed by the file's page cache and shared between
+    # every worker process instead of copied into each one.
+    if model_path is not None and mmap and device.type == "cpu":
+        state_dict = torch.load(model_path, map_location=device, mmap=True, weights_only=True)
+        model.load_state_dict(state_dict, strict=True, assign=True)
+    elif model_path is not None:
+        state_dict = torch.load(model_path, map_location=device)
+        model.load_state_dict(state_dict, strict=True)
+
+    model = model.to(device)
+    model.eval()
+    model.requires_grad_(False)
+    return model
+
+
+def set_torch_threads(num_threads=0, interop_threads=0):
+    """Set torch's intra-op (and, if still possible, inter-op) thread counts; 0 keeps the default"""
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if interop_threads and torch.get_num_interop_threads() != interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            # Only allowed once, before any inter-op parallel work has started
+            logger.debug("Inter-op thread count already fixed at %d", torch.get_num_interop_threads())
+
+
+def load_torch_model(model_path, num_classes, backend="eager", mmap=True, quantized_model_path=None,
+                     num_threads=0, interop_threads=0):
+    """Load best_model.pth for one of the torch backends, ready to call on NumPy batches"""
+    device = default_device()
+    set_torch_threads(num_threads, interop_threads)
+    logger.info("Using device: %s (%d intra-op threads)", device, torch.get_num_threads())
+    model = load_fp32_model(model_path, num_classes, device, mmap=mmap)
+    return TorchModel(prepare_backend(model, backend, device, quantized_model_path), device)
+
+
+def prepare_backend(model, backend, device, quantized_model_path=None):
+    """Return the module ``MLModelService`` should run for ``backend``"""
+    if backend not in BACKENDS or backend == "onnx":
+        raise ValueError(f"Unknown torch inference backend '{backend}'")
+
+    if backend == "eager":
+        return model
+
+    if backend == "torchscript":
+        return trace_for_inference(model, device)
+
+    if device.type != "cpu":
+        logger.warning("int8 backend is CPU-only; using fp32 eager on %s", device)
+        return model
+    if quantized_model_path and os.path.exists(quantized_model_path):
+        logger.info("Loading calibrated int8 model from: %s", quantized_model_path)
+        quantized = torch.jit.load(quantized_model_path, map_location="cpu")
+        quantized.eval()
+        return quantized
+    logger.warning("No calibrated int8 model found (run `manage.py calibrate_model`); "
+                   "falling back to dynamic int8 quantization of the fc layer")
+    return quantize_dynamic_int8(model)
@@ -0,0 +1,237 @@
+# myapp/inference_server.py
+"""
+Out-of-process inference over a local Unix socket.
+
+A long-lived ``manage.py run_inference_server`` process owns the
+MLModelService; Django workers talk to it through ``InferenceClient`` when
+``ML_INFERENCE_SOCKET`` is set. Web concurrency and inference parallelism can
+then be sized independently on the same host.
+
+Every message is a 4-byte big-endian header length, a JSON header and
+``header["size"]`` bytes of payload (the raw image bytes for requests, empty
+for responses).
+"""
+import json
+import os
+import socket
+import socketserver
+import stat
+import struct
+import threading
+
+from django.conf import settings
+
+from .metrics import REGISTRY
+
+_HEADER_LENGTH = struct.Struct(">I")
+
+
+def _recv_exact(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError("Connection closed by peer")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def send_message(sock, header, payload=b""):
+    header = dict(header, size=len(payload))
+    encoded = json.dumps(header).encode("utf-8")
+    sock.sendall(_HEADER_LENGTH.pack(len(encoded)) + encoded + payload)
+
+
+def recv_message(sock):
+    (length,) = _HEADER_LENGTH.unpack(_recv_exact(sock, _HEADER_LENGTH.size))
+    header = json.loads(_recv_exact(sock, length))
+    payload = _recv_exact(sock, header.get("size", 0)) if header.get("size") else b""
+    return header, payload
+
+
+class _InferenceRequestHandler(socketserver.BaseRequestHandler):
+    """Serves requests on one client connection until it is closed"""
+
+    def handle(self):
+        service = self.server.service
+        while True:
+            try:
+                header, payload = recv_message(self.request)
+            except (ConnectionError, OSError):
+                return
+
+            op = header.get("op")
+            try:
+                if op == "predict":
+                    result = service.predict(payload, header.get("symptom_start_date"))
+                elif op == "predict_many":
+                    images, offset = [], 0
+                    for size in header.get("sizes", []):
+                        images.append(payload[offset:offset + size])
+                        offset += size
+                    result = service.predict_many(images, header.get("symptom_start_dates"))
+                elif op == "cache_stats":
+                    result = service.cache.stats()
+                elif op == "metrics":
+                    result = REGISTRY.snapshot()
+                elif op == "ping":
+                    result = dict(service.readiness(), ok=True)
+                else:
+                    result = {"error": f"Unknown operation: {op}", "success": False}
+            except Exception as e:
+                result = {"error": f"Inference server error: {str(e)}", "success": False}
+
+            try:
+                send_message(self.request, {"result": result})
+            except OSError:
+                return
+
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Threaded Unix socket server wrapping an MLModelService.
+
+    Each connection gets its own thread; concurrent predictions from all
+    connections meet in the service's micro-batcher.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, service):
+        self.service = service
+        if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            os.unlink(socket_path)
+        super().__init__(socket_path, _InferenceRequestHandler)
+        os.chmod(socket_path, 0o660)
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+class InferenceClient:
+    """Thin client with the same predict interface as MLModelService.
+
+    Each thread keeps one persistent connection to the inference server and
+    reconnects once if it finds the connection broken.
+    """
+
+    def __init__(self, socket_path, timeout=60):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            self._local.sock = sock
+        return sock
+
+    def _reset(self):
+        sock = getattr(self._local, "sock", None)
+        self._local.sock = None
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    def call(self, header, payload=b""):
+        """Send one request and return the server's result.
+
+        Only a connection that breaks before the request is sent (typically a
+        persistent one the server closed) is retried. Once the request is out
+        the server may already be running it, so a timeout or error while
+        waiting for the response fails straight away instead of predicting
+        the same image twice.
+        """
+        for attempt in range(2):
+            try:
+                sock = self._connection()
+                send_message(sock, header, payload)
+                break
+            except OSError as e:
+                self._reset()
+                if attempt:
+                    raise ConnectionError(f"Inference server unavailable: {str(e)}") from e
+        try:
+            response, _ = recv_message(sock)
+        except socket.timeout as e:
+            self._reset()
+            raise ConnectionError(f"Inference server timed out after {self.timeout}s") from e
+        except OSError as e:
+            self._reset()
+            raise ConnectionError(f"Inference server connection lost: {str(e)}") from e
+        return response["result"]
+
+    @staticmethod
+    def _read(image_file):
+        if isinstance(image_file, (bytes, bytearray)):
+            return bytes(image_file)
+        if hasattr(image_file, "seek"):
+            image_file.seek(0)
+        return image_file.read()
+
+    def predict(self, image_file, symptom_start_date=None):
+        try:
+            return self.call(
+                {"op": "predict", "symptom_start_date": symptom_start_date},
+                self._read(image_file),
+            )
+        except Exception as e:
+            return {"error": str(e), "success": False}
+
+    def predict_many(self, image_files, symptom_start_dates=None):
+        images = [self._read(image_file) for image_file in image_files]
+        try:
+            return self.call(
+                {
+                    "op": "predict_many",
+                    "sizes": [len(data) for data in images],
+                    "symptom_start_dates": list(symptom_start_dates or []),
+                },
+                b"".join(images),
+            )
+        except Exception as e:
+            return [{"error": str(e), "success": False} for _ in images]
+
+    def cache_stats(self):
+        return self.call({"op": "cache_stats"})
+
+    def readiness(self):
+        """The inference server's model state; not ready while it is unreachable"""
+        try:
+            return self.call({"op": "ping"})
+        except ConnectionError as e:
+            return {"model_loaded": False, "warm": False, "ready": False, "error": str(e)}
+
+    def prepare(self):
+        """The inference server prepares its own model at startup; report whether it is ready"""
+        return self.readiness()["ready"]
+
+    def prepare_in_background(self):
+        """The inference server prepares its own model at startup"""
+
+    def metrics_snapshot(self):
+        """The inference server's metrics, for merging into this process's /metrics"""
+        return self.call({"op": "metrics"})
+
+
+def get_predictor():
+    """Return the object views should call ``predict`` on.
+
+    When ``ML_INFERENCE_SOCKET`` is configured this is an InferenceClient and
+    the model is never loaded in the web process; otherwise it is the
+    in-process global MLModelService.
+    """
+    socket_path = getattr(settings, "ML_INFERENCE_SOCKET", "")
+    if socket_path:
+        return InferenceClient(socket_path, timeout=getattr(settings, "ML_INFERENCE_TIMEOUT", 60))
+    from .ml_service import ml_service
+    return ml_service
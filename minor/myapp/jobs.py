@@ -0,0 +1,262 @@
+# myapp/jobs.py
+"""
+Asynchronous prediction jobs backed by the ``PredictionJob`` table.
+
+``submit_job`` stores the upload and returns immediately; a ``JobWorker``
+(``manage.py run_prediction_worker``, or a thread inside each web process
+when ``ML_JOB_INLINE_WORKER`` is on) claims up to ``ML_BATCH_MAX_SIZE`` queued
+jobs at a time and runs them as one ``predict_many`` batch under the same
+admission control as the synchronous endpoints. Claiming is a conditional
+UPDATE on each job's status, so any number of workers on any database can
+share the queue without an external broker. A job queued by a web process
+wakes that process's worker at once; other workers find it on their next
+poll. Finished jobs keep their result for ``ML_JOB_RESULT_TTL`` seconds and
+are then purged.
+
+The prediction page (including camera captures, which it uploads) submits a
+job and polls its status, so a slow mobile upload never holds a web worker
+while the prediction runs. Status polls wait at most ``ML_JOB_LONG_POLL_MAX``.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .admission import Overloaded, get_admission_controller
+from .metrics import PREDICTION_JOBS
+from .models import PredictionJob
+from .prediction_log import record_prediction
+from .uploads import attach_upload
+
+logger = logging.getLogger(__name__)
+
+
+def submit_job(user, data, filename="", symptom_start_date=None):
+    """Queue ``data`` (image bytes) for prediction and return the new job"""
+    job = PredictionJob.objects.create(
+        user=user if user is not None and user.is_authenticated else None,
+        image=data,
+        filename=filename or "",
+        symptom_start_date=symptom_start_date or "",
+    )
+    PREDICTION_JOBS.inc(event="submitted")
+    if getattr(settings, "ML_JOB_INLINE_WORKER", True):
+        ensure_inline_worker()
+    # Wake this process's worker once the row is visible to it
+    transaction.on_commit(_job_queued.set)
+    return job
+
+
+def job_payload(job):
+    """JSON representation returned by the job endpoints"""
+    payload = {
+        "job_id": str(job.id),
+        "status": job.status,
+        "filename": job.filename,
+        "created_at": job.created_at.isoformat(),
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+    if job.status == PredictionJob.DONE:
+        payload["result"] = job.result
+    elif job.status == PredictionJob.FAILED:
+        payload["error"] = job.error
+        if job.result:
+            payload["result"] = job.result
+    return payload
+
+
+def claim_jobs(limit):
+    """Atomically move up to ``limit`` of the oldest queued jobs to running and return them"""
+    candidates = PredictionJob.objects.filter(status=PredictionJob.QUEUED).values_list("id", flat=True)
+    claimed = []
+    for job_id in candidates[:limit * 2]:
+        if PredictionJob.objects.filter(pk=job_id, status=PredictionJob.QUEUED).update(
+            status=PredictionJob.RUNNING,
+            started_at=timezone.now(),
+            attempts=F("attempts") + 1,
+        ):
+            claimed.append(job_id)
+            if len(claimed) == limit:
+                break
+    return list(PredictionJob.objects.filter(pk__in=claimed)) if claimed else []
+
+
+def requeue_jobs(jobs):
+    """Put claimed jobs back in the queue without counting the attempt"""
+    PredictionJob.objects.filter(pk__in=[job.pk for job in jobs], status=PredictionJob.RUNNING).update(
+        status=PredictionJob.QUEUED,
+        started_at=None,
+        attempts=F("attempts") - 1,
+    )
+
+
+def run_jobs(jobs, predictor):
+    """Run claimed jobs as one admitted batch and store their results.
+
+    Raises ``Overloaded`` (after requeueing the jobs) when admission control
+    turns the batch away.
+    """
+    images = [bytes(job.image) for job in jobs]
+    try:
+        ticket = get_admission_controller().reserve()
+        try:
+            with ticket.running():
+                results = predictor.predict_many(images, [job.symptom_start_date or None for job in jobs])
+        finally:
+            ticket.release()
+    except Overloaded:
+        requeue_jobs(jobs)
+        raise
+    except Exception as e:
+        results = [{"error": f"Prediction failed: {str(e)}", "success": False} for _ in jobs]
+
+    for job, data, result in zip(jobs, images, results):
+        finish_job(job, attach_upload(result, data))
+    _notify_finished()
+    return jobs
+
+
+def finish_job(job, result):
+    """Store a job's result (or error) and schedule it for purging"""
+    job.finished_at = timezone.now()
+    job.expires_at = job.finished_at + timedelta(seconds=getattr(settings, "ML_JOB_RESULT_TTL", 3600))
+    job.image = b""
+    if "error" in result:
+        job.status = PredictionJob.FAILED
+        job.error = result["error"]
+        # A retake request carries the quality issues the client should show
+        if result.get("retake"):
+            job.result = result
+    else:
+        job.status = PredictionJob.DONE
+        job.result = result
+        record_prediction(result, source="job", user_id=job.user_id)
+    job.save(update_fields=["status", "result", "error", "image", "finished_at", "expires_at"])
+    PREDICTION_JOBS.inc(event=job.status)
+    return job
+
+
+def purge_expired_jobs():
+    """Delete finished jobs past their TTL and requeue jobs whose worker died"""
+    now = timezone.now()
+    deleted, _ = PredictionJob.objects.filter(expires_at__lt=now).delete()
+
+    stale = now - timedelta(seconds=getattr(settings, "ML_JOB_STALE_SECONDS", 300))
+    max_attempts = getattr(settings, "ML_JOB_MAX_ATTEMPTS", 3)
+    with transaction.atomic():
+        requeued = PredictionJob.objects.filter(
+            status=PredictionJob.RUNNING, started_at__lt=stale, attempts__lt=max_attempts,
+        ).update(status=PredictionJob.QUEUED)
+        PredictionJob.objects.filter(
+            status=PredictionJob.RUNNING, started_at__lt=stale, attempts__gte=max_attempts,
+        ).update(
+            status=PredictionJob.FAILED,
+            error="Prediction did not finish",
+            image=b"",
+            finished_at=now,
+            expires_at=now + timedelta(seconds=getattr(settings, "ML_JOB_RESULT_TTL", 3600)),
+        )
+    if deleted or requeued:
+        logger.info("Purged %d expired prediction job(s), requeued %d stale job(s)", deleted, requeued)
+    return deleted, requeued
+
+
+class JobWorker:
+    """Consumes the job queue until stopped"""
+
+    purge_every = 60.0
+
+    def __init__(self, predictor, poll_interval=None, batch_size=None):
+        self.predictor = predictor
+        self.poll_interval = poll_interval or getattr(settings, "ML_JOB_POLL_INTERVAL", 0.5)
+        self.batch_size = max(1, batch_size or getattr(settings, "ML_BATCH_MAX_SIZE", 8))
+        self._last_purge = 0.0
+
+    def run_once(self):
+        """Run the next batch of queued jobs, if any; return whether any were run"""
+        if time.monotonic() - self._last_purge > self.purge_every:
+            self._last_purge = time.monotonic()
+            purge_expired_jobs()
+        jobs = claim_jobs(self.batch_size)
+        if not jobs:
+            return False
+        run_jobs(jobs, self.predictor)
+        return True
+
+    def run_forever(self, stop_event=None, burst=False):
+        """Work through the queue until ``stop_event`` is set (or, with ``burst``, until it is empty)"""
+        while stop_event is None or not stop_event.is_set():
+            close_old_connections()
+            try:
+                ran = self.run_once()
+            except Overloaded as e:
+                # The web endpoints are saturated; the jobs were requeued
+                time.sleep(e.retry_after)
+                continue
+            except Exception:
+                logger.exception("Prediction job worker error")
+                ran = False
+            if not ran:
+                if burst:
+                    return
+                # submit_job() in this process wakes the worker straight away;
+                # the poll interval only bounds the delay for jobs queued elsewhere
+                _job_queued.wait(self.poll_interval)
+                _job_queued.clear()
+        close_old_connections()
+
+
+_job_queued = threading.Event()
+_finish_waiters = set()
+_finish_waiters_lock = threading.Lock()
+
+
+def _notify_finished():
+    """Wake every ``wait_for_finished_jobs`` caller in this process"""
+    with _finish_waiters_lock:
+        waiters = list(_finish_waiters)
+    for loop, event in waiters:
+        try:
+            loop.call_soon_threadsafe(event.set)
+        except RuntimeError:
+            # The waiter's event loop has already closed
+            pass
+
+
+async def wait_for_finished_jobs(timeout):
+    """Wait until this process finishes a job or ``timeout`` seconds pass, without holding a thread"""
+    entry = (asyncio.get_running_loop(), asyncio.Event())
+    with _finish_waiters_lock:
+        _finish_waiters.add(entry)
+    try:
+        await asyncio.wait_for(entry[1].wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        with _finish_waiters_lock:
+            _finish_waiters.discard(entry)
+
+
+_inline_thread = None
+_inline_pid = None
+_inline_lock = threading.Lock()
+
+
+def ensure_inline_worker():
+    """Start this process's background job worker thread if it is not running (fork-safe)"""
+    global _inline_thread, _inline_pid
+    with _inline_lock:
+        if _inline_thread is not None and _inline_pid == os.getpid() and _inline_thread.is_alive():
+            return
+        from .inference_server import get_predictor
+        worker = JobWorker(get_predictor())
+        _inline_thread = threading.Thread(target=worker.run_forever, name="prediction-jobs", daemon=True)
+        _inline_pid = os.getpid()
+        _inline_thread.start()
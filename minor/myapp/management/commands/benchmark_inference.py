@@ -0,0 +1,383 @@
+import io
+import json
+import os
+import platform
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from PIL import Image
+
+from myapp.prediction_cache import PredictionCache
+from myapp.preprocessing import list_images, preprocess_image
+
+LEVELS = ("predict", "preprocess", "http", "cascade")
+
+
+def parse_sizes(value):
+    """'640x480,1920x1080' -> [(640, 480), (1920, 1080)]"""
+    sizes = []
+    for item in value.split(","):
+        width, height = item.lower().split("x")
+        sizes.append((int(width), int(height)))
+    return sizes
+
+
+def parse_ints(value):
+    return [int(item) for item in value.split(",") if item]
+
+
+def parse_floats(value):
+    return [float(item) for item in value.split(",") if item]
+
+
+def synthetic_jpeg(size, seed):
+    """A smooth, photo-like JPEG of ``size`` pixels (random noise compresses unrealistically)"""
+    rng = np.random.default_rng(seed)
+    small = Image.fromarray(rng.integers(0, 256, (24, 32, 3), dtype=np.uint8))
+    buffer = io.BytesIO()
+    small.resize(size, Image.BICUBIC).save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def summarize(latencies, elapsed=None, items=None):
+    """Latency percentiles in milliseconds plus optional throughput"""
+    values = np.asarray(latencies, dtype=np.float64) * 1000
+    summary = {
+        "samples": len(values),
+        "mean_ms": round(float(values.mean()), 3),
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p90_ms": round(float(np.percentile(values, 90)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+        "max_ms": round(float(values.max()), 3),
+    }
+    if elapsed:
+        summary["throughput_per_s"] = round((items or len(values)) / elapsed, 2)
+    return summary
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark MLModelService latency by image and batch size, preprocessing "
+        "throughput, end-to-end /predict-api throughput and the cascade's "
+        "throughput/accuracy trade-off, and emit the results as JSON"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--levels", default=",".join(LEVELS),
+                            help=f"Comma-separated subset of: {', '.join(LEVELS)}")
+        parser.add_argument("--image-sizes", default="640x480,1920x1080,4032x3024",
+                            help="Synthetic JPEG sizes as WxH,WxH,...")
+        parser.add_argument("--batch-sizes", default="1,4,8,16")
+        parser.add_argument("--concurrency", default="1,2,4,8",
+                            help="Concurrent clients for the http level")
+        parser.add_argument("--iterations", type=int, default=20, help="Timed iterations per configuration")
+        parser.add_argument("--warmup", type=int, default=2, help="Untimed iterations per configuration")
+        parser.add_argument("--url",
+                            help="Benchmark a running server (e.g. local gunicorn) instead of the Django test client")
+        parser.add_argument("--sessionid", help="sessionid cookie for --url (the endpoint requires login)")
+        parser.add_argument("--thresholds", default="0.5,0.7,0.8,0.9,0.95",
+                            help="First-stage confidence thresholds for the cascade level")
+        parser.add_argument("--cascade-images",
+                            help="Directory of real scalp images for the cascade level (optionally in "
+                                 "class-named subfolders for accuracy); synthetic images otherwise")
+        parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+
+    def handle(self, *args, **options):
+        levels = [level for level in options["levels"].split(",") if level]
+        unknown = set(levels) - set(LEVELS)
+        if unknown:
+            raise CommandError(f"Unknown benchmark level(s): {', '.join(sorted(unknown))}")
+
+        from myapp.ml_service import ml_service as service
+
+        random_weights = not service.ensure_loaded()
+        if random_weights and not options["url"]:
+            service.load_random_model()
+        # Every configuration must measure real work, not cache hits
+        service.cache = PredictionCache(max_entries=0)
+
+        self.sizes = parse_sizes(options["image_sizes"])
+        self.iterations = max(1, options["iterations"])
+        self.warmup = max(0, options["warmup"])
+
+        results = {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "environment": self.environment(service, random_weights),
+            "results": {},
+        }
+        if "preprocess" in levels:
+            results["results"]["preprocess"] = self.bench_preprocess()
+        if "predict" in levels and not options["url"]:
+            results["results"]["predict"] = self.bench_predict(service, parse_ints(options["batch_sizes"]))
+        if "http" in levels:
+            results["results"]["http"] = self.bench_http(parse_ints(options["concurrency"]), options)
+        if "cascade" in levels and not options["url"]:
+            results["results"]["cascade"] = self.bench_cascade(
+                service, random_weights, parse_floats(options["thresholds"]), options["cascade_images"],
+                max(parse_ints(options["batch_sizes"]) or [8]),
+            )
+
+        encoded = json.dumps(results, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(encoded)
+            self.stderr.write(f"Benchmark results written to {options['output']}")
+        else:
+            self.stdout.write(encoded)
+
+    def environment(self, service, random_weights):
+        info = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "backend": service.backend,
+            "device": str(service.device),
+            "random_weights": random_weights,
+            "batching_enabled": service.batcher is not None,
+            "batch_max_size": getattr(settings, "ML_BATCH_MAX_SIZE", None),
+            "batch_max_wait_ms": getattr(settings, "ML_BATCH_MAX_WAIT_MS", None),
+            "jpeg_draft_decode": getattr(settings, "ML_JPEG_DRAFT_DECODE", None),
+        }
+        try:
+            import torch
+            info["torch"] = torch.__version__
+            info["torch_threads"] = torch.get_num_threads()
+        except ImportError:
+            pass
+        return info
+
+    def timed(self, fn):
+        for _ in range(self.warmup):
+            fn()
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(self.iterations):
+            begin = time.perf_counter()
+            fn()
+            latencies.append(time.perf_counter() - begin)
+        return latencies, time.perf_counter() - started
+
+    def bench_preprocess(self):
+        """Decode + resize + normalize only, per image size"""
+        results = []
+        for size in self.sizes:
+            data = synthetic_jpeg(size, seed=sum(size))
+            latencies, elapsed = self.timed(lambda: preprocess_image(io.BytesIO(data)))
+            results.append({"image_size": f"{size[0]}x{size[1]}", **summarize(latencies, elapsed)})
+            self.stderr.write(f"preprocess {size[0]}x{size[1]}: p50 {results[-1]['p50_ms']} ms")
+        return results
+
+    def bench_predict(self, service, batch_sizes):
+        """MLModelService.predict per image size, and batched forward passes per batch size"""
+        single = []
+        for size in self.sizes:
+            data = synthetic_jpeg(size, seed=sum(size))
+            latencies, elapsed = self.timed(lambda: service.predict(io.BytesIO(data)))
+            single.append({"image_size": f"{size[0]}x{size[1]}", **summarize(latencies, elapsed)})
+            self.stderr.write(f"predict {size[0]}x{size[1]}: p50 {single[-1]['p50_ms']} ms")
+
+        batched = []
+        for batch_size in batch_sizes:
+            batch = np.random.default_rng(batch_size).standard_normal(
+                (batch_size, 3, 224, 224)).astype(np.float32)
+            latencies, elapsed = self.timed(lambda: service._run_batch(batch))
+            entry = summarize(latencies, elapsed, items=batch_size * len(latencies))
+            entry["batch_size"] = batch_size
+            entry["per_image_ms"] = round(entry["mean_ms"] / batch_size, 3)
+            batched.append(entry)
+            self.stderr.write(f"forward batch={batch_size}: {entry['per_image_ms']} ms/image")
+
+        return {"single_image": single, "batched_forward": batched}
+
+    def bench_cascade(self, service, random_weights, thresholds, images_dir, batch_size):
+        """Throughput and agreement with ResNet50 for each first-stage confidence threshold"""
+        from myapp.ml_service import FULL_TIER
+
+        bundle = service.bundle
+        first_stage = bundle.first_stage or service._load_first_stage(bundle.device)
+        if first_stage is None and random_weights:
+            from myapp.inference_backends import load_first_stage_model
+            first_stage = load_first_stage_model(
+                None, len(service.class_names), getattr(settings, "ML_CASCADE_ARCH", "mobilenet_v3_small"),
+                bundle.device,
+            )
+        if first_stage is None:
+            raise CommandError("No first-stage model; train one with `manage.py distill_first_stage`")
+
+        if images_dir:
+            paths = list_images(images_dir)
+            if not paths:
+                raise CommandError(f"No images found in {images_dir}")
+            inputs = np.stack([service.preprocess(path) for path in paths])
+            labels = [os.path.basename(os.path.dirname(path)) for path in paths]
+            labels = [label if label in service.class_names else None for label in labels]
+        else:
+            size = self.sizes[0]
+            inputs = np.stack([service.preprocess(io.BytesIO(synthetic_jpeg(size, seed=i))) for i in range(32)])
+            labels = [None] * len(inputs)
+
+        def run(cascade_bundle):
+            outputs, started = [], time.perf_counter()
+            for start in range(0, len(inputs), batch_size):
+                outputs.extend(service._run_batch(inputs[start:start + batch_size], cascade_bundle))
+            return outputs, time.perf_counter() - started
+
+        def score(outputs, elapsed):
+            predictions = [int(np.argmax(probs)) for probs, _ in outputs]
+            entry = {
+                "images_per_s": round(len(inputs) / elapsed, 2),
+                "escalation_rate": round(sum(tier == FULL_TIER for _, tier in outputs) / len(outputs), 4),
+                "agreement_with_resnet50": round(
+                    sum(p == r for p, r in zip(predictions, reference)) / len(predictions), 4),
+            }
+            labelled = [(p, label) for p, label in zip(predictions, labels) if label is not None]
+            if labelled:
+                entry["accuracy"] = round(
+                    sum(service.class_names[p] == label for p, label in labelled) / len(labelled), 4)
+            return entry
+
+        full_bundle = bundle._replace(first_stage=None)
+        cascade_bundle = bundle._replace(first_stage=first_stage)
+        run(full_bundle)  # warmup
+        outputs, elapsed = run(full_bundle)
+        reference = [int(np.argmax(probs)) for probs, _ in outputs]
+        baseline = score(outputs, elapsed)
+        self.stderr.write(f"cascade resnet50 only: {baseline['images_per_s']} images/s")
+
+        tradeoff = []
+        for threshold in thresholds:
+            with override_settings(ML_CASCADE_THRESHOLD=threshold):
+                run(cascade_bundle)
+                entry = score(*run(cascade_bundle))
+            entry["threshold"] = threshold
+            entry["speedup"] = round(entry["images_per_s"] / baseline["images_per_s"], 2)
+            tradeoff.append(entry)
+            self.stderr.write(
+                f"cascade threshold={threshold}: {entry['images_per_s']} images/s, "
+                f"{entry['escalation_rate']:.0%} escalated, {entry['agreement_with_resnet50']:.1%} agreement"
+            )
+
+        return {
+            "images": len(inputs),
+            "batch_size": batch_size,
+            "first_stage": getattr(settings, "ML_CASCADE_ARCH", "mobilenet_v3_small"),
+            "resnet50_only": baseline,
+            "thresholds": tradeoff,
+        }
+
+    def bench_http(self, concurrency_levels, options):
+        """End-to-end POSTs to /predict-api at increasing concurrency"""
+        size = self.sizes[0]
+        payloads = [synthetic_jpeg(size, seed=i) for i in range(8)]
+
+        if options["url"]:
+            post = self.live_poster(options["url"], options["sessionid"])
+            teardown = None
+        else:
+            post, teardown = self.test_client_poster()
+
+        results = []
+        try:
+            for concurrency in concurrency_levels:
+                total = max(self.iterations, concurrency) * concurrency
+                for i in range(self.warmup):
+                    post(payloads[i % len(payloads)])
+
+                latencies, errors = [], 0
+                lock = threading.Lock()
+
+                def one(i):
+                    nonlocal errors
+                    begin = time.perf_counter()
+                    ok = post(payloads[i % len(payloads)])
+                    took = time.perf_counter() - begin
+                    with lock:
+                        latencies.append(took)
+                        errors += 0 if ok else 1
+
+                started = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                    list(pool.map(one, range(total)))
+                elapsed = time.perf_counter() - started
+
+                entry = summarize(latencies, elapsed)
+                entry.update({"concurrency": concurrency, "requests": total, "errors": errors,
+                              "image_size": f"{size[0]}x{size[1]}"})
+                results.append(entry)
+                self.stderr.write(
+                    f"http concurrency={concurrency}: {entry['throughput_per_s']} req/s, p99 {entry['p99_ms']} ms"
+                )
+        finally:
+            if teardown:
+                teardown()
+        return results
+
+    def test_client_poster(self):
+        """POST through the Django test client against a throwaway test database"""
+        from django.contrib.auth.models import User
+        from django.db import connection
+        from django.test import Client
+        from django.test.utils import setup_test_environment, teardown_test_environment
+
+        setup_test_environment()
+        if connection.vendor == "sqlite":
+            # The default shared in-memory SQLite test database raises "table is
+            # locked" under concurrent session writes; a file waits instead.
+            import tempfile
+            connection.settings_dict["TEST"]["NAME"] = os.path.join(
+                tempfile.mkdtemp(prefix="benchmark-"), "test.sqlite3")
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        user = User.objects.create_user("benchmark", password="benchmark-password")
+        local = threading.local()
+
+        def post(data):
+            client = getattr(local, "client", None)
+            if client is None:
+                client = local.client = Client()
+                client.force_login(user)
+            upload = io.BytesIO(data)
+            upload.name = "benchmark.jpg"
+            try:
+                response = client.post("/predict-api", {"file": upload})
+            except Exception:
+                return False
+            return response.status_code == 200
+
+        def teardown():
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        return post, teardown
+
+    def live_poster(self, url, sessionid):
+        """POST multipart uploads to a running server with urllib"""
+        import urllib.request
+        import uuid
+
+        endpoint = url.rstrip("/") + "/predict-api"
+
+        def post(data):
+            boundary = uuid.uuid4().hex
+            body = (
+                f"--{boundary}\r\n"
+                'Content-Disposition: form-data; name="file"; filename="benchmark.jpg"\r\n'
+                "Content-Type: image/jpeg\r\n\r\n"
+            ).encode() + data + f"\r\n--{boundary}--\r\n".encode()
+            request = urllib.request.Request(endpoint, data=body, method="POST")
+            request.add_header("Content-Type", f"multipart/form-data; boundary={boundary}")
+            if sessionid:
+                request.add_header("Cookie", f"sessionid={sessionid}")
+            try:
+                with urllib.request.urlopen(request, timeout=120) as response:
+                    response.read()
+                    return response.status == 200
+            except Exception:
+                return False
+
+        return post
@@ -0,0 +1,82 @@
+import json
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from myapp.preprocessing import IMAGE_MEAN, IMAGE_SIZE, IMAGE_STD, list_images, preprocess_batch
+
+
+def reference_transform():
+    """The original torchvision Resize -> ToTensor -> Normalize pipeline"""
+    from PIL import Image
+    from torchvision import transforms
+
+    transform = transforms.Compose([
+        transforms.Resize(IMAGE_SIZE),
+        transforms.ToTensor(),
+        transforms.Normalize(IMAGE_MEAN.tolist(), IMAGE_STD.tolist()),
+    ])
+
+    def run(paths):
+        return np.stack([transform(Image.open(path).convert("RGB")).numpy() for path in paths])
+
+    return run
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the fast preprocessing pipeline against the original torchvision "
+        "transform and check that their outputs agree within tolerance"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--images", required=True, help="Directory of sample images (ideally full-size phone JPEGs)")
+        parser.add_argument("--repeat", type=int, default=3, help="Timed passes over the image set")
+        parser.add_argument("--tolerance", type=float, default=1e-5,
+                            help="Maximum allowed difference for the full-resolution (non-draft) fast path")
+        parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+
+    def handle(self, *args, **options):
+        paths = list_images(options["images"])
+        if not paths:
+            raise CommandError(f"No images found in {options['images']}")
+
+        pipelines = {
+            "torchvision": reference_transform(),
+            "fast": lambda items: preprocess_batch(items, draft=False),
+            "fast_draft": lambda items: preprocess_batch(items, draft=True),
+        }
+
+        outputs, timings = {}, {}
+        for name, run in pipelines.items():
+            outputs[name] = run(paths)
+            started = time.perf_counter()
+            for _ in range(max(1, options["repeat"])):
+                run(paths)
+            elapsed = time.perf_counter() - started
+            timings[name] = 1000 * elapsed / (len(paths) * max(1, options["repeat"]))
+
+        reference = outputs["torchvision"]
+        results = {"images": len(paths), "pipelines": {}}
+        for name in pipelines:
+            diff = np.abs(outputs[name] - reference)
+            results["pipelines"][name] = {
+                "ms_per_image": round(timings[name], 3),
+                "speedup": round(timings["torchvision"] / timings[name], 2),
+                "max_abs_diff": float(diff.max()),
+                "mean_abs_diff": float(diff.mean()),
+            }
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+        else:
+            self.stdout.write(f"Preprocessing {len(paths)} images ({options['repeat']} passes)")
+            for name, entry in results["pipelines"].items():
+                self.stdout.write(
+                    f"  {name:<12} {entry['ms_per_image']:>9.3f} ms/image  x{entry['speedup']:<6} "
+                    f"max |diff| {entry['max_abs_diff']:.2e}  mean |diff| {entry['mean_abs_diff']:.2e}"
+                )
+
+        if results["pipelines"]["fast"]["max_abs_diff"] > options["tolerance"]:
+            raise CommandError("Fast preprocessing does not match the torchvision transform within tolerance")
@@ -0,0 +1,202 @@
+import json
+import os
+import time
+
+import numpy as np
+import torch
+from django.core.management.base import BaseCommand, CommandError
+
+from myapp.inference_backends import build_resnet50, quantize_static_int8, trace_for_inference
+from myapp.model_registry import RegistryError
+from myapp.preprocessing import list_images
+
+class Command(BaseCommand):
+    help = (
+        "Calibrate a statically quantized int8 copy of best_model.pth and report "
+        "how its predictions differ from the fp32 (and TorchScript) model"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--images", required=True,
+                            help="Directory of representative scalp images used for calibration")
+        parser.add_argument("--eval-images",
+                            help="Directory used for the accuracy-diff report (defaults to --images). "
+                                 "Images inside a folder named after a class are also scored against that label.")
+        parser.add_argument("--version",
+                            help="Registry version to calibrate (defaults to the active one, else best_model.pth)")
+        parser.add_argument("--output",
+                            help="Where to write the int8 TorchScript model (defaults to next to the version's "
+                                 "registry weights, or ML_QUANTIZED_MODEL_PATH for best_model.pth)")
+        parser.add_argument("--limit", type=int, default=200, help="Maximum number of calibration images")
+        parser.add_argument("--batch-size", type=int, default=16)
+        parser.add_argument("--report", help="Optional path to write the accuracy-diff report as JSON")
+
+    def handle(self, *args, **options):
+        from myapp.ml_service import ml_service as service
+
+        class_names = service.class_names
+        try:
+            version, model_path = service.resolve_model(options["version"])
+        except (FileNotFoundError, RegistryError) as e:
+            raise CommandError(str(e))
+        options["output"] = options["output"] or service.quantized_model_path(version)
+
+        calibration_paths = list_images(options["images"])[:options["limit"]]
+        if not calibration_paths:
+            raise CommandError(f"No images found in {options['images']}")
+        eval_paths = list_images(options["eval_images"] or options["images"])
+
+        batch_size = max(1, options["batch_size"])
+        skipped = {}
+
+        def batches(paths):
+            """(tensor, paths) batches; images that cannot be decoded are skipped and recorded"""
+            images, kept = [], []
+            for path in paths:
+                try:
+                    images.append(service.preprocess(path))
+                except Exception as e:
+                    skipped[path] = str(e) or e.__class__.__name__
+                    continue
+                kept.append(path)
+                if len(images) == batch_size:
+                    yield torch.from_numpy(np.stack(images)), kept
+                    images, kept = [], []
+            if images:
+                yield torch.from_numpy(np.stack(images)), kept
+
+        state_dict = torch.load(model_path, map_location="cpu", weights_only=True)
+
+        self.stdout.write(f"Calibrating on {len(calibration_paths)} images...")
+        calibrated = 0
+
+        def calibration_batches():
+            nonlocal calibrated
+            for batch, kept in batches(calibration_paths):
+                calibrated += len(kept)
+                yield batch
+
+        quantized = quantize_static_int8(state_dict, len(class_names), calibration_batches())
+        if not calibrated:
+            raise CommandError(f"None of the {len(calibration_paths)} calibration images could be decoded")
+        torch.jit.save(quantized, options["output"])
+        self.stdout.write(self.style.SUCCESS(f"Wrote int8 model to {options['output']}"))
+
+        fp32 = build_resnet50(len(class_names))
+        fp32.load_state_dict(state_dict, strict=True)
+        fp32.eval()
+        candidates = {
+            "torchscript": trace_for_inference(fp32, torch.device("cpu")),
+            "int8": quantized,
+        }
+
+        report = self.accuracy_diff(fp32, candidates, batches(eval_paths), class_names)
+        report["model_path"] = model_path
+        report["quantized_model_path"] = options["output"]
+        report["calibration_images"] = calibrated
+        report["skipped_images"] = sorted(skipped)
+        report["model_size_mb"] = {
+            "fp32": round(os.path.getsize(model_path) / 1e6, 1),
+            "int8": round(os.path.getsize(options["output"]) / 1e6, 1),
+        }
+
+        self.print_report(report, class_names)
+        if skipped:
+            self.stderr.write(self.style.WARNING(f"Skipped {len(skipped)} image(s) that could not be decoded:"))
+            for path, error in sorted(skipped.items()):
+                self.stderr.write(f"  {path}: {error}")
+        if options["report"]:
+            with open(options["report"], "w") as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"Report written to {options['report']}")
+
+    def accuracy_diff(self, reference, candidates, batches, class_names):
+        """Compare each candidate backend's predictions with the fp32 reference"""
+        def label_of(path):
+            label = os.path.basename(os.path.dirname(path))
+            return label if label in class_names else None
+
+        stats = {
+            name: {
+                "agree": 0,
+                "correct": 0,
+                "max_abs_prob_diff": 0.0,
+                "sum_abs_prob_diff": 0.0,
+                "seconds": 0.0,
+                "per_class": {cls: {"images": 0, "agree": 0} for cls in class_names},
+            }
+            for name in candidates
+        }
+        reference_stats = {"correct": 0, "seconds": 0.0}
+        seen = 0
+        labelled = 0
+
+        with torch.no_grad():
+            for batch, paths in batches:
+                started = time.perf_counter()
+                ref_probs = torch.softmax(reference(batch), dim=1)
+                reference_stats["seconds"] += time.perf_counter() - started
+                ref_pred = ref_probs.argmax(dim=1).tolist()
+                batch_labels = [label_of(path) for path in paths]
+                labelled += sum(1 for label in batch_labels if label)
+                reference_stats["correct"] += sum(
+                    1 for pred, label in zip(ref_pred, batch_labels) if label == class_names[pred]
+                )
+
+                for name, model in candidates.items():
+                    started = time.perf_counter()
+                    probs = torch.softmax(model(batch), dim=1)
+                    entry = stats[name]
+                    entry["seconds"] += time.perf_counter() - started
+                    diff = (probs - ref_probs).abs().max(dim=1).values
+                    entry["max_abs_prob_diff"] = max(entry["max_abs_prob_diff"], float(diff.max()))
+                    entry["sum_abs_prob_diff"] += float(diff.sum())
+                    for ref, pred, label in zip(ref_pred, probs.argmax(dim=1).tolist(), batch_labels):
+                        per_class = entry["per_class"][class_names[ref]]
+                        per_class["images"] += 1
+                        if pred == ref:
+                            entry["agree"] += 1
+                            per_class["agree"] += 1
+                        if label == class_names[pred]:
+                            entry["correct"] += 1
+                seen += len(batch)
+
+        report = {
+            "images": seen,
+            "labelled_images": labelled,
+            "fp32": {
+                "ms_per_image": round(1000 * reference_stats["seconds"] / max(seen, 1), 2),
+                "accuracy": (reference_stats["correct"] / labelled) if labelled else None,
+            },
+        }
+        for name, entry in stats.items():
+            report[name] = {
+                "top1_agreement": entry["agree"] / max(seen, 1),
+                "max_abs_prob_diff": entry["max_abs_prob_diff"],
+                "mean_abs_prob_diff": entry["sum_abs_prob_diff"] / max(seen, 1),
+                "ms_per_image": round(1000 * entry["seconds"] / max(seen, 1), 2),
+                "accuracy": (entry["correct"] / labelled) if labelled else None,
+                "per_class_agreement": {
+                    cls: (counts["agree"] / counts["images"]) if counts["images"] else None
+                    for cls, counts in entry["per_class"].items()
+                },
+            }
+        return report
+
+    def print_report(self, report, class_names):
+        self.stdout.write("")
+        self.stdout.write(f"Accuracy diff vs fp32 on {report['images']} images")
+        self.stdout.write(f"  fp32         {report['fp32']['ms_per_image']:>8} ms/image")
+        for name in ("torchscript", "int8"):
+            entry = report[name]
+            self.stdout.write(
+                f"  {name:<12} {entry['ms_per_image']:>8} ms/image  "
+                f"top-1 agreement {entry['top1_agreement']:.3f}  "
+                f"max |dp| {entry['max_abs_prob_diff']:.4f}"
+            )
+        self.stdout.write("")
+        self.stdout.write("  Per-class int8 agreement (by fp32 prediction):")
+        for cls in class_names:
+            agreement = report["int8"]["per_class_agreement"][cls]
+            shown = "-" if agreement is None else f"{agreement:.3f}"
+            self.stdout.write(f"    {cls:<24} {shown}")
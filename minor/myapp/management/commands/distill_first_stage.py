@@ -0,0 +1,96 @@
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from myapp.inference_backends import FIRST_STAGE_ARCHS, build_first_stage, load_fp32_model
+from myapp.model_registry import RegistryError
+from myapp.preprocessing import list_images
+
+
+class Command(BaseCommand):
+    help = (
+        "Train the cascade's small first-stage classifier by distilling ResNet50's "
+        "predictions on a directory of (unlabelled) scalp images"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--images", required=True, help="Directory of representative scalp images")
+        parser.add_argument("--output", default=getattr(settings, "ML_CASCADE_MODEL_PATH", "first_stage_model.pth"))
+        parser.add_argument("--arch", default=getattr(settings, "ML_CASCADE_ARCH", "mobilenet_v3_small"),
+                            choices=FIRST_STAGE_ARCHS)
+        parser.add_argument("--epochs", type=int, default=10)
+        parser.add_argument("--batch-size", type=int, default=32)
+        parser.add_argument("--lr", type=float, default=1e-3)
+        parser.add_argument("--temperature", type=float, default=2.0, help="Distillation softmax temperature")
+        parser.add_argument("--pretrained", action="store_true",
+                            help="Start from torchvision's ImageNet weights (downloads them)")
+
+    def handle(self, *args, **options):
+        from myapp.ml_service import ml_service as service
+
+        paths = list_images(options["images"])
+        if not paths:
+            raise CommandError(f"No images found in {options['images']}")
+        try:
+            _, model_path = service.resolve_model()
+        except (FileNotFoundError, RegistryError) as e:
+            raise CommandError(str(e))
+
+        device = torch.device("cpu")
+        teacher = load_fp32_model(model_path, len(service.class_names), device, mmap=True)
+
+        # Inputs and teacher soft targets are computed once; the image set is
+        # expected to be a few thousand images at most
+        self.stdout.write(f"Preprocessing {len(paths)} images and computing ResNet50 targets...")
+        inputs = np.stack([service.preprocess(path) for path in paths])
+        with torch.no_grad():
+            teacher_logits = torch.cat([
+                teacher(torch.from_numpy(inputs[start:start + 64]))
+                for start in range(0, len(inputs), 64)
+            ])
+
+        student = build_first_stage(options["arch"], len(service.class_names), pretrained=options["pretrained"])
+        optimizer = torch.optim.AdamW(student.parameters(), lr=options["lr"])
+        temperature = options["temperature"]
+        batch_size = max(1, options["batch_size"])
+        rng = np.random.default_rng(0)
+
+        for epoch in range(options["epochs"]):
+            student.train()
+            order = rng.permutation(len(inputs))
+            total_loss, started = 0.0, time.perf_counter()
+            for start in range(0, len(order), batch_size):
+                index = order[start:start + batch_size]
+                batch = torch.from_numpy(inputs[index])
+                # Random horizontal flips; scalp images have no preferred side
+                flip = torch.from_numpy(rng.random(len(index)) < 0.5)
+                batch[flip] = batch[flip].flip(-1)
+                loss = F.kl_div(
+                    F.log_softmax(student(batch) / temperature, dim=1),
+                    F.softmax(teacher_logits[index] / temperature, dim=1),
+                    reduction="batchmean",
+                ) * temperature ** 2
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+                total_loss += float(loss) * len(index)
+            self.stdout.write(f"epoch {epoch + 1}/{options['epochs']}: loss {total_loss / len(inputs):.4f} "
+                              f"({time.perf_counter() - started:.1f}s)")
+
+        student.eval()
+        with torch.no_grad():
+            student_probs = torch.cat([
+                torch.softmax(student(torch.from_numpy(inputs[start:start + 64])), dim=1)
+                for start in range(0, len(inputs), 64)
+            ])
+        agreement = float((student_probs.argmax(1) == teacher_logits.argmax(1)).float().mean())
+        torch.save(student.state_dict(), options["output"])
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {options['arch']} first stage to {options['output']} "
+            f"(top-1 agreement with ResNet50 on the training images: {agreement:.1%}); "
+            "use `benchmark_inference --levels cascade` to choose ML_CASCADE_THRESHOLD"
+        ))
@@ -0,0 +1,76 @@
+import numpy as np
+import torch
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from myapp.inference_backends import load_fp32_model
+from myapp.model_registry import RegistryError
+from myapp.preprocessing import list_images
+
+
+class Command(BaseCommand):
+    help = "Export best_model.pth to ONNX and check its logits against the PyTorch model"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", default=getattr(settings, "ML_ONNX_MODEL_PATH", "best_model.onnx"),
+                            help="Where to write the ONNX model (defaults to ML_ONNX_MODEL_PATH)")
+        parser.add_argument("--opset", type=int, default=17)
+        parser.add_argument("--fixtures",
+                            help="Directory of images for the parity check (random inputs are used if omitted)")
+        parser.add_argument("--samples", type=int, default=8,
+                            help="Number of random inputs for the parity check when --fixtures is not given")
+        parser.add_argument("--tolerance", type=float, default=1e-3,
+                            help="Maximum allowed absolute logit difference between the two backends")
+        parser.add_argument("--skip-check", action="store_true", help="Export only, without the parity check")
+
+    def handle(self, *args, **options):
+        from myapp.ml_service import ml_service as service
+
+        try:
+            _, model_path = service.resolve_model()
+        except (FileNotFoundError, RegistryError) as e:
+            raise CommandError(str(e))
+
+        model = load_fp32_model(model_path, len(service.class_names), torch.device("cpu"), mmap=False)
+        example = torch.zeros(1, 3, 224, 224)
+        torch.onnx.export(
+            model,
+            example,
+            options["output"],
+            input_names=["input"],
+            output_names=["logits"],
+            dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}},
+            opset_version=options["opset"],
+        )
+        self.stdout.write(self.style.SUCCESS(f"Exported {model_path} to {options['output']}"))
+
+        if options["skip_check"]:
+            return
+
+        if options["fixtures"]:
+            paths = list_images(options["fixtures"])
+            if not paths:
+                raise CommandError(f"No images found in {options['fixtures']}")
+            inputs = np.stack([service.preprocess(path) for path in paths])
+        else:
+            rng = np.random.default_rng(0)
+            inputs = rng.standard_normal((options["samples"], 3, 224, 224)).astype(np.float32)
+
+        self.check_parity(model, options["output"], inputs, options["tolerance"])
+
+    def check_parity(self, model, onnx_path, inputs, tolerance):
+        """Compare PyTorch and ONNX Runtime logits on the same inputs"""
+        from myapp.onnx_backend import OnnxModel
+
+        with torch.no_grad():
+            torch_logits = model(torch.from_numpy(inputs)).numpy()
+        onnx_logits = OnnxModel(onnx_path)(inputs)
+
+        max_diff = float(np.abs(torch_logits - onnx_logits).max())
+        agreement = float((torch_logits.argmax(axis=1) == onnx_logits.argmax(axis=1)).mean())
+        self.stdout.write(
+            f"Parity on {len(inputs)} inputs: max |logit diff| {max_diff:.2e}, top-1 agreement {agreement:.3f}"
+        )
+        if max_diff > tolerance or agreement < 1.0:
+            raise CommandError(f"ONNX export does not match PyTorch within tolerance {tolerance}")
+        self.stdout.write(self.style.SUCCESS("ONNX Runtime logits match PyTorch"))
@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from myapp.model_registry import RegistryError, get_registry
+
+
+class Command(BaseCommand):
+    help = (
+        "Manage versioned model weights: add a new version, list versions, verify "
+        "checksums, or activate a version (running workers hot-swap to it)"
+    )
+
+    def add_arguments(self, parser):
+        subcommands = parser.add_subparsers(dest="action", required=True)
+
+        add = subcommands.add_parser("add", help="Copy a weights file into the registry as a new version")
+        add.add_argument("path", help="Path to a best_model.pth state dict")
+        add.add_argument("--version", help="Version name (default: next vN)")
+        add.add_argument("--notes", default="")
+        add.add_argument("--activate", action="store_true", help="Make it the active version")
+
+        subcommands.add_parser("list", help="List versions")
+
+        activate = subcommands.add_parser("activate", help="Switch the active version")
+        activate.add_argument("version")
+
+        verify = subcommands.add_parser("verify", help="Check a version's checksum (default: all)")
+        verify.add_argument("version", nargs="?")
+
+    def handle(self, *args, **options):
+        registry = get_registry()
+        try:
+            getattr(self, f"handle_{options['action']}")(registry, options)
+        except RegistryError as e:
+            raise CommandError(str(e))
+
+    def handle_add(self, registry, options):
+        version = registry.add(options["path"], options["version"], options["notes"], options["activate"])
+        self.stdout.write(self.style.SUCCESS(f"Added model version {version} to {registry.root}"))
+        if registry.active_version() == version:
+            self.stdout.write(f"{version} is now active")
+
+    def handle_list(self, registry, options):
+        active = registry.active_version()
+        versions = registry.versions()
+        if not versions:
+            self.stdout.write(f"No model versions in {registry.root}")
+        for version, entry in versions:
+            marker = "*" if version == active else " "
+            self.stdout.write(f"{marker} {version:<10} {entry['sha256'][:12]}  {entry['size'] / 1e6:8.1f} MB  "
+                              f"{entry['added_at']}  {entry.get('notes', '')}")
+
+    def handle_activate(self, registry, options):
+        registry.activate(options["version"])
+        self.stdout.write(self.style.SUCCESS(
+            f"Activated model version {options['version']}; workers will load, warm and swap to it"
+        ))
+
+    def handle_verify(self, registry, options):
+        versions = [options["version"]] if options["version"] else [version for version, _ in registry.versions()]
+        for version in versions:
+            registry.verify(version)
+            self.stdout.write(f"{version}: OK")
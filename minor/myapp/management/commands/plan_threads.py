@@ -0,0 +1,138 @@
+import json
+import multiprocessing
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from myapp.thread_planner import (
+    apply_affinity, available_cpus, cgroup_cpu_limit, current_plan, plan_threads,
+)
+
+
+def parse_ints(value):
+    return [int(item) for item in value.split(",") if item]
+
+
+def _benchmark_worker(plan, batch_size, seconds, barrier, results):
+    """One simulated gunicorn worker: forward passes on a random ResNet50 for ``seconds``"""
+    import numpy as np
+
+    from myapp.inference_backends import TorchModel, build_resnet50, default_device, set_torch_threads
+
+    apply_affinity(plan)
+    set_torch_threads(plan.intra_op, plan.inter_op)
+    device = default_device()
+    model = TorchModel(build_resnet50(11).to(device).eval(), device)
+    batch = np.random.default_rng(plan.worker_index).standard_normal((batch_size, 3, 224, 224)).astype(np.float32)
+    for _ in range(2):
+        model(batch)
+
+    barrier.wait()
+    images, deadline = 0, time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        model(batch)
+        images += batch_size
+    results.put(images)
+
+
+class Command(BaseCommand):
+    help = (
+        "Show the CPU thread layout the planner picks for each gunicorn worker, or "
+        "benchmark candidate worker/thread layouts and report the fastest"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int,
+                            help="Worker processes to plan for (default: ML_WORKER_PROCESSES / WEB_CONCURRENCY)")
+        parser.add_argument("--pin", action="store_true", help="Plan (and benchmark) pinned core sets")
+        parser.add_argument("--benchmark", action="store_true",
+                            help="Time concurrent workers for each candidate layout")
+        parser.add_argument("--worker-counts", help="Worker counts to try in --benchmark, e.g. 1,2,4")
+        parser.add_argument("--threads", help="Intra-op threads per worker to try in --benchmark, e.g. 1,2,4")
+        parser.add_argument("--batch-size", type=int, default=1)
+        parser.add_argument("--seconds", type=float, default=10.0, help="Timed duration per layout")
+        parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+
+    def handle(self, *args, **options):
+        cpus = available_cpus()
+        cpu_limit = cgroup_cpu_limit()
+        default = current_plan()
+        workers = options["workers"] or default.workers
+
+        layout = [
+            plan_threads(workers, index, pin=options["pin"], intra_op=getattr(settings, "ML_TORCH_THREADS", 0),
+                         inter_op=default.inter_op, cpus=cpus, cpu_limit=cpu_limit)
+            for index in range(workers)
+        ]
+        report = {
+            "cpus": cpus,
+            "cgroup_cpu_limit": cpu_limit,
+            "layout": [plan._asdict() for plan in layout],
+        }
+        if options["benchmark"]:
+            report["benchmark"] = self.benchmark(cpus, cpu_limit, workers, options)
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        self.stdout.write(f"Usable CPUs: {layout[0].usable_cpus} of {len(cpus)} "
+                          f"(cgroup limit: {cpu_limit if cpu_limit else 'none'})")
+        for plan in layout:
+            self.stdout.write(
+                f"  worker {plan.worker_index}: {plan.intra_op} intra-op / {plan.inter_op} inter-op threads, "
+                f"CPUs {plan.cpus if plan.cpus else 'unpinned'}"
+            )
+        if options["benchmark"]:
+            self.stdout.write("")
+            self.stdout.write(f"{'workers':>8} {'threads':>8} {'pinned':>7} {'images/s':>10}")
+            for entry in report["benchmark"]["results"]:
+                self.stdout.write(f"{entry['workers']:>8} {entry['intra_op']:>8} {str(entry['pinned']):>7} "
+                                  f"{entry['images_per_s']:>10.2f}")
+            best = report["benchmark"]["best"]
+            self.stdout.write(self.style.SUCCESS(
+                f"Best: WEB_CONCURRENCY={best['workers']} ML_TORCH_THREADS={best['intra_op']} "
+                f"ML_PIN_CPUS={int(best['pinned'])} ({best['images_per_s']:.2f} images/s)"
+            ))
+
+    def benchmark(self, cpus, cpu_limit, workers, options):
+        usable = plan_threads(1, cpus=cpus, cpu_limit=cpu_limit).usable_cpus
+        worker_counts = parse_ints(options["worker_counts"]) if options["worker_counts"] else [workers]
+        thread_counts = (parse_ints(options["threads"]) if options["threads"]
+                         else sorted({1, 2, 4, max(1, usable // max(worker_counts))} | {usable}))
+
+        context = multiprocessing.get_context("spawn")
+        results = []
+        for count in worker_counts:
+            for threads in thread_counts:
+                for pinned in ([False, True] if options["pin"] else [False]):
+                    plans = [plan_threads(count, index, pin=pinned, intra_op=threads, cpus=cpus, cpu_limit=cpu_limit)
+                             for index in range(count)]
+                    rate = self.run_layout(context, plans, options["batch_size"], options["seconds"])
+                    results.append({"workers": count, "intra_op": threads, "pinned": pinned,
+                                    "images_per_s": round(rate, 2)})
+                    self.stderr.write(f"workers={count} threads={threads} pinned={pinned}: {rate:.2f} images/s")
+
+        return {
+            "batch_size": options["batch_size"],
+            "seconds": options["seconds"],
+            "results": results,
+            "best": max(results, key=lambda entry: entry["images_per_s"]),
+        }
+
+    def run_layout(self, context, plans, batch_size, seconds):
+        """Aggregate images/s of ``len(plans)`` concurrent worker processes"""
+        barrier = context.Barrier(len(plans))
+        queue = context.Queue()
+        processes = [
+            context.Process(target=_benchmark_worker, args=(plan, batch_size, seconds, barrier, queue))
+            for plan in plans
+        ]
+        for process in processes:
+            process.start()
+        # Generous timeout so a crashed worker cannot hang the benchmark
+        total = sum(queue.get(timeout=seconds + 600) for _ in processes)
+        for process in processes:
+            process.join()
+        return total / seconds
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from myapp.analytics import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the daily prediction rollups from the Prediction table "
+        "(only needed after bulk imports or manual edits; normal writes keep them current)"
+    )
+
+    def handle(self, *args, **options):
+        rows = rebuild_rollups()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {rows} daily rollup row(s)"))
@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from myapp.inference_server import InferenceServer
+
+
+class Command(BaseCommand):
+    help = "Run the long-lived inference process that serves predictions over a Unix socket"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--socket",
+            default=getattr(settings, "ML_INFERENCE_SOCKET", "") or "/tmp/hair-scalp-inference.sock",
+            help="Path of the Unix socket to listen on (defaults to ML_INFERENCE_SOCKET)",
+        )
+
+    def handle(self, *args, **options):
+        from myapp.ml_service import ml_service
+
+        ml_service.prepare()
+        if ml_service.model is None:
+            raise CommandError("Model could not be loaded; refusing to start the inference server")
+
+        server = InferenceServer(options["socket"], ml_service)
+        self.stdout.write(self.style.SUCCESS(f"Inference server listening on {options['socket']}"))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            self.stdout.write("Shutting down inference server")
+        finally:
+            server.server_close()
@@ -0,0 +1,53 @@
+import threading
+
+from django.core.management.base import BaseCommand
+
+from myapp.inference_server import get_predictor
+from myapp.jobs import JobWorker, purge_expired_jobs
+
+
+class Command(BaseCommand):
+    help = (
+        "Consume queued prediction jobs from the database (/predict-api/jobs). "
+        "Run several of these to scale out; set ML_JOB_INLINE_WORKER=0 so web "
+        "processes leave the queue to them"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=1, help="Jobs to run concurrently in this process")
+        parser.add_argument("--poll-interval", type=float, help="Seconds between polls of an empty queue")
+        parser.add_argument("--burst", action="store_true", help="Exit once the queue is empty")
+        parser.add_argument("--purge", action="store_true", help="Only purge expired jobs and exit")
+
+    def handle(self, *args, **options):
+        if options["purge"]:
+            deleted, requeued = purge_expired_jobs()
+            self.stdout.write(f"Deleted {deleted} expired job(s), requeued {requeued} stale job(s)")
+            return
+
+        predictor = get_predictor()
+        # Load and warm the model (or check the inference server) before taking jobs
+        if not predictor.prepare():
+            self.stderr.write(self.style.WARNING("Model is not ready; jobs will fail until it is"))
+
+        stop = threading.Event()
+        threads = [
+            threading.Thread(
+                target=JobWorker(predictor, options["poll_interval"]).run_forever,
+                kwargs={"stop_event": stop, "burst": options["burst"]},
+                name=f"prediction-jobs-{index}",
+            )
+            for index in range(max(1, options["threads"]))
+        ]
+        self.stdout.write(self.style.SUCCESS(f"Prediction worker started with {len(threads)} thread(s)"))
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=1)
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping prediction worker")
+            stop.set()
+            for thread in threads:
+                thread.join()
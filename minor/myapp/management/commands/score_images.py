@@ -0,0 +1,287 @@
+import csv
+import json
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from myapp.model_registry import RegistryError
+from myapp.preprocessing import decode_file, iter_images, new_batch
+
+FORMATS = ("csv", "jsonl", "parquet")
+BASE_FIELDS = ["path", "digest", "predicted_class", "confidence", "model_version", "model_tier", "error"]
+
+
+def iter_manifest(manifest):
+    """Paths from a manifest: one per line, or a CSV with a ``path`` column.
+
+    Relative paths are resolved against the manifest's directory.
+    """
+    base = os.path.dirname(os.path.abspath(manifest))
+    with open(manifest, newline="") as f:
+        first = f.readline()
+        f.seek(0)
+        if "path" in next(csv.reader([first]), []):
+            lines = (row["path"] for row in csv.DictReader(f))
+        else:
+            lines = (line.strip() for line in f)
+        for line in lines:
+            if line and not line.startswith("#"):
+                yield os.path.join(base, line)
+
+
+class RowWriter:
+    """Appends result rows to a CSV or JSONL file; the byte offset is the checkpoint"""
+
+    def __init__(self, path, fmt, fields):
+        self.path = path
+        self.fmt = fmt
+        self.fields = fields
+        self.rows = []
+        self.file = None
+
+    def open(self, state=None):
+        offset = (state or {}).get("bytes", 0)
+        self.file = open(self.path, "r+" if offset else "w", newline="", encoding="utf-8")
+        # Drop anything written after the last checkpoint
+        self.file.truncate(offset)
+        self.file.seek(offset)
+        if self.fmt == "csv":
+            self.csv = csv.DictWriter(self.file, fieldnames=self.fields, extrasaction="ignore")
+            if not offset:
+                self.csv.writeheader()
+
+    def write(self, row):
+        self.rows.append(row)
+
+    def flush(self):
+        for row in self.rows:
+            if self.fmt == "csv":
+                self.csv.writerow(row)
+            else:
+                self.file.write(json.dumps(row) + "\n")
+        self.rows = []
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return {"bytes": self.file.tell()}
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class ParquetPartWriter:
+    """Writes each checkpoint's rows as one ``part-NNNNN.parquet`` file in a directory"""
+
+    def __init__(self, path, fields):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise CommandError("Parquet output needs pyarrow (pip install pyarrow)")
+        self.path = path
+        self.fields = fields
+        self.rows = []
+        self.parts = 0
+
+    def open(self, state=None):
+        self.parts = (state or {}).get("parts", 0)
+        os.makedirs(self.path, exist_ok=True)
+        # Parts past the checkpoint belong to an interrupted run
+        for name in os.listdir(self.path):
+            if name.startswith("part-") and name.endswith(".parquet") and int(name[5:10]) >= self.parts:
+                os.remove(os.path.join(self.path, name))
+
+    def write(self, row):
+        self.rows.append(row)
+
+    def flush(self):
+        if self.rows:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pylist([{field: row.get(field) for field in self.fields} for row in self.rows])
+            part = os.path.join(self.path, f"part-{self.parts:05d}.parquet")
+            pq.write_table(table, part + ".tmp")
+            os.replace(part + ".tmp", part)
+            self.parts += 1
+            self.rows = []
+        return {"parts": self.parts}
+
+    def close(self):
+        pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Score a directory (or manifest) of images offline: decode in a process pool, "
+        "run batched inference and append results to CSV, JSONL or Parquet, resumably"
+    )
+
+    def add_arguments(self, parser):
+        source = parser.add_mutually_exclusive_group(required=True)
+        source.add_argument("--images", help="Directory of images (walked recursively)")
+        source.add_argument("--manifest", help="File listing image paths, one per line or a CSV with a 'path' column")
+        parser.add_argument("--output", required=True,
+                            help="Output file (csv/jsonl) or directory of part files (parquet)")
+        parser.add_argument("--format", choices=FORMATS, help="Output format (default: from --output's extension)")
+        parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) - 1),
+                            help="Decode processes (0 = decode in this process)")
+        parser.add_argument("--batch-size", type=int, default=getattr(settings, "ML_BATCH_MAX_SIZE", 8) * 4)
+        parser.add_argument("--checkpoint-every", type=int, default=1000,
+                            help="Flush results and record progress every N images")
+        parser.add_argument("--probabilities", action="store_true", help="Add one column per class probability")
+        parser.add_argument("--resume", action="store_true", help="Continue from the output's checkpoint")
+
+    def handle(self, *args, **options):
+        from myapp.ml_service import ml_service as service
+
+        fmt = options["format"] or os.path.splitext(options["output"])[1].lstrip(".").lower()
+        if fmt not in FORMATS:
+            raise CommandError(f"Cannot infer the output format from {options['output']}; pass --format")
+        checkpoint_path = options["output"].rstrip(os.sep) + ".checkpoint.json"
+
+        state = None
+        if options["resume"] and os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                state = json.load(f)
+            if state["format"] != fmt:
+                raise CommandError(f"Checkpoint was written for {state['format']} output, not {fmt}")
+        elif os.path.exists(options["output"]):
+            if options["resume"]:
+                raise CommandError(f"No checkpoint found for {options['output']}")
+            raise CommandError(f"{options['output']} already exists; pass --resume to continue it")
+
+        try:
+            service.resolve_model()
+        except (FileNotFoundError, RegistryError) as e:
+            raise CommandError(str(e))
+        if not service.ensure_loaded():
+            raise CommandError("Model could not be loaded")
+        # Pin one version for the whole run even if the registry changes meanwhile
+        bundle = service.bundle
+        if state and state.get("model_version") != bundle.version:
+            self.stderr.write(self.style.WARNING(
+                f"Resuming a run started with model {state.get('model_version')} using model {bundle.version}"
+            ))
+
+        fields = BASE_FIELDS + ([f"p_{name}" for name in service.class_names] if options["probabilities"] else [])
+        if fmt == "parquet":
+            writer = ParquetPartWriter(options["output"], fields)
+        else:
+            writer = RowWriter(options["output"], fmt, fields)
+        writer.open(state)
+
+        paths = iter_manifest(options["manifest"]) if options["manifest"] else iter_images(options["images"])
+        done = state["done"] if state else 0
+        for _ in zip(range(done), paths):
+            pass
+
+        self.service = service
+        self.bundle = bundle
+        self.writer = writer
+        self.options = options
+        self.fmt = fmt
+        self.checkpoint_path = checkpoint_path
+        self.done = done
+        self.errors = state.get("errors", 0) if state else 0
+        self.started = time.perf_counter()
+        self.since_checkpoint = 0
+        if done:
+            self.stderr.write(f"Resuming after {done} images")
+        try:
+            self.score(paths)
+        finally:
+            writer.close()
+
+        elapsed = time.perf_counter() - self.started
+        self.stdout.write(self.style.SUCCESS(
+            f"Scored {self.done} images ({self.errors} errors) into {options['output']} "
+            f"using model {bundle.version} in {elapsed:.1f}s"
+        ))
+
+    def score(self, paths):
+        """Decode ahead in the pool while the model runs, keeping a bounded window in flight"""
+        workers = max(0, self.options["workers"])
+        batch_size = max(1, self.options["batch_size"])
+        draft = getattr(settings, "ML_JPEG_DRAFT_DECODE", True)
+        # Decoded images waiting for the model are bounded by this window plus one batch
+        window = max(batch_size, workers) * 2
+
+        buffer = new_batch(batch_size)
+        pending = []  # (path, digest, buffer row or None, error) in input order
+        filled = 0
+
+        def take(path, decode):
+            nonlocal filled
+            try:
+                digest, image = decode()
+            except Exception as e:
+                pending.append((path, None, None, str(e) or e.__class__.__name__))
+            else:
+                buffer[filled] = image
+                pending.append((path, digest, filled, None))
+                filled += 1
+            if filled == batch_size:
+                self.run_batch(buffer, pending, filled)
+                pending.clear()
+                filled = 0
+
+        if workers:
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+                in_flight = deque()
+                for path in paths:
+                    in_flight.append((path, pool.submit(decode_file, path, draft)))
+                    if len(in_flight) >= window:
+                        path, future = in_flight.popleft()
+                        take(path, future.result)
+                while in_flight:
+                    path, future = in_flight.popleft()
+                    take(path, future.result)
+        else:
+            for path in paths:
+                take(path, lambda: decode_file(path, draft))
+
+        if pending:
+            self.run_batch(buffer, pending, filled)
+        if self.since_checkpoint or not os.path.exists(self.checkpoint_path):
+            self.checkpoint()
+
+    def run_batch(self, buffer, pending, filled):
+        """Run the decoded rows of ``buffer`` through the model and queue every pending row in order"""
+        outputs = self.service._run_batch(buffer[:filled], self.bundle) if filled else []
+        class_names = self.service.class_names
+        for path, digest, row_index, error in pending:
+            row = {"path": path, "digest": digest, "model_version": self.bundle.version, "error": error}
+            if row_index is None:
+                self.errors += 1
+            else:
+                probs, tier = outputs[row_index]
+                best = int(probs.argmax())
+                row.update(predicted_class=class_names[best], confidence=round(float(probs[best]), 6),
+                           model_tier=tier)
+                if self.options["probabilities"]:
+                    row.update({f"p_{name}": round(float(p), 6) for name, p in zip(class_names, probs)})
+            self.writer.write(row)
+
+        self.done += len(pending)
+        self.since_checkpoint += len(pending)
+        if self.since_checkpoint >= self.options["checkpoint_every"]:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """Flush written rows, then atomically record how many inputs they cover"""
+        state = self.writer.flush()
+        state.update(done=self.done, errors=self.errors, format=self.fmt, model_version=self.bundle.version)
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.checkpoint_path)
+        self.since_checkpoint = 0
+
+        elapsed = time.perf_counter() - self.started
+        self.stderr.write(f"{self.done} images scored ({self.errors} errors), {elapsed:.1f}s elapsed")
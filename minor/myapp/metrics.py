@@ -0,0 +1,411 @@
+# myapp/metrics.py
+"""
+Minimal metrics with Prometheus text exposition.
+
+Counters, gauges and histograms are updated in process memory. With several
+gunicorn workers a scrape reaches only one of them, so when ``ML_METRICS_DIR``
+is set every process also writes a snapshot of its metrics to
+``<ML_METRICS_DIR>/<pid>-<token>.json`` every ``ML_METRICS_FLUSH_INTERVAL``
+seconds (and at exit). ``/metrics`` then adds up the snapshots of all
+processes, so counters only ever grow no matter which worker answers.
+Snapshots of exited workers are kept for their counters and histograms;
+their gauges are dropped. gunicorn.conf.py points ``ML_METRICS_DIR`` at
+``cache/metrics`` and empties it when the server starts.
+"""
+import atexit
+import copy
+import json
+import os
+import secrets
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+# Default latency buckets in seconds, covering cache hits through slow CPU batches
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.registry = None
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        if self.registry is not None and self.registry._exporter_pid is None:
+            self.registry.start_exporter()
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    @classmethod
+    def from_snapshot(cls, name, snapshot):
+        """Rebuild a metric (with its samples) from ``snapshot()`` output"""
+        kwargs = {"buckets": snapshot["buckets"]} if cls is Histogram else {}
+        metric = cls(name, snapshot["documentation"], snapshot["labelnames"], **kwargs)
+        metric._values = {tuple(key): value for key, value in snapshot["samples"]}
+        return metric
+
+    def snapshot(self):
+        """JSON-serializable copy of this metric, for merging into another process's output"""
+        with self._lock:
+            samples = [[list(key), copy.deepcopy(value)] for key, value in self._values.items()]
+        return {
+            "kind": self.kind,
+            "documentation": self.documentation,
+            "labelnames": list(self.labelnames),
+            "samples": samples,
+        }
+
+    def render(self, remote=()):
+        """Exposition lines; ``remote`` is a list of (process, samples) from other processes"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_sample(key, value))
+        for process, samples in remote:
+            for key, value in samples:
+                lines.extend(self._render_sample(tuple(key), value, (("process", process),)))
+        return lines
+
+    def _render_sample(self, key, value, extra=()):
+        return [f"{self.name}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["counts"][i] += 1
+                    break
+            state["sum"] += value
+            state["count"] += 1
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        snapshot["buckets"] = list(self.buckets[:-1])
+        return snapshot
+
+    def _render_sample(self, key, state, extra=()):
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets, state["counts"]):
+            cumulative += count
+            labels = _format_labels(self.labelnames, key, tuple(extra) + (("le", _format_value(bound)),))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key, extra)
+        lines.append(f"{self.name}_sum{labels} {_format_value(state['sum'])}")
+        lines.append(f"{self.name}_count{labels} {state['count']}")
+        return lines
+
+
+_KINDS = {"counter": Counter, "gauge": Gauge, "histogram": Histogram}
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def merge_snapshots(into, snapshot, gauges=True):
+    """Add the samples of one process's ``snapshot()`` to ``into`` (modified in place)"""
+    for name, metric in snapshot.items():
+        if metric["kind"] not in _KINDS or (metric["kind"] == "gauge" and not gauges):
+            continue
+        target = into.setdefault(name, dict(metric, samples=[]))
+        samples = {tuple(key): value for key, value in target["samples"]}
+        for key, value in metric["samples"]:
+            key = tuple(key)
+            if key not in samples:
+                samples[key] = copy.deepcopy(value)
+            elif metric["kind"] == "histogram":
+                state = samples[key]
+                state["counts"] = [a + b for a, b in zip(state["counts"], value["counts"])]
+                state["sum"] += value["sum"]
+                state["count"] += value["count"]
+            else:
+                samples[key] += value
+        target["samples"] = [[list(key), value] for key, value in samples.items()]
+    return into
+
+
+class Registry:
+    """Holds this process's metrics and renders them in Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._exporter_pid = None
+        self._export_path = None
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # A forked worker counts from zero under its own snapshot file;
+        # otherwise everything the parent counted would be added twice
+        self._lock = threading.Lock()
+        for metric in self._metrics.values():
+            metric._reset()
+        self._exporter_pid = None
+        self._export_path = None
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            metric.registry = self
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def snapshot(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    def start_exporter(self):
+        """Start writing this process's snapshots to ``ML_METRICS_DIR`` (once per process)"""
+        with self._lock:
+            if self._exporter_pid is not None:
+                return
+            self._exporter_pid = os.getpid()
+            directory = getattr(settings, "ML_METRICS_DIR", "") if settings.configured else ""
+            if not directory:
+                return
+            os.makedirs(directory, exist_ok=True)
+            self._export_path = os.path.join(directory, f"{os.getpid()}-{secrets.token_hex(4)}.json")
+            path = self._export_path
+        interval = max(0.1, getattr(settings, "ML_METRICS_FLUSH_INTERVAL", 5.0))
+
+        def export_forever():
+            while True:
+                time.sleep(interval)
+                self.export(path)
+
+        threading.Thread(target=export_forever, name="metrics-export", daemon=True).start()
+        atexit.register(self.export, path)
+
+    def export(self, path):
+        """Atomically replace ``path`` with this process's current snapshot"""
+        if path != self._export_path:
+            # Registered by the process this one was forked from
+            return
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".metrics-")
+            with os.fdopen(fd, "w") as f:
+                json.dump({"pid": os.getpid(), "metrics": self.snapshot()}, f)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+
+    def collect(self):
+        """This process's snapshot plus those of every other process exporting to ``ML_METRICS_DIR``"""
+        if self._exporter_pid is None:
+            self.start_exporter()
+        merged = self.snapshot()
+        if self._export_path is None:
+            return merged
+        directory = os.path.dirname(self._export_path)
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if not name.endswith(".json") or path == self._export_path:
+                continue
+            try:
+                with open(path) as f:
+                    exported = json.load(f)
+            except (OSError, ValueError):
+                continue
+            merge_snapshots(merged, exported["metrics"], gauges=_process_alive(exported["pid"]))
+        return merged
+
+    def render(self, remote=None):
+        """Render all metrics, summed over the processes exporting to ``ML_METRICS_DIR``.
+
+        ``remote`` maps a process name to a ``snapshot()`` taken in another
+        process (e.g. the out-of-process inference server); its samples are
+        merged into the matching metric families with a ``process`` label.
+        """
+        remote = remote or {}
+        metrics = {
+            name: _KINDS[snapshot["kind"]].from_snapshot(name, snapshot)
+            for name, snapshot in self.collect().items()
+        }
+
+        for snapshots in remote.values():
+            for name, snapshot in snapshots.items():
+                if name not in metrics and snapshot["kind"] in _KINDS:
+                    metrics[name] = _KINDS[snapshot["kind"]].from_snapshot(name, dict(snapshot, samples=[]))
+
+        lines = []
+        for name, metric in metrics.items():
+            samples = [
+                (process, snapshots[name]["samples"])
+                for process, snapshots in remote.items()
+                if name in snapshots
+            ]
+            lines.extend(metric.render(samples))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "ml_stage_duration_seconds",
+    "Time spent in each stage of the prediction hot path",
+    ("stage",),
+)
+PREDICTIONS = REGISTRY.counter(
+    "ml_predictions_total",
+    "Predictions served, by outcome",
+    ("outcome",),
+)
+CACHE_LOOKUPS = REGISTRY.counter(
+    "ml_prediction_cache_lookups_total",
+    "Prediction cache lookups, by result",
+    ("result",),
+)
+CACHE_ENTRIES = REGISTRY.gauge(
+    "ml_prediction_cache_entries",
+    "Entries in this process's in-memory prediction cache",
+)
+BATCH_SIZE = REGISTRY.histogram(
+    "ml_forward_batch_size",
+    "Number of images per model forward pass",
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+ADMISSION_IN_FLIGHT = REGISTRY.gauge(
+    "ml_admission_in_flight",
+    "Predictions currently running in this process",
+)
+ADMISSION_QUEUE_DEPTH = REGISTRY.gauge(
+    "ml_admission_queue_depth",
+    "Predictions waiting for a free slot in this process",
+)
+ADMISSION_REJECTED = REGISTRY.counter(
+    "ml_admission_rejected_total",
+    "Predictions rejected with 429, by reason",
+    ("reason",),
+)
+ADMISSION_WAIT_SECONDS = REGISTRY.histogram(
+    "ml_admission_wait_seconds",
+    "Time admitted predictions spent waiting for a slot",
+)
+CASCADE_ANSWERS = REGISTRY.counter(
+    "ml_cascade_answers_total",
+    "Images answered by each tier of the inference cascade",
+    ("tier",),
+)
+SINGLEFLIGHT_CALLS = REGISTRY.counter(
+    "ml_singleflight_calls_total",
+    "Inferences by single-flight role: leader ran the model, shared reused a concurrent leader's result",
+    ("role",),
+)
+PREDICTION_JOBS = REGISTRY.counter(
+    "ml_prediction_jobs_total",
+    "Asynchronous prediction jobs, by event",
+    ("event",),
+)
+QUALITY_REJECTED = REGISTRY.counter(
+    "ml_quality_rejected_total",
+    "Uploads turned away by the image quality gate, by issue",
+    ("issue",),
+)
+TTA_IMAGES = REGISTRY.counter(
+    "ml_tta_images_total",
+    "Low-confidence images re-scored with test-time augmentation",
+)
+PREDICTION_LOG = REGISTRY.counter(
+    "ml_prediction_log_rows_total",
+    "Prediction history rows by write-behind event (queued, written, dropped, failed)",
+    ("event",),
+)
+
+
+@contextmanager
+def stage_timer(stage):
+    """Record the duration of a ``with`` block under ``ml_stage_duration_seconds{stage=...}``"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage)
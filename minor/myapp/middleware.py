@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.shortcuts import redirect
 from django.contrib.auth import logout
 from django.urls import reverse
@@ -7,6 +8,11 @@ import time
 class SessionTimeoutMiddleware:
     """
     Middleware to handle 30-minute session timeout
+
+    ``last_activity`` is only rewritten once it is more than
+    SESSION_ACTIVITY_UPDATE_INTERVAL seconds old, so a burst of requests
+    costs at most one session save instead of one per request. The timeout
+    still slides with activity, to within that interval.
     """
     def __init__(self, get_response):
         self.get_response = get_response
@@ -17,20 +23,21 @@ class SessionTimeoutMiddleware:
             # Get last activity time from session
             last_activity = request.session.get('last_activity')
             current_time = time.time()
+            timeout = getattr(settings, 'SESSION_IDLE_TIMEOUT', 1800)
             
             # If this is the first request, set last activity
             if last_activity is None:
                 request.session['last_activity'] = current_time
             else:
                 # Check if session has expired (30 minutes = 1800 seconds)
-                if current_time - last_activity > 1800:
+                if current_time - last_activity > timeout:
                     # Session expired, logout user
                     logout(request)
                     messages.warning(request, 'Your session has expired. Please log in again.')
                     # Redirect to login page
                     return redirect('login')
-                else:
-                    # Update last activity time
+                elif current_time - last_activity >= getattr(settings, 'SESSION_ACTIVITY_UPDATE_INTERVAL', 60):
+                    # Update last activity time (coalesced, see above)
                     request.session['last_activity'] = current_time
 
         response = self.get_response(request)
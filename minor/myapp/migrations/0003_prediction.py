@@ -0,0 +1,37 @@
+# Generated by Django 5.2.5 on 2026-10-18 07:22
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0002_prediction_job'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Prediction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField()),
+                ('image_digest', models.CharField(blank=True, max_length=64)),
+                ('predicted_class', models.CharField(max_length=50)),
+                ('confidence', models.FloatField()),
+                ('probabilities', models.JSONField(default=dict)),
+                ('stage_info', models.JSONField(blank=True, null=True)),
+                ('symptom_start_date', models.CharField(blank=True, max_length=20)),
+                ('model_version', models.CharField(blank=True, max_length=50)),
+                ('model_tier', models.CharField(blank=True, max_length=50)),
+                ('source', models.CharField(blank=True, max_length=10)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='predictions', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['user', '-created_at'], name='myapp_predi_user_id_33f63e_idx'), models.Index(fields=['predicted_class', 'created_at'], name='myapp_predi_predict_527fa4_idx'), models.Index(fields=['image_digest'], name='myapp_predi_image_d_de04fc_idx')],
+            },
+        ),
+    ]
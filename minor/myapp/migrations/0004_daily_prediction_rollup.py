@@ -0,0 +1,28 @@
+# Generated by Django 5.2.5 on 2026-10-18 07:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0003_prediction'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyPredictionRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('predicted_class', models.CharField(max_length=50)),
+                ('severity', models.CharField(blank=True, max_length=50)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('confidence_sum', models.FloatField(default=0.0)),
+            ],
+            options={
+                'ordering': ['date', 'predicted_class', 'severity'],
+                'constraints': [models.UniqueConstraint(fields=('date', 'predicted_class', 'severity'), name='unique_daily_rollup')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.5 on 2026-10-18 07:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0004_daily_prediction_rollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='prediction',
+            name='image_name',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='prediction',
+            name='result_id',
+            field=models.CharField(blank=True, db_index=True, max_length=16),
+        ),
+    ]
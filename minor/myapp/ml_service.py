@@ -1,17 +1,53 @@
 # myapp/ml_service.py
+import io
+import logging
 import os
-import torch
-import torch.nn as nn
-from torchvision import models, transforms
-from PIL import Image
+import threading
+import time
+from collections import namedtuple
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date
+from django.conf import settings
+from .admission import get_admission_controller
+from .batching import MicroBatcher
+from .metrics import BATCH_SIZE, CASCADE_ANSWERS, PREDICTIONS, QUALITY_REJECTED, TTA_IMAGES, stage_timer
+from .model_registry import get_registry
+from .prediction_cache import PredictionCache, image_digest, shared_cache
+from .preprocessing import TTA_VIEW_COUNT, decode_image, new_batch, normalize_into, resize, tta_views_into
+from .quality import ImageQualityError, assess_quality, retake_response
+from .singleflight import SingleFlight
+from .thread_planner import apply_affinity, current_plan, log_plan
+
+logger = logging.getLogger(__name__)
+
+# Everything that changes together when a new model version is swapped in;
+# requests read ``service.bundle`` once so a swap never mixes two versions
+ModelBundle = namedtuple("ModelBundle", "model backend device version first_stage")
+
+# Names reported in ``model_tier``: which model of the cascade answered
+FULL_TIER = "resnet50"
+TTA_SUFFIX = "+tta"
+
+
+def softmax(logits):
+    """Row-wise softmax of a (N, C) logits array"""
+    shifted = logits - logits.max(axis=1, keepdims=True)
+    exp = np.exp(shifted)
+    return exp / exp.sum(axis=1, keepdims=True)
+
 
 class MLModelService:
-    """Service class to handle ML model operations for Django integration"""
+    """Service class to handle ML model operations for Django integration.
+
+    Constructing the service is cheap: the model is loaded on the first
+    prediction, or explicitly with ``prepare()`` (gunicorn worker boot, the
+    inference server, or a ``/ready`` probe), so management commands and
+    migrations never import torch or read the weights.
+    """
 
     def __init__(self):
-        self.model = None
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.bundle = None
         self.class_names = [
             'Alopecia Areata',
             'Contact Dermatitis',
@@ -25,51 +61,309 @@ class MLModelService:
             'Telogen Effluvium',
             'Tinea Capitis'
         ]
-        self.transform = transforms.Compose([
-            transforms.Resize((224, 224)),
-            transforms.ToTensor(),
-            transforms.Normalize([0.485, 0.456, 0.406],
-                                 [0.229, 0.224, 0.225])
-        ])
-        self.load_model()
+        self.batcher = None
+        self.thread_plan = None
+        self.cache = self._build_cache()
+        self.inflight = SingleFlight()
+        self.warm = False
+        self._load_attempted = False
+        self._load_lock = threading.Lock()
+        self._prepare_thread = None
+        self._swap_lock = threading.Lock()
+        self._watcher_pid = None
+        self._preload_pid = None
+        if getattr(settings, 'ML_BATCHING_ENABLED', True):
+            self.batcher = MicroBatcher(
+                self._run_batch,
+                max_batch_size=getattr(settings, 'ML_BATCH_MAX_SIZE', 8),
+                max_wait_ms=getattr(settings, 'ML_BATCH_MAX_WAIT_MS', 5),
+                expected=self._admitted_predictions,
+            )
+
+    @property
+    def model(self):
+        return self.bundle.model if self.bundle else None
+
+    @property
+    def backend(self):
+        return self.bundle.backend if self.bundle else None
+
+    @property
+    def device(self):
+        return self.bundle.device if self.bundle else None
+
+    @property
+    def model_version(self):
+        return self.bundle.version if self.bundle else None
+
+    def _build_cache(self):
+        """Create the prediction cache, backed by the shared Django cache if there is one"""
+        return PredictionCache(
+            max_entries=getattr(settings, 'ML_PREDICTION_CACHE_SIZE', 1024),
+            ttl=getattr(settings, 'ML_PREDICTION_CACHE_TTL', 3600),
+            shared_cache=shared_cache(getattr(settings, 'ML_PREDICTION_CACHE_ALIAS', '')),
+        )
+
+    def cache_stats(self):
+        """Prediction cache hit/miss counters for this process"""
+        return self.cache.stats()
+
+    def resolve_model(self, version=None):
+        """(version, path) of the weights to load: ``version`` or the active one from
+        the model registry, else the unversioned best_model.pth as "default"
+        """
+        registry = get_registry()
+        if version is not None:
+            return version, registry.verify(version)
+        if registry.exists():
+            active, path = registry.active_path()
+            if active is not None:
+                return active, path
+        return "default", self.resolve_model_path()
+
+    def quantized_model_path(self, version):
+        """The calibrated int8 model for ``version``: next to its registry weights,
+        or ML_QUANTIZED_MODEL_PATH for the unversioned best_model.pth
+        """
+        if version == "default":
+            return getattr(settings, 'ML_QUANTIZED_MODEL_PATH', None)
+        return get_registry().quantized_path(version)
+
+    def resolve_model_path(self):
+        """Locate best_model.pth"""
+        # Use absolute path to the model in required_files folder
+        model_path = r"D:\disease prediction model\required_files\best_model.pth"
+        
+        # Fallback to relative path if absolute doesn't exist
+        if not os.path.exists(model_path):
+            model_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "best_model.pth")
+        
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"Model file not found at {model_path}")
+        return model_path
+
+    def configure_threads(self):
+        """Plan this worker's share of the CPUs and apply it (also called after gunicorn forks)"""
+        if not getattr(settings, 'ML_THREAD_PLANNER', True) or self._in_preload_parent():
+            return
+        plan = current_plan()
+        apply_affinity(plan)
+        log_plan(plan)
+        self.thread_plan = plan
+        if self.model is None:
+            return
+        if self.backend == 'onnx':
+            logger.info("ONNX Runtime session keeps the thread count it was created with")
+        else:
+            from .inference_backends import set_torch_threads
+            set_torch_threads(plan.intra_op, plan.inter_op)
+
+    def thread_counts(self):
+        """(intra-op, inter-op) threads for the model: the thread plan, else ML_TORCH_THREADS"""
+        if self.thread_plan is not None:
+            return self.thread_plan.intra_op, self.thread_plan.inter_op
+        return getattr(settings, 'ML_TORCH_THREADS', 0), 0
+
+    def ensure_loaded(self):
+        """Load the model on first use; returns whether a model is available"""
+        if not self._load_attempted:
+            with self._load_lock:
+                if not self._load_attempted:
+                    self.configure_threads()
+                    self.load_model()
+                    self._load_attempted = True
+        if self._watcher_pid != os.getpid() and self.model is not None and not self._in_preload_parent():
+            self.watch_registry()
+        return self.model is not None
+
+    def _in_preload_parent(self):
+        """Whether this is the gunicorn master that preloaded the model for its workers"""
+        return self._preload_pid == os.getpid()
+
+    def preload(self):
+        """Load the weights in the gunicorn master so the forked workers share them.
+
+        Only the weights: thread planning, warmup and the registry watcher set
+        up threads (and torch's OpenMP pool) that do not survive fork, so each
+        worker does those itself in ``prepare()``.
+        """
+        with self._load_lock:
+            self._preload_pid = os.getpid()
+            if not self._load_attempted:
+                self.load_model()
+                # A failed preload is retried by each worker
+                self._load_attempted = self.model is not None
+        return self.model is not None
+
+    def warmup(self, batch_sizes=None, iterations=None, model=None):
+        """Run dummy batches through the model so the first real request does not hit cold kernels"""
+        if model is None:
+            if not self.ensure_loaded():
+                return False
+            model = self.model
+        batch_sizes = batch_sizes or getattr(settings, 'ML_WARMUP_BATCH_SIZES', [1])
+        iterations = max(1, iterations or getattr(settings, 'ML_WARMUP_ITERATIONS', 2))
+        for batch_size in batch_sizes:
+            batch = new_batch(batch_size)
+            batch.fill(0.0)
+            started = time.perf_counter()
+            for _ in range(iterations):
+                model(batch)
+            logger.info("Warmup batch=%d: %.1f ms/pass", batch_size,
+                        1000 * (time.perf_counter() - started) / iterations)
+        if model is self.model:
+            self.warm = True
+        return True
+
+    def prepare(self):
+        """Load the model and, if ML_WARMUP_ENABLED, warm it up; returns readiness"""
+        if self._in_preload_parent():
+            # Warmup and the registry watcher start threads that do not
+            # survive fork; each worker prepares itself
+            return False
+        if not self.ensure_loaded():
+            return False
+        if getattr(settings, 'ML_WARMUP_ENABLED', True) and not self.warm:
+            try:
+                self.warmup()
+            except Exception:
+                logger.exception("Model warmup failed")
+        return self.readiness()["ready"]
+
+    def prepare_in_background(self):
+        """Start ``prepare()`` on a background thread unless it is already running"""
+        with self._load_lock:
+            if self._prepare_thread is None or not self._prepare_thread.is_alive():
+                self._prepare_thread = threading.Thread(target=self.prepare, name="ml-prepare", daemon=True)
+                self._prepare_thread.start()
+
+    def readiness(self):
+        """Model-loaded and warm state, for the /ready endpoint"""
+        loaded = self.model is not None
+        warm = self.warm or not getattr(settings, 'ML_WARMUP_ENABLED', True)
+        return {
+            "model_loaded": loaded,
+            "load_failed": self._load_attempted and not loaded,
+            "warm": self.warm,
+            "ready": loaded and warm,
+            "backend": self.backend,
+            "model_version": self.model_version,
+        }
+
+    def _load_bundle(self, version=None):
+        """Load a model with the configured inference backend, without touching the live one"""
+        backend = getattr(settings, 'ML_INFERENCE_BACKEND', 'eager')
+        intra_op, inter_op = self.thread_counts()
+        logger.info("Inference backend: %s", backend)
+        logger.info("Number of classes: %d (%s)", len(self.class_names), ", ".join(self.class_names))
+
+        if backend == "onnx":
+            # ONNX Runtime only: torch/torchvision are never imported
+            from .onnx_backend import OnnxModel
+            model_path = getattr(settings, 'ML_ONNX_MODEL_PATH', None)
+            logger.info("Loading ONNX model from: %s", model_path)
+            model = OnnxModel(
+                model_path,
+                intra_op_threads=getattr(settings, 'ML_ONNX_THREADS', 0) or intra_op,
+            )
+            version = "onnx"
+        else:
+            from .inference_backends import load_torch_model
+            version, model_path = self.resolve_model(version)
+            logger.info("Loading model %s from: %s", version, model_path)
+
+            # Load ResNet50 architecture and trained weights with strict=True
+            # (matching your test code), then apply the selected backend
+            model = load_torch_model(
+                model_path, len(self.class_names), backend,
+                mmap=getattr(settings, 'ML_MMAP_WEIGHTS', True),
+                quantized_model_path=self.quantized_model_path(version),
+                num_threads=intra_op,
+                interop_threads=inter_op,
+            )
+        first_stage = None
+        if getattr(settings, 'ML_CASCADE_ENABLED', False) and backend != "onnx":
+            first_stage = self._load_first_stage(model.device)
+        logger.info("Model %s loaded on %s, ready to predict %d classes", version, model.device, len(self.class_names))
+        return ModelBundle(model, backend, model.device, version, first_stage)
+
+    def _load_first_stage(self, device):
+        """The cascade's small first-stage model, or None if its weights are missing"""
+        from .inference_backends import load_first_stage_model
+        path = getattr(settings, 'ML_CASCADE_MODEL_PATH', None)
+        arch = getattr(settings, 'ML_CASCADE_ARCH', 'mobilenet_v3_small')
+        if not path or not os.path.exists(path):
+            logger.warning("No first-stage model at %s (run `manage.py distill_first_stage`); "
+                           "every image goes to ResNet50", path)
+            return None
+        logger.info("Loading %s first stage from: %s (threshold %.2f)", arch, path,
+                    getattr(settings, 'ML_CASCADE_THRESHOLD', 0.9))
+        return load_first_stage_model(path, len(self.class_names), arch, device)
 
     def load_model(self):
-        """Load the trained PyTorch model"""
+        """Load the trained model with the configured inference backend"""
         try:
-            # Use absolute path to the model in required_files folder
-            model_path = r"D:\disease prediction model\required_files\best_model.pth"
-            
-            # Fallback to relative path if absolute doesn't exist
-            if not os.path.exists(model_path):
-                model_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "best_model.pth")
-            
-            if not os.path.exists(model_path):
-                raise FileNotFoundError(f"Model file not found at {model_path}")
+            self.bundle = self._load_bundle()
+        except Exception:
+            logger.exception("Error loading model")
+            self.bundle = None
 
-            print(f"🖥️ Using device: {self.device}")
-            print(f"📂 Loading model from: {model_path}")
-            print(f"🔢 Number of classes: {len(self.class_names)}")
-            print(f"🏷️ Classes: {self.class_names}")
+    def swap_model(self, version=None):
+        """Load ``version`` (default: the registry's active one), warm it and swap it in.
 
-            # Load ResNet50 architecture (matching your test code)
-            model = models.resnet50(weights=None)
-            num_ftrs = model.fc.in_features
-            model.fc = nn.Linear(num_ftrs, len(self.class_names))
+        The live model keeps serving until the single assignment of
+        ``self.bundle``; requests already running hold the old bundle and
+        finish on it. Prediction cache keys include the version, so results
+        of the old model are never served for the new one.
+        """
+        with self._swap_lock:
+            bundle = self._load_bundle(version)
+            if getattr(settings, 'ML_WARMUP_ENABLED', True):
+                self.warmup(model=bundle.model)
+            previous, self.bundle = self.bundle, bundle
+            self.warm = True
+            self._load_attempted = True
+        logger.info("Swapped model %s -> %s", previous.version if previous else None, bundle.version)
+        return bundle.version
 
-            # Load trained weights with strict=True (matching your test code)
-            state_dict = torch.load(model_path, map_location=self.device)
-            model.load_state_dict(state_dict, strict=True)
+    def watch_registry(self):
+        """Hot-swap whenever the registry's active version changes (one thread per process)"""
+        interval = getattr(settings, 'ML_MODEL_WATCH_INTERVAL', 10)
+        if interval <= 0 or getattr(settings, 'ML_INFERENCE_BACKEND', 'eager') == 'onnx':
+            return
+        if self._in_preload_parent():
+            # A swap in the master would load and warm a model no worker uses
+            return
+        self._watcher_pid = os.getpid()
+        registry = get_registry()
 
-            self.model = model.to(self.device)
-            self.model.eval()
-            print(f"✅ PyTorch model loaded successfully on {self.device}")
-            print(f"✅ Model ready to predict {len(self.class_names)} classes including 'No Disease'")
+        def watch():
+            seen = registry.manifest_mtime()
+            while True:
+                time.sleep(interval)
+                mtime = registry.manifest_mtime()
+                if mtime == seen:
+                    continue
+                seen = mtime
+                try:
+                    active = registry.active_version()
+                    if active and active != self.model_version:
+                        self.swap_model(active)
+                except Exception:
+                    logger.exception("Model hot-swap failed; still serving %s", self.model_version)
 
-        except Exception as e:
-            print(f"❌ Error loading PyTorch model: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            self.model = None
+        threading.Thread(target=watch, name="ml-registry-watch", daemon=True).start()
+
+    def load_random_model(self):
+        """Use a randomly initialised ResNet50 (benchmarks without best_model.pth)"""
+        from .inference_backends import load_torch_model
+        backend = getattr(settings, 'ML_INFERENCE_BACKEND', 'eager')
+        if backend in ("onnx", "int8"):
+            backend = "eager"
+        logger.warning("Using a randomly initialised model (%s backend)", backend)
+        model = load_torch_model(None, len(self.class_names), backend)
+        self.bundle = ModelBundle(model, backend, model.device, "random", None)
+        self._load_attempted = True
 
     def calculate_disease_stage(self, predicted_class, confidence, symptom_start_date):
         """Calculate disease stage based on confidence, time elapsed, and disease-specific factors"""
@@ -123,7 +417,7 @@ class MLModelService:
             return stage_info
                 
         except Exception as e:
-            print(f"❌ Error calculating stage: {str(e)}")
+            logger.warning("Error calculating stage: %s", e)
             return {
                 "stage": "Unknown",
                 "stage_number": None,
@@ -247,63 +541,311 @@ class MLModelService:
             "confidence_level": confidence
         }
 
+    def read_image_bytes(self, image_file):
+        """Read an uploaded file (or a path) into bytes"""
+        if isinstance(image_file, (bytes, bytearray)):
+            return bytes(image_file)
+        if hasattr(image_file, 'read'):
+            if hasattr(image_file, 'seek'):
+                image_file.seek(0)
+            return image_file.read()
+        with open(image_file, 'rb') as f:
+            return f.read()
+
+    def preprocess(self, image_file, out=None, check_quality=False):
+        """Decode an uploaded image into a normalized (3, 224, 224) float32 array.
+
+        JPEGs are decoded at reduced size when ``ML_JPEG_DRAFT_DECODE`` is on;
+        ``out`` may be a row of a preallocated batch buffer. With
+        ``check_quality`` (and ``ML_QUALITY_GATE_ENABLED``) an unusable photo
+        raises ``ImageQualityError`` before any tensor work is done.
+        """
+        with stage_timer("decode"):
+            img, original_size = decode_image(image_file, draft=getattr(settings, 'ML_JPEG_DRAFT_DECODE', True))
+        logger.debug("Image loaded: %s (decoded at %s)", original_size, img.size)
+        if check_quality and getattr(settings, 'ML_QUALITY_GATE_ENABLED', True):
+            with stage_timer("quality"):
+                report = assess_quality(img, original_size)
+            if not report.ok:
+                for issue in report.issues:
+                    QUALITY_REJECTED.inc(issue=issue)
+                raise ImageQualityError(report)
+        with stage_timer("preprocess"):
+            if out is None:
+                out = new_batch(1)[0]
+            return normalize_into(resize(img), out)
+
+    def _run_batch(self, images, bundle=None):
+        """Run a list (or stacked array) of preprocessed images through the model(s).
+
+        Returns one ``(probs, tier)`` per image. With a first-stage model
+        loaded, every image goes through it and only those it is less than
+        ``ML_CASCADE_THRESHOLD`` confident about are escalated to ResNet50.
+        With ``ML_TTA_ENABLED``, images still below ``ML_TTA_THRESHOLD`` are
+        re-scored with test-time augmentation.
+        """
+        batch = images if isinstance(images, np.ndarray) else np.stack(images)
+        bundle = bundle or self.bundle
+        BATCH_SIZE.observe(len(batch))
+
+        if bundle.first_stage is None:
+            escalate = np.arange(len(batch))
+            probs = None
+        else:
+            with stage_timer("first_stage"):
+                probs = softmax(bundle.first_stage(batch))
+            escalate = np.flatnonzero(probs.max(axis=1) < getattr(settings, 'ML_CASCADE_THRESHOLD', 0.9))
+        tiers = [getattr(settings, 'ML_CASCADE_ARCH', 'first_stage')] * len(batch)
+
+        if len(escalate):
+            full_batch = batch if len(escalate) == len(batch) else batch[escalate]
+            with stage_timer("forward"):
+                logits = bundle.model(full_batch)
+            with stage_timer("softmax_topk"):
+                full_probs = softmax(logits)
+            if probs is None:
+                probs = full_probs
+            else:
+                probs[escalate] = full_probs
+            for index in escalate:
+                tiers[index] = FULL_TIER
+
+        for tier in tiers:
+            CASCADE_ANSWERS.inc(tier=tier)
+
+        if getattr(settings, 'ML_TTA_ENABLED', False):
+            uncertain = np.flatnonzero(probs.max(axis=1) < getattr(settings, 'ML_TTA_THRESHOLD', 0.70))
+            if len(uncertain):
+                self._test_time_augment(batch, probs, tiers, uncertain, bundle)
+        return list(zip(probs, tiers))
+
+    def _test_time_augment(self, batch, probs, tiers, indices, bundle):
+        """Average ResNet50 over flipped and cropped views of ``batch[indices]``.
+
+        ``probs`` and ``tiers`` are updated in place. Every view of every
+        uncertain image goes through the model as one stacked batch, so TTA
+        costs a single extra forward pass per batch.
+        """
+        with stage_timer("tta"):
+            views = new_batch(len(indices) * TTA_VIEW_COUNT)
+            for position, index in enumerate(indices):
+                tta_views_into(batch[index], views[position * TTA_VIEW_COUNT:(position + 1) * TTA_VIEW_COUNT])
+            BATCH_SIZE.observe(len(views))
+            view_probs = softmax(bundle.model(views)).reshape(len(indices), TTA_VIEW_COUNT, -1)
+
+        for position, index in enumerate(indices):
+            if tiers[index] == FULL_TIER:
+                probs[index] = (probs[index] + view_probs[position].sum(axis=0)) / (TTA_VIEW_COUNT + 1)
+            else:
+                # Only possible when ML_CASCADE_THRESHOLD is below ML_TTA_THRESHOLD
+                probs[index] = view_probs[position].mean(axis=0)
+            tiers[index] = FULL_TIER + TTA_SUFFIX
+        TTA_IMAGES.inc(len(indices))
+
+    @staticmethod
+    def _admitted_predictions():
+        """Predictions of this process holding an admission slot, None without admission control"""
+        controller = get_admission_controller()
+        return controller.in_flight if controller.enabled else None
+
+    def infer(self, image, bundle=None):
+        """Return ``(probs, tier)`` for one image, batched with concurrent callers of the same bundle"""
+        bundle = bundle or self.bundle
+        if self.batcher is not None:
+            return self.batcher.submit(image, bundle).result()
+        return self._run_batch([image], bundle)[0]
+
+    @staticmethod
+    def _cache_key(content_digest, bundle):
+        """Cache / single-flight key: the image digest scoped to the model version (and cascade)"""
+        scope = bundle.version
+        if bundle.first_stage is not None:
+            scope += f"+{getattr(settings, 'ML_CASCADE_ARCH', '')}@{getattr(settings, 'ML_CASCADE_THRESHOLD', 0.9)}"
+        if getattr(settings, 'ML_TTA_ENABLED', False):
+            scope += f"{TTA_SUFFIX}@{getattr(settings, 'ML_TTA_THRESHOLD', 0.70)}"
+        return f"{scope}:{content_digest}"
+
+    def _build_result(self, probs, symptom_start_date, model_version=None, model_tier=FULL_TIER,
+                      content_digest=None):
+        """Turn one softmax row into the prediction response dict"""
+        pred = int(np.argmax(probs))
+        predicted_class = self.class_names[pred]
+        confidence = float(probs[pred])
+
+        # Top 3 is only worth computing when someone is reading debug output
+        if logger.isEnabledFor(logging.DEBUG):
+            top3 = ", ".join(
+                f"{self.class_names[index]}={probs[index]:.3f}" for index in np.argsort(probs)[::-1][:3]
+            )
+            logger.debug("Prediction: %s (confidence %.3f); top 3: %s", predicted_class, confidence, top3)
+        
+        # Calculate disease stage
+        with stage_timer("staging"):
+            stage_info = self.calculate_disease_stage(predicted_class, confidence, symptom_start_date)
+        logger.debug("Disease stage: %s", stage_info.get("stage") if stage_info else None)
+
+        return {
+            "predicted_class": predicted_class,
+            "confidence": confidence,
+            "stage_info": stage_info,
+            "symptom_start_date": symptom_start_date,
+            "model_version": model_version,
+            "model_tier": model_tier,
+            "image_digest": content_digest,
+            "probabilities": {name: round(float(p), 6) for name, p in zip(self.class_names, probs)},
+            "success": True
+        }
+
     def predict(self, image_file, symptom_start_date=None):
         """Make prediction on uploaded image"""
-        if self.model is None:
+        if not self.ensure_loaded():
             return {"error": "Model not loaded", "success": False}
 
         try:
-            # Open and preprocess image
-            img = Image.open(image_file).convert("RGB")
-            print(f"📸 Image loaded: {img.size}")
-            
-            img_tensor = self.transform(img).unsqueeze(0).to(self.device)
-            print(f"🔄 Image tensor shape: {img_tensor.shape}")
+            # Identical uploads reuse the cached probability vector
+            bundle = self.bundle
+            version = bundle.version
+            data = self.read_image_bytes(image_file)
+            content_digest = image_digest(data)
+            digest = self._cache_key(content_digest, bundle)
+            cached = self.cache.get(digest)
 
-            # Inference
-            with torch.no_grad():
-                outputs = self.model(img_tensor)
-                probs = torch.nn.functional.softmax(outputs, dim=1)
-                conf, pred = torch.max(probs, 1)
-
-            predicted_class = self.class_names[pred.item()]
-            confidence = float(conf.item())
-            
-            print(f"🎯 Prediction: {predicted_class} (confidence: {confidence:.3f})")
-            
-            # Get top 3 predictions for debugging
-            top3_probs, top3_indices = torch.topk(probs, 3)
-            print("📊 Top 3 predictions:")
-            for i in range(3):
-                class_name = self.class_names[top3_indices[0][i].item()]
-                prob = top3_probs[0][i].item()
-                print(f"   {i+1}. {class_name}: {prob:.3f}")
-            
-            # Calculate disease stage
-            stage_info = self.calculate_disease_stage(predicted_class, confidence, symptom_start_date)
-            
-            if stage_info and stage_info.get("stage"):
-                print(f"📈 Disease stage: {stage_info['stage']} (Severity: {stage_info['severity']})")
-                print(f"📊 Stage details: {stage_info['clinical_notes']}")
+            if cached is not None:
+                logger.debug("Prediction cache hit: %s", digest[:12])
+                probs, tier = np.asarray(cached[0], dtype=np.float32), cached[1]
             else:
-                print(f"ℹ️ No stage calculation (predicted: {predicted_class})")
-
-            result = {
-                "predicted_class": predicted_class,
-                "confidence": confidence,
-                "stage_info": stage_info,
-                "symptom_start_date": symptom_start_date,
-                "success": True
-            }
-            
-            print(f"✅ Prediction successful")
+                # Concurrent uploads of the same image share a single inference
+                probs, tier = self.inflight.do(digest, lambda: self._compute_probs(data, digest, bundle))
+
+            # Staging depends on today's date, so it is never cached
+            result = self._build_result(probs, symptom_start_date, version, tier, content_digest)
+            PREDICTIONS.inc(outcome="success")
             return result
 
+        except ImageQualityError as e:
+            logger.info("Prediction skipped: %s", e)
+            PREDICTIONS.inc(outcome="retake")
+            return retake_response(e.report)
         except Exception as e:
-            print(f"❌ Error during prediction: {str(e)}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("Error during prediction")
+            PREDICTIONS.inc(outcome="error")
             return {"error": f"Prediction failed: {str(e)}", "success": False}
 
-# Global instance
+    def _compute_probs(self, data, digest, bundle):
+        """Preprocess and run one image on ``bundle``, remembering the result in the cache"""
+        # Open and preprocess image (unusable photos stop here)
+        image = self.preprocess(io.BytesIO(data), check_quality=True)
+
+        # Inference (shares a forward pass with any concurrent requests)
+        probs, tier = self.infer(image, bundle)
+        self.cache.set(digest, probs, tier)
+        return probs, tier
+
+    def predict_many(self, image_files, symptom_start_dates=None):
+        """Predict a list of images, returning results in input order.
+
+        Images are decoded in parallel and run through the model in chunks of
+        at most ``ML_BATCH_MAX_SIZE``. A file that fails to decode gets its own
+        error entry instead of failing the whole batch.
+        """
+        if not self.ensure_loaded():
+            return [{"error": "Model not loaded", "success": False} for _ in image_files]
+
+        # The whole upload runs on one model version even if a swap happens meanwhile
+        bundle = self.bundle
+        symptom_start_dates = list(symptom_start_dates or [])
+        symptom_start_dates += [None] * (len(image_files) - len(symptom_start_dates))
+        results = [None] * len(image_files)
+
+        # Every image is decoded straight into its row of one batch buffer, so
+        # the common all-miss case runs chunks as zero-copy slices of it
+        buffer = new_batch(len(image_files))
+        contents = [None] * len(image_files)
+
+        def decode(index):
+            try:
+                data = self.read_image_bytes(image_files[index])
+                contents[index] = image_digest(data)
+                digest = self._cache_key(contents[index], bundle)
+                cached = self.cache.get(digest)
+                if cached is not None:
+                    return digest, (np.asarray(cached[0], dtype=np.float32), cached[1]), None
+                self.preprocess(io.BytesIO(data), out=buffer[index], check_quality=True)
+                return digest, None, None
+            except ImageQualityError as e:
+                return None, None, e
+            except Exception as e:
+                logger.warning("Error decoding image %d of batch: %s", index, e)
+                return None, None, e
+
+        workers = max(1, min(len(image_files), getattr(settings, 'ML_DECODE_WORKERS', 4)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            decoded = list(pool.map(decode, range(len(image_files))))
+
+        # Images already being predicted (by another request, or earlier in
+        # this list) wait for that inference instead of running their own
+        ready = []
+        waiting = []
+        digests = {}
+        for index, (digest, cached, error) in enumerate(decoded):
+            if isinstance(error, ImageQualityError):
+                results[index] = retake_response(error.report)
+            elif error is not None:
+                results[index] = {"error": f"Prediction failed: {str(error)}", "success": False}
+            elif cached is not None:
+                results[index] = self._build_result(cached[0], symptom_start_dates[index], bundle.version, cached[1],
+                                                    contents[index])
+            else:
+                future, leader = self.inflight.begin(digest)
+                if leader:
+                    digests[index] = digest
+                    ready.append(index)
+                else:
+                    waiting.append((index, future))
+
+        unfinished = set(ready)
+        try:
+            chunk_size = getattr(settings, 'ML_BATCH_MAX_SIZE', 8)
+            for start in range(0, len(ready), chunk_size):
+                chunk = ready[start:start + chunk_size]
+                if chunk[-1] - chunk[0] == len(chunk) - 1:
+                    batch = buffer[chunk[0]:chunk[-1] + 1]
+                else:
+                    batch = buffer[chunk]
+                try:
+                    outputs = self._run_batch(batch, bundle)
+                except Exception as e:
+                    logger.exception("Error during batch prediction")
+                    for index in chunk:
+                        results[index] = {"error": f"Prediction failed: {str(e)}", "success": False}
+                        self.inflight.finish(digests[index], error=e)
+                        unfinished.discard(index)
+                    continue
+                for index, (probs, tier) in zip(chunk, outputs):
+                    self.cache.set(digests[index], probs, tier)
+                    self.inflight.finish(digests[index], (probs, tier))
+                    unfinished.discard(index)
+                    results[index] = self._build_result(probs, symptom_start_dates[index], bundle.version, tier,
+                                                        contents[index])
+        finally:
+            # Never leave other requests waiting on an inference that will not happen
+            for index in unfinished:
+                self.inflight.finish(digests[index], error=RuntimeError("Batch prediction aborted"))
+
+        for index, future in waiting:
+            try:
+                probs, tier = future.result()
+                results[index] = self._build_result(probs, symptom_start_dates[index], bundle.version, tier,
+                                                    contents[index])
+            except ImageQualityError as e:
+                results[index] = retake_response(e.report)
+            except Exception as e:
+                results[index] = {"error": f"Prediction failed: {str(e)}", "success": False}
+
+        for item in results:
+            PREDICTIONS.inc(outcome="success" if item.get("success") else "retake" if item.get("retake") else "error")
+        logger.debug("Batch prediction finished for %d images", len(image_files))
+        return results
+
+# Global instance (the model itself is loaded lazily, see ensure_loaded)
 ml_service = MLModelService()
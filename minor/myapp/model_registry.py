@@ -0,0 +1,198 @@
+# myapp/model_registry.py
+"""
+Versioned model weights on local disk.
+
+    <ML_MODEL_REGISTRY_DIR>/
+        manifest.json
+        v1/best_model.pth
+        v2/best_model.pth
+        v2/best_model_int8.pt      (optional, written by ``manage.py calibrate_model``)
+
+``manifest.json`` records every version's file, size, mtime and SHA-256 plus
+which version is active. Checksums are only recomputed when a file's size or
+mtime changes, so verifying the active version on boot is cheap. The manifest
+is rewritten atomically, and every read-modify-write of it (``add``,
+``activate`` and the stat refresh in ``verify``) holds an exclusive ``flock``
+on ``.manifest.lock`` so concurrent writers never drop each other's changes.
+Running workers watch its mtime and hot-swap to a newly activated version
+(see ``MLModelService.watch_registry``).
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.json"
+LOCK_NAME = ".manifest.lock"
+WEIGHTS_NAME = "best_model.pth"
+QUANTIZED_NAME = "best_model_int8.pt"
+
+
+class RegistryError(Exception):
+    pass
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ModelRegistry:
+    """Read and update the manifest of versioned model weights under ``root``"""
+
+    def __init__(self, root):
+        self.root = str(root)
+        self.manifest_path = os.path.join(self.root, MANIFEST_NAME)
+
+    def exists(self):
+        return os.path.exists(self.manifest_path)
+
+    def manifest_mtime(self):
+        try:
+            return os.stat(self.manifest_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def load(self):
+        if not self.exists():
+            return {"active": None, "versions": {}}
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def save(self, manifest):
+        os.makedirs(self.root, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".manifest-", suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    @contextmanager
+    def locked(self):
+        """Hold the manifest lock for a read-modify-write of the manifest"""
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, LOCK_NAME), "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def active_version(self):
+        return self.load().get("active")
+
+    def versions(self):
+        """(version, entry) pairs, oldest first"""
+        entries = self.load()["versions"]
+        return sorted(entries.items(), key=lambda item: item[1].get("added_at", ""))
+
+    def _next_version(self, manifest):
+        numbers = [int(match.group(1)) for name in manifest["versions"]
+                   for match in [re.fullmatch(r"v(\d+)", name)] if match]
+        return f"v{max(numbers, default=0) + 1}"
+
+    def add(self, source_path, version=None, notes="", activate=False):
+        """Copy ``source_path`` into the registry as a new version and return its name"""
+        if not os.path.exists(source_path):
+            raise RegistryError(f"Model file not found at {source_path}")
+        with self.locked():
+            return self._add(source_path, version, notes, activate)
+
+    def _add(self, source_path, version, notes, activate):
+        manifest = self.load()
+        version = version or self._next_version(manifest)
+        if version in manifest["versions"]:
+            raise RegistryError(f"Version {version} already exists")
+
+        relative = os.path.join(version, WEIGHTS_NAME)
+        target = os.path.join(self.root, relative)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copy2(source_path, target)
+
+        stat = os.stat(target)
+        manifest["versions"][version] = {
+            "file": relative,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": file_sha256(target),
+            "added_at": datetime.now(timezone.utc).isoformat(),
+            "notes": notes,
+        }
+        if activate or manifest.get("active") is None:
+            manifest["active"] = version
+        self.save(manifest)
+        return version
+
+    def activate(self, version):
+        with self.locked():
+            manifest = self.load()
+            self._check(version, manifest)
+            manifest["active"] = version
+            self.save(manifest)
+
+    def verify(self, version, manifest=None):
+        """Check ``version``'s file against its recorded checksum and return its path.
+
+        The SHA-256 is only recomputed when the file's size or mtime differs
+        from the manifest; a matching recompute refreshes the cached stat in a
+        freshly read manifest, under the manifest lock.
+        """
+        path, stale = self._check(version, manifest or self.load(), rehash=False)
+        if not stale:
+            return path
+        with self.locked():
+            manifest = self.load()
+            path, refreshed = self._check(version, manifest)
+            if refreshed:
+                self.save(manifest)
+        return path
+
+    def _check(self, version, manifest, rehash=True):
+        """(path, changed) for ``version``; with ``rehash`` a changed stat is re-hashed and updated in ``manifest``"""
+        entry = manifest["versions"].get(version)
+        if entry is None:
+            raise RegistryError(f"Unknown model version {version}")
+        path = os.path.join(self.root, entry["file"])
+        try:
+            stat = os.stat(path)
+        except OSError:
+            raise RegistryError(f"Model file for {version} is missing: {path}")
+
+        if stat.st_size == entry["size"] and stat.st_mtime_ns == entry["mtime_ns"]:
+            return path, False
+        if not rehash:
+            return path, True
+        if stat.st_size != entry["size"] or file_sha256(path) != entry["sha256"]:
+            raise RegistryError(f"Checksum mismatch for model version {version}: {path}")
+        entry["mtime_ns"] = stat.st_mtime_ns
+        return path, True
+
+    def quantized_path(self, version):
+        """Where ``version``'s calibrated int8 model lives (it need not exist)"""
+        return os.path.join(self.root, version, QUANTIZED_NAME)
+
+    def active_path(self):
+        """(version, path) of the active version, or (None, None) without a registry"""
+        manifest = self.load()
+        version = manifest.get("active")
+        if version is None:
+            return None, None
+        return version, self.verify(version, manifest)
+
+
+def get_registry():
+    return ModelRegistry(getattr(settings, "ML_MODEL_REGISTRY_DIR", os.path.join(settings.BASE_DIR.parent, "models")))
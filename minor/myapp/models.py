@@ -1,3 +1,6 @@
+import uuid
+
+from django.conf import settings
 from django.db import models
 
 class User(models.Model):
@@ -7,3 +10,96 @@ class User(models.Model):
 
     def __str__(self):
         return self.username
+
+
+class PredictionJob(models.Model):
+    """An uploaded image waiting for (or holding the result of) an asynchronous prediction"""
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.CASCADE,
+                             related_name='prediction_jobs')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    image = models.BinaryField(blank=True)  # cleared once the job has run
+    filename = models.CharField(max_length=255, blank=True)
+    symptom_start_date = models.CharField(max_length=20, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    expires_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+            models.Index(fields=['expires_at']),
+        ]
+
+    def __str__(self):
+        return f'{self.id} ({self.status})'
+
+    @property
+    def finished(self):
+        return self.status in (self.DONE, self.FAILED)
+
+
+class Prediction(models.Model):
+    """One served prediction, written in bulk by the write-behind logger (see ``myapp.prediction_log``)"""
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL,
+                             related_name='predictions')
+    created_at = models.DateTimeField()  # when the prediction was served, not when the row was written
+    image_digest = models.CharField(max_length=64, blank=True)
+    predicted_class = models.CharField(max_length=50)
+    confidence = models.FloatField()
+    probabilities = models.JSONField(default=dict)
+    stage_info = models.JSONField(null=True, blank=True)
+    symptom_start_date = models.CharField(max_length=20, blank=True)
+    model_version = models.CharField(max_length=50, blank=True)
+    model_tier = models.CharField(max_length=50, blank=True)
+    source = models.CharField(max_length=10, blank=True)  # endpoint that served it: api, async, batch, job
+    result_id = models.CharField(max_length=16, blank=True, db_index=True)  # short id returned to the client
+    image_name = models.CharField(max_length=64, blank=True)  # stored upload, see myapp.uploads
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at']),
+            models.Index(fields=['predicted_class', 'created_at']),
+            models.Index(fields=['image_digest']),
+        ]
+
+    def __str__(self):
+        return f'{self.predicted_class} ({self.confidence:.2f}) at {self.created_at}'
+
+
+class DailyPredictionRollup(models.Model):
+    """Per-day prediction counts by class and severity, kept current as predictions are written"""
+
+    date = models.DateField()
+    predicted_class = models.CharField(max_length=50)
+    severity = models.CharField(max_length=50, blank=True)
+    count = models.PositiveIntegerField(default=0)
+    confidence_sum = models.FloatField(default=0.0)  # mean confidence = confidence_sum / count
+
+    class Meta:
+        ordering = ['date', 'predicted_class', 'severity']
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'predicted_class', 'severity'], name='unique_daily_rollup'),
+        ]
+
+    def __str__(self):
+        return f'{self.date} {self.predicted_class} / {self.severity or "-"}: {self.count}'
@@ -0,0 +1,41 @@
+# myapp/onnx_backend.py
+"""
+ONNX Runtime inference backend.
+
+Deliberately free of torch/torchvision imports: a worker configured with
+``ML_INFERENCE_BACKEND = 'onnx'`` only loads NumPy and onnxruntime, which
+keeps start-up time and resident memory well below the torch stack.
+"""
+import os
+
+import numpy as np
+
+
+class OnnxModel:
+    """Callable wrapper around an ONNX Runtime CPU session"""
+
+    def __init__(self, model_path, intra_op_threads=0):
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError(
+                "The 'onnx' inference backend requires onnxruntime (pip install onnxruntime)"
+            ) from e
+
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(
+                f"ONNX model not found at {model_path} (run `manage.py export_onnx` first)"
+            )
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads:
+            options.intra_op_num_threads = intra_op_threads
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_name = self.session.get_outputs()[0].name
+        self.device = "cpu"
+
+    def __call__(self, batch):
+        batch = np.ascontiguousarray(batch, dtype=np.float32)
+        return self.session.run([self.output_name], {self.input_name: batch})[0]
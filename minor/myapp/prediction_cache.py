@@ -0,0 +1,131 @@
+# myapp/prediction_cache.py
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+from .metrics import CACHE_ENTRIES, CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+
+def shared_cache(alias):
+    """The Django cache ``alias`` if all worker processes see the same one, else None.
+
+    LocMem caches live inside one process (and the dummy cache stores
+    nothing), so data written there by one worker is invisible to the rest.
+    """
+    if not alias:
+        return None
+    try:
+        cache = caches[alias]
+    except Exception as e:
+        logger.warning("Cache alias '%s' unavailable: %s", alias, e)
+        return None
+    if isinstance(cache, (LocMemCache, DummyCache)):
+        return None
+    return cache
+
+
+def image_digest(data):
+    """Content hash used as the cache key for uploaded image bytes"""
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+class PredictionCache:
+    """LRU cache from image digest to the raw probability vector and the
+    model tier that produced it.
+
+    Entries live in a per-process ``OrderedDict`` bounded by ``max_entries``
+    and expire after ``ttl`` seconds. When ``shared_cache`` (a Django cache
+    backend such as the file-based or Redis one) is given, misses fall
+    through to it and stores are written to both, so every gunicorn worker
+    benefits from a prediction made by any of them.
+    """
+
+    key_prefix = "mlpred:"
+
+    def __init__(self, max_entries=1024, ttl=3600, shared_cache=None):
+        self.max_entries = max(0, int(max_entries))
+        self.ttl = float(ttl)
+        self.shared_cache = shared_cache
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, digest):
+        """Return the cached ``(probs, tier)`` for ``digest`` or None"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                expires_at, probs = entry
+                if expires_at > now:
+                    self._entries.move_to_end(digest)
+                    self.hits += 1
+                    CACHE_LOOKUPS.inc(result="hit")
+                    return probs
+                del self._entries[digest]
+
+        probs = None
+        if self.shared_cache is not None:
+            try:
+                probs = self.shared_cache.get(self.key_prefix + digest)
+            except Exception as e:
+                logger.warning("Shared prediction cache unavailable: %s", e)
+            if probs is not None:
+                probs = tuple(probs)
+
+        with self._lock:
+            if probs is None:
+                self.misses += 1
+                CACHE_LOOKUPS.inc(result="miss")
+                return None
+            self.hits += 1
+            CACHE_LOOKUPS.inc(result="shared_hit")
+            self._store_local(digest, probs, now)
+        return probs
+
+    def set(self, digest, probs, tier=None):
+        """Remember ``probs`` (a sequence of floats) and the answering ``tier`` for ``digest``"""
+        probs = ([float(p) for p in probs], tier)
+        with self._lock:
+            self._store_local(digest, probs, time.monotonic())
+        if self.shared_cache is not None:
+            try:
+                self.shared_cache.set(self.key_prefix + digest, probs, timeout=self.ttl)
+            except Exception as e:
+                logger.warning("Shared prediction cache unavailable: %s", e)
+
+    def _store_local(self, digest, probs, now):
+        if self.max_entries == 0:
+            return
+        self._entries[digest] = (now + self.ttl, probs)
+        self._entries.move_to_end(digest)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        CACHE_ENTRIES.set(len(self._entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Hit/miss counters for this worker process"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "shared": self.shared_cache is not None,
+            }
@@ -0,0 +1,222 @@
+# myapp/prediction_log.py
+"""
+Write-behind logging of served predictions to the ``Prediction`` table.
+
+``record_prediction`` only builds an unsaved row and puts it on an in-memory
+queue, so prediction requests never wait on the database. A daemon thread in
+each process drains the queue and writes rows with ``bulk_create`` in batches
+of up to ``ML_PREDICTION_LOG_BATCH_SIZE``, at least every
+``ML_PREDICTION_LOG_FLUSH_INTERVAL`` seconds. When the queue is full (the
+database is down or far behind) new rows are dropped and counted rather than
+slowing requests down. Remaining rows are flushed at interpreter exit.
+Each batch also updates the daily rollups (see ``myapp.analytics``).
+
+The writer thread also stores each row in the shared ``ML_RESULT_CACHE_ALIAS``
+cache under its ``result_id`` before inserting it, so ``find_result`` can
+resolve the id even if the insert later fails (or logging is off). A result
+is only given a ``result_id`` when there is such a cache and its row was
+queued; the request itself never touches the cache. The same entries record
+which user each stored upload belongs to (see ``owns_upload``).
+"""
+import atexit
+import logging
+import os
+import queue
+import secrets
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .analytics import invalidate_caches, update_rollups
+from .metrics import PREDICTION_LOG
+from .models import Prediction
+from .prediction_cache import shared_cache
+
+logger = logging.getLogger(__name__)
+
+
+class PredictionLogWriter:
+    """Bounded queue of unsaved ``Prediction`` rows plus the thread that bulk-inserts them"""
+
+    def __init__(self, batch_size=None, flush_interval=None, max_queue=None):
+        self.batch_size = max(1, batch_size or getattr(settings, "ML_PREDICTION_LOG_BATCH_SIZE", 100))
+        self.flush_interval = flush_interval or getattr(settings, "ML_PREDICTION_LOG_FLUSH_INTERVAL", 1.0)
+        self.queue = queue.Queue(maxsize=max_queue or getattr(settings, "ML_PREDICTION_LOG_QUEUE_SIZE", 10000))
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def put(self, row):
+        """Queue ``row`` without blocking; returns False if it was dropped"""
+        self._ensure_thread()
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            PREDICTION_LOG.inc(event="dropped")
+            return False
+        PREDICTION_LOG.inc(event="queued")
+        return True
+
+    def _ensure_thread(self):
+        """Start the writer thread on first use, and again in a forked child"""
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            if self._pid != os.getpid():
+                # Rows queued before a fork belong to the parent
+                self.queue = queue.Queue(maxsize=self.queue.maxsize)
+            self._thread = threading.Thread(target=self._run, name="prediction-log", daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def _drain(self, first=None):
+        rows = [] if first is None else [first]
+        while len(rows) < self.batch_size:
+            try:
+                rows.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return rows
+
+    def _write(self, rows):
+        if not rows:
+            return
+        cache_results(rows)
+        if not getattr(settings, "ML_PREDICTION_LOG_ENABLED", True):
+            return
+        with self._write_lock:
+            try:
+                with transaction.atomic():
+                    Prediction.objects.bulk_create(rows, batch_size=self.batch_size)
+                    update_rollups(rows)
+            except Exception:
+                logger.exception("Could not write %d prediction log row(s)", len(rows))
+                PREDICTION_LOG.inc(len(rows), event="failed")
+                close_old_connections()
+                return
+        invalidate_caches(rows)
+        PREDICTION_LOG.inc(len(rows), event="written")
+
+    def _run(self):
+        while True:
+            try:
+                first = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                close_old_connections()
+                continue
+            # Give a burst a moment to accumulate into one INSERT
+            if self.queue.qsize() < self.batch_size:
+                time.sleep(min(0.05, self.flush_interval))
+            self._write(self._drain(first))
+
+    def flush(self):
+        """Write everything queued so far from the calling thread"""
+        if self._pid != os.getpid():
+            return
+        while True:
+            rows = self._drain()
+            if not rows:
+                return
+            self._write(rows)
+
+
+_writer = PredictionLogWriter()
+atexit.register(_writer.flush)
+
+
+def get_prediction_log():
+    return _writer
+
+
+def new_result_id():
+    """Short, URL-safe, unguessable id for one prediction result"""
+    return secrets.token_urlsafe(9)
+
+
+def _result_cache():
+    return shared_cache(getattr(settings, "ML_RESULT_CACHE_ALIAS", "results"))
+
+
+def cache_results(rows):
+    """Store rows and their uploads' owners in the result cache (runs on the writer thread)"""
+    entries = {f"result:{row.result_id}": row for row in rows if row.result_id}
+    entries.update((_upload_key(row.user_id, row.image_name), True) for row in rows if row.image_name)
+    cache = _result_cache()
+    if not entries or cache is None:
+        return
+    try:
+        cache.set_many(entries, getattr(settings, "ML_RESULT_CACHE_TTL", 86400))
+    except Exception as e:
+        logger.warning("Could not cache %d prediction result(s): %s", len(entries), e)
+
+
+def find_result(result_id, user_id):
+    """The ``Prediction`` with ``result_id`` if it belongs to ``user_id``: cached, else from the table"""
+    cache = _result_cache()
+    row = None
+    if cache is not None:
+        try:
+            row = cache.get(f"result:{result_id}")
+        except Exception as e:
+            logger.warning("Could not read cached prediction result: %s", e)
+    if row is None:
+        return Prediction.objects.filter(result_id=result_id, user_id=user_id).first()
+    return row if row.user_id == user_id else None
+
+
+def _upload_key(user_id, name):
+    # Originals and thumbnails share the 40-character digest prefix
+    return f"upload:{user_id}:{name[:40]}"
+
+
+def owns_upload(user_id, name):
+    """Whether one of ``user_id``'s predictions stored the upload ``name`` (or its original)"""
+    cache = _result_cache()
+    if cache is not None:
+        try:
+            if cache.get(_upload_key(user_id, name)):
+                return True
+        except Exception as e:
+            logger.warning("Could not read cached upload owner: %s", e)
+    return Prediction.objects.filter(user_id=user_id, image_name__startswith=name[:40]).exists()
+
+
+def record_prediction(result, user=None, source="", user_id=None):
+    """Give a successful prediction result dict its ``result_id`` and queue it for the ``Prediction`` table.
+
+    Non-blocking: the row is only put on the writer's queue. The id is left
+    out when there is no shared result cache or the queue dropped the row,
+    since it could not be resolved then.
+    """
+    if not result.get("success"):
+        return False
+    if user is not None and user.is_authenticated:
+        user_id = user.pk
+    row = Prediction(
+        user_id=user_id,
+        created_at=timezone.now(),
+        image_digest=result.get("image_digest") or "",
+        predicted_class=result["predicted_class"],
+        confidence=result["confidence"],
+        probabilities=result.get("probabilities") or {},
+        stage_info=result.get("stage_info"),
+        symptom_start_date=result.get("symptom_start_date") or "",
+        model_version=result.get("model_version") or "",
+        model_tier=result.get("model_tier") or "",
+        source=source,
+        result_id=new_result_id() if _result_cache() is not None else "",
+        image_name=result.get("image_name") or "",
+    )
+    if not (row.result_id or getattr(settings, "ML_PREDICTION_LOG_ENABLED", True)):
+        return False
+    if not _writer.put(row):
+        return False
+    if row.result_id:
+        result["result_id"] = row.result_id
+    return True
@@ -0,0 +1,155 @@
+# myapp/preprocessing.py
+"""
+Image decode and preprocessing for the scalp classifier.
+
+Equivalent to ``Resize((224, 224)) -> ToTensor() -> Normalize(mean, std)`` but
+cheaper on large phone photos:
+
+* JPEGs are decoded with PIL's draft mode, letting libjpeg scale by 1/2, 1/4
+  or 1/8 during decoding so a 12MP capture never materialises at full size.
+* ``ToTensor`` and ``Normalize`` are fused into one per-channel lookup table
+  that maps uint8 pixels straight to normalized float32 values, written into
+  a caller-provided (optionally preallocated) CHW buffer.
+* Test-time augmentation views (flips and crops) are derived from the already
+  normalized array, so they never touch PIL again.
+"""
+import io
+import os
+
+import numpy as np
+from PIL import Image
+
+from .prediction_cache import image_digest
+
+# ImageNet normalization used when the model was trained
+IMAGE_SIZE = (224, 224)
+IMAGE_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+IMAGE_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+# File types picked up when scanning a directory of images
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".webp"}
+
+# _NORMALIZE_LUT[c][v] == (v / 255 - mean[c]) / std[c]
+_NORMALIZE_LUT = (
+    (np.arange(256, dtype=np.float32)[None, :] / np.float32(255.0) - IMAGE_MEAN[:, None])
+    / IMAGE_STD[:, None]
+).astype(np.float32)
+
+
+def decode_image(image_file, size=IMAGE_SIZE, draft=True):
+    """Open an image and return it as an RGB PIL image plus its original size.
+
+    With ``draft`` enabled, JPEGs are decoded at the smallest DCT scale that is
+    still at least ``size``; other formats are decoded normally.
+    """
+    img = Image.open(image_file)
+    original_size = img.size
+    if draft and img.format == "JPEG":
+        img.draft("RGB", size)
+    return img.convert("RGB"), original_size
+
+
+def resize(img, size=IMAGE_SIZE):
+    """Resize with the same filter torchvision's ``Resize`` uses for PIL images"""
+    if img.size == size:
+        return img
+    return img.resize(size, Image.BILINEAR)
+
+
+def normalize_into(img, out):
+    """Write the normalized CHW float32 version of a uint8 RGB image into ``out``"""
+    pixels = np.asarray(img, dtype=np.uint8)
+    for channel in range(3):
+        np.take(_NORMALIZE_LUT[channel], pixels[:, :, channel], out=out[channel])
+    return out
+
+
+def new_batch(count, size=IMAGE_SIZE):
+    """Allocate an uninitialised (count, 3, H, W) float32 batch buffer"""
+    return np.empty((count, 3, size[1], size[0]), dtype=np.float32)
+
+
+def preprocess_image(image_file, out=None, size=IMAGE_SIZE, draft=True):
+    """Decode, resize and normalize one image into ``out`` (allocated if None)"""
+    img, _ = decode_image(image_file, size=size, draft=draft)
+    if out is None:
+        out = np.empty((3, size[1], size[0]), dtype=np.float32)
+    return normalize_into(resize(img, size), out)
+
+
+def preprocess_batch(image_files, out=None, size=IMAGE_SIZE, draft=True):
+    """Preprocess several images into one contiguous (N, 3, H, W) batch"""
+    if out is None:
+        out = new_batch(len(image_files), size)
+    for index, image_file in enumerate(image_files):
+        preprocess_image(image_file, out=out[index], size=size, draft=draft)
+    return out
+
+
+def _resample_indices(start, length, size):
+    """Neighbour indices and weights for bilinearly stretching ``length`` samples to ``size``"""
+    coords = start + (np.arange(size, dtype=np.float32) + 0.5) * (length / size) - 0.5
+    coords = np.clip(coords, start, start + length - 1)
+    low = np.floor(coords).astype(np.intp)
+    high = np.minimum(low + 1, start + length - 1)
+    return low, high, (coords - low).astype(np.float32)
+
+
+def crop_resize_into(image, top, left, height, width, out):
+    """Bilinearly stretch a crop of a (3, H, W) array back to (3, H, W) in ``out``"""
+    _, size_h, size_w = image.shape
+    row_low, row_high, row_weight = _resample_indices(top, height, size_h)
+    col_low, col_high, col_weight = _resample_indices(left, width, size_w)
+    rows = image[:, row_low] * (1 - row_weight)[:, None] + image[:, row_high] * row_weight[:, None]
+    np.multiply(rows[:, :, col_low], 1 - col_weight, out=out)
+    out += rows[:, :, col_high] * col_weight
+    return out
+
+
+# Flips plus the four corner crops and the centre crop
+TTA_VIEW_COUNT = 7
+
+
+def tta_views_into(image, out, crop_scale=0.875):
+    """Write the test-time augmentation views of one normalized (3, H, W) image into ``out``.
+
+    ``out`` is a (TTA_VIEW_COUNT, 3, H, W) slice of a batch buffer. Bilinear
+    resampling is linear, so cropping the normalized array equals normalizing
+    the cropped image.
+    """
+    _, size_h, size_w = image.shape
+    crop_h, crop_w = int(round(size_h * crop_scale)), int(round(size_w * crop_scale))
+    out[0] = image[:, :, ::-1]
+    out[1] = image[:, ::-1, :]
+    offsets = [
+        (0, 0), (0, size_w - crop_w), (size_h - crop_h, 0), (size_h - crop_h, size_w - crop_w),
+        ((size_h - crop_h) // 2, (size_w - crop_w) // 2),
+    ]
+    for view, (top, left) in enumerate(offsets, start=2):
+        crop_resize_into(image, top, left, crop_h, crop_w, out[view])
+    return out
+
+
+def iter_images(directory):
+    """Image files under ``directory`` in a stable order, without listing the whole tree up front"""
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                yield os.path.join(root, name)
+
+
+def list_images(directory):
+    """All image files under ``directory`` in a stable order"""
+    return list(iter_images(directory))
+
+
+def decode_file(path, draft=True):
+    """Read, hash and preprocess one image file; returns ``(digest, CHW array)``.
+
+    Lives here rather than in a management command so process-pool workers
+    can unpickle it without importing torch.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    return image_digest(data), preprocess_image(io.BytesIO(data), draft=draft)
@@ -0,0 +1,124 @@
+# myapp/quality.py
+"""
+Server-side image quality gate.
+
+``camera_capture.html`` checks alignment in the browser, but uploads from
+``predict.html`` reach the model as they are. Blurred, black or blown-out
+photos still cost a full forward pass and produce a confident-looking but
+meaningless answer. ``assess_quality`` measures the image on a small
+grayscale copy (a few milliseconds even for phone photos) and
+``MLModelService`` asks the user to retake the photo instead of running the
+model when it fails.
+
+Measurements:
+
+* blur: variance of the 4-neighbour Laplacian (low = few sharp edges)
+* exposure: mean brightness plus the share of nearly black / nearly white pixels
+* resolution: the shorter side of the original upload
+"""
+from collections import namedtuple
+
+import numpy as np
+from django.conf import settings
+from PIL import Image
+
+# Side of the square-ish copy the checks run on; big enough for the Laplacian
+# to see hair-scale edges, small enough to keep the gate cheap
+ANALYSIS_SIZE = 256
+
+QualityReport = namedtuple("QualityReport", "ok issues metrics")
+
+
+class ImageQualityError(Exception):
+    """Raised instead of running the model on an image that failed the quality gate"""
+
+    def __init__(self, report):
+        super().__init__("Image quality too low: " + ", ".join(report.issues))
+        self.report = report
+
+
+# Issue code -> what the user should do about it
+RETAKE_ADVICE = {
+    "too_small": "Use a higher-resolution photo.",
+    "blurry": "Hold the camera steady and make sure the scalp is in focus.",
+    "too_dark": "Take the photo in better light.",
+    "too_bright": "Avoid direct light or flash glare on the scalp.",
+}
+
+
+def _thresholds():
+    return {
+        "min_side": getattr(settings, "ML_QUALITY_MIN_SIDE", 224),
+        "min_sharpness": getattr(settings, "ML_QUALITY_MIN_SHARPNESS", 20.0),
+        "min_brightness": getattr(settings, "ML_QUALITY_MIN_BRIGHTNESS", 40.0),
+        "max_brightness": getattr(settings, "ML_QUALITY_MAX_BRIGHTNESS", 225.0),
+        "max_clipped": getattr(settings, "ML_QUALITY_MAX_CLIPPED", 0.5),
+    }
+
+
+def grayscale_copy(img, size=ANALYSIS_SIZE):
+    """Float32 luminance of ``img`` scaled so its longer side is at most ``size``"""
+    gray = img.convert("L")
+    if max(gray.size) > size:
+        gray = gray.copy()
+        gray.thumbnail((size, size), Image.BILINEAR)
+    return np.asarray(gray, dtype=np.float32)
+
+
+def laplacian_variance(gray):
+    """Variance of the 4-neighbour Laplacian of a 2-D array"""
+    if gray.shape[0] < 3 or gray.shape[1] < 3:
+        return 0.0
+    centre = gray[1:-1, 1:-1]
+    laplacian = (
+        gray[:-2, 1:-1] + gray[2:, 1:-1] + gray[1:-1, :-2] + gray[1:-1, 2:] - 4.0 * centre
+    )
+    return float(laplacian.var())
+
+
+def assess_quality(img, original_size=None):
+    """Measure a decoded RGB image and return a ``QualityReport``.
+
+    ``original_size`` is the upload's size before any draft-mode decoding;
+    it defaults to ``img.size``.
+    """
+    limits = _thresholds()
+    width, height = original_size or img.size
+    gray = grayscale_copy(img)
+
+    brightness = float(gray.mean())
+    dark = float(np.count_nonzero(gray < 16)) / gray.size
+    bright = float(np.count_nonzero(gray > 240)) / gray.size
+    metrics = {
+        "width": width,
+        "height": height,
+        "sharpness": round(laplacian_variance(gray), 2),
+        "brightness": round(brightness, 2),
+        "dark_fraction": round(dark, 4),
+        "bright_fraction": round(bright, 4),
+    }
+
+    issues = []
+    if min(width, height) < limits["min_side"]:
+        issues.append("too_small")
+    if brightness < limits["min_brightness"] or dark > limits["max_clipped"]:
+        issues.append("too_dark")
+    elif brightness > limits["max_brightness"] or bright > limits["max_clipped"]:
+        issues.append("too_bright")
+    # A black or washed-out frame has no edges either; report the exposure only
+    exposed = "too_dark" not in issues and "too_bright" not in issues
+    if exposed and metrics["sharpness"] < limits["min_sharpness"]:
+        issues.append("blurry")
+    return QualityReport(not issues, issues, metrics)
+
+
+def retake_response(report):
+    """Prediction-shaped payload asking the user for a better photo"""
+    return {
+        "error": "Image quality too low for a reliable prediction. Please retake the photo.",
+        "success": False,
+        "retake": True,
+        "quality_issues": report.issues,
+        "advice": [RETAKE_ADVICE[issue] for issue in report.issues],
+        "quality_metrics": report.metrics,
+    }
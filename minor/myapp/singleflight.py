@@ -0,0 +1,59 @@
+# myapp/singleflight.py
+"""
+Collapse concurrent identical work into one call.
+
+Double-clicks and client retries often post the same image several times
+within milliseconds; before the first copy has finished (and filled the
+prediction cache) every copy would run its own forward pass. ``SingleFlight``
+lets the first caller for a key do the work while later callers for the same
+key wait for, and share, its result.
+"""
+import threading
+from concurrent.futures import Future
+
+from .metrics import SINGLEFLIGHT_CALLS
+
+
+class SingleFlight:
+    """Per-key deduplication of in-flight calls"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def begin(self, key):
+        """Return ``(future, leader)``; the leader must call ``finish(key, ...)`` exactly once"""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                SINGLEFLIGHT_CALLS.inc(role="shared")
+                return future, False
+            future = self._calls[key] = Future()
+        SINGLEFLIGHT_CALLS.inc(role="leader")
+        return future, True
+
+    def finish(self, key, result=None, error=None):
+        """Publish the leader's result (or exception) to every waiter"""
+        with self._lock:
+            future = self._calls.pop(key)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key, fn):
+        """Run ``fn()`` unless a call for ``key`` is already in flight, and return the shared result"""
+        future, leader = self.begin(key)
+        if not leader:
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            self.finish(key, error=e)
+            raise
+        self.finish(key, result)
+        return result
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
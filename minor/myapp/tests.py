@@ -1,3 +1,1037 @@
-from django.test import TestCase
+import asyncio
+import io
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from importlib import import_module
+from importlib.util import find_spec
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
+from PIL import Image, ImageFilter
+
+from .admission import AdmissionController, Overloaded
+from . import thread_planner
+from . import views
+from . import jobs
+from . import middleware
+from .analytics import decode_cursor, encode_cursor, history_page, update_rollups
+from .batching import MicroBatcher
+from .inference_server import InferenceClient, InferenceServer
+from .middleware import SessionTimeoutMiddleware
+from .model_registry import ModelRegistry, RegistryError
+from .ml_service import MLModelService, ModelBundle
+from .models import DailyPredictionRollup, Prediction, PredictionJob
+from .prediction_cache import PredictionCache, image_digest, shared_cache
+from . import prediction_log
+from .prediction_log import PredictionLogWriter, find_result, record_prediction
+from .preprocessing import IMAGE_MEAN, IMAGE_SIZE, IMAGE_STD, TTA_VIEW_COUNT, new_batch, preprocess_image
+from .quality import RETAKE_ADVICE, assess_quality, retake_response
+from .singleflight import SingleFlight
+from .uploads import store_upload, thumbnail_name
+
+
+class MicroBatcherTests(TestCase):
+    """Batches close on size or deadline and every Future is resolved"""
+
+    def setUp(self):
+        self.batches = []
+        self.error = None
+
+    def run_batch(self, items, context=None):
+        self.batches.append(list(items))
+        if self.error is not None:
+            raise self.error
+        return [item * 10 for item in items]
+
+    def test_full_batch_runs_without_waiting_for_deadline(self):
+        batcher = MicroBatcher(self.run_batch, max_batch_size=4, max_wait_ms=10000)
+        started = time.monotonic()
+        futures = [batcher.submit(item) for item in range(4)]
+        self.assertEqual([future.result(timeout=5) for future in futures], [0, 10, 20, 30])
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(self.batches, [[0, 1, 2, 3]])
+
+    def test_batches_are_capped_at_max_size(self):
+        gate = threading.Event()
+
+        def run_batch(items, context=None):
+            gate.wait(5)
+            return self.run_batch(items)
+
+        batcher = MicroBatcher(run_batch, max_batch_size=2, max_wait_ms=50)
+        futures = [batcher.submit(item) for item in range(5)]
+        gate.set()
+        self.assertEqual([future.result(timeout=5) for future in futures], [0, 10, 20, 30, 40])
+        self.assertTrue(all(len(batch) <= 2 for batch in self.batches))
+        self.assertEqual(sum(self.batches, []), [0, 1, 2, 3, 4])
+
+    def test_partial_batch_flushes_on_deadline(self):
+        batcher = MicroBatcher(self.run_batch, max_batch_size=8, max_wait_ms=50)
+        started = time.monotonic()
+        future = batcher.submit(7)
+        self.assertEqual(future.result(timeout=5), 70)
+        self.assertGreaterEqual(time.monotonic() - started, 0.045)
+        self.assertEqual(self.batches, [[7]])
+
+    def test_batch_runs_once_every_admitted_item_is_pending(self):
+        admitted = [1]
+        batcher = MicroBatcher(self.run_batch, max_batch_size=8, max_wait_ms=10000, expected=lambda: admitted[0])
+        started = time.monotonic()
+        self.assertEqual(batcher.submit(7).result(timeout=5), 70)
+        admitted[0] = 3
+        with batcher._cond:
+            futures = [batcher.submit(item) for item in range(3)]
+        self.assertEqual([future.result(timeout=5) for future in futures], [0, 10, 20])
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(self.batches, [[7], [0, 1, 2]])
+
+    def test_exception_reaches_every_future_in_the_batch(self):
+        self.error = RuntimeError("forward pass failed")
+        batcher = MicroBatcher(self.run_batch, max_batch_size=3, max_wait_ms=10000)
+        futures = [batcher.submit(item) for item in range(3)]
+        for future in futures:
+            with self.assertRaisesMessage(RuntimeError, "forward pass failed"):
+                future.result(timeout=5)
+
+        # The worker thread survives a failed batch
+        self.error = None
+        futures = [batcher.submit(item) for item in range(3)]
+        self.assertEqual([future.result(timeout=5) for future in futures], [0, 10, 20])
+
+    def test_items_of_different_contexts_are_never_batched_together(self):
+        contexts = []
+
+        def run_batch(items, context=None):
+            contexts.append(context)
+            return self.run_batch(items)
+
+        old, new = object(), object()
+        batcher = MicroBatcher(run_batch, max_batch_size=4, max_wait_ms=50)
+        futures = [batcher.submit(item, context) for item, context in [(1, old), (2, new), (3, old), (4, new)]]
+        self.assertEqual([future.result(timeout=5) for future in futures], [10, 20, 30, 40])
+        self.assertEqual(self.batches, [[1, 3], [2, 4]])
+        self.assertEqual(contexts, [old, new])
+
+    def test_worker_thread_is_restarted_after_fork(self):
+        batcher = MicroBatcher(self.run_batch, max_batch_size=1, max_wait_ms=0)
+        self.assertEqual(batcher.submit(1).result(timeout=5), 10)
+        parent_thread = batcher._thread
+        child_pid = batcher._pid + 1
+
+        # A forked child inherits the batcher but not its thread
+        with mock.patch("myapp.batching.os.getpid", return_value=child_pid):
+            self.assertEqual(batcher.submit(2).result(timeout=5), 20)
+        self.assertIsNot(batcher._thread, parent_thread)
+        self.assertEqual(batcher._pid, child_pid)
+
+
+class AdmissionControllerTests(TestCase):
+    """Queue places and running slots, per process and through a lock directory"""
+
+    def setUp(self):
+        lock_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(lock_dir.cleanup)
+        self.lock_dir = lock_dir.name
+
+    def controllers(self, **kwargs):
+        """One per-process controller and one sharing the lock directory"""
+        kwargs.setdefault("queue_timeout", 0.05)
+        return [
+            AdmissionController(**kwargs),
+            AdmissionController(lock_dir=self.lock_dir, **kwargs),
+        ]
+
+    def test_full_queue_is_rejected_without_waiting(self):
+        for controller in self.controllers(max_in_flight=1, max_queue=1):
+            with self.subTest(shared=controller.shared):
+                running, queued = controller.reserve(), controller.reserve()
+                running.wait()
+                with self.assertRaises(Overloaded) as caught:
+                    controller.reserve()
+                self.assertEqual(caught.exception.reason, "queue full")
+                running.release()
+                queued.release()
+
+    def test_queue_timeout_is_rejected(self):
+        for controller in self.controllers(max_in_flight=1, max_queue=1):
+            with self.subTest(shared=controller.shared):
+                running, queued = controller.reserve(), controller.reserve()
+                running.wait()
+                with self.assertRaises(Overloaded) as caught:
+                    queued.wait()
+                self.assertEqual(caught.exception.reason, "queue timeout")
+                queued.release()
+                running.release()
+                self.assertEqual(controller.stats()["in_flight"], 0)
+                self.assertEqual(controller.stats()["queued"], 0)
+
+    def test_release_frees_the_slot_for_the_next_request(self):
+        for controller in self.controllers(max_in_flight=1, max_queue=0):
+            with self.subTest(shared=controller.shared):
+                with controller.admit():
+                    self.assertEqual(controller.stats()["in_flight"], 1)
+                    with self.assertRaises(Overloaded):
+                        controller.reserve()
+                with controller.admit():
+                    pass
+                # Releasing twice does not free somebody else's slot
+                ticket = controller.reserve()
+                ticket.release()
+                ticket.release()
+                self.assertEqual(controller.stats()["in_flight"], 0)
+
+    def test_controllers_sharing_a_lock_dir_share_one_limit(self):
+        first = AdmissionController(1, max_queue=0, queue_timeout=0.05, lock_dir=self.lock_dir)
+        second = AdmissionController(1, max_queue=0, queue_timeout=0.05, lock_dir=self.lock_dir)
+        with first.admit():
+            with self.assertRaises(Overloaded):
+                second.reserve()
+        with second.admit():
+            pass
+
+    def test_running_returns_the_slot_between_passes(self):
+        for controller in self.controllers(max_in_flight=1, max_queue=1, queue_timeout=5):
+            with self.subTest(shared=controller.shared):
+                batch = controller.reserve()
+                with batch.running():
+                    self.assertEqual(controller.stats()["in_flight"], 1)
+                # Between passes the batch keeps its queue place but not its slot
+                self.assertEqual(controller.stats(), dict(controller.stats(), in_flight=0, queued=1))
+                with controller.admit():
+                    pass
+                with batch.running():
+                    pass
+                batch.release()
+                self.assertEqual(controller.stats()["queued"], 0)
+
+    def test_disabled_controller_admits_everything(self):
+        controller = AdmissionController(0)
+        tickets = [controller.reserve() for _ in range(10)]
+        for ticket in tickets:
+            with ticket.running():
+                pass
+            ticket.release()
+        self.assertFalse(controller.enabled)
+
+
+class ThreadPlannerTests(TestCase):
+    """Workers get disjoint CPU shares planned from the unpinned mask"""
+
+    def setUp(self):
+        patcher = mock.patch.object(thread_planner, "_unpinned_cpus", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_pinned_shares_do_not_overlap(self):
+        shares = [thread_planner.plan_threads(4, index, pin=True, cpus=range(8)).cpus for index in range(4)]
+        self.assertEqual(shares, [[0, 1], [2, 3], [4, 5], [6, 7]])
+
+    def test_replanning_after_pinning_uses_the_unpinned_mask(self):
+        mask = set(range(8))
+        with mock.patch("os.sched_getaffinity", side_effect=lambda pid: set(mask)), \
+                mock.patch("os.sched_setaffinity", side_effect=lambda pid, cpus: mask.__init__(cpus)):
+            thread_planner.apply_affinity(thread_planner.plan_threads(4, 0, pin=True))
+            self.assertEqual(mask, {0, 1})
+            # Planned again (or inherited by a fork) the share is still worker 3's
+            plan = thread_planner.plan_threads(4, 3, pin=True)
+        self.assertEqual(plan.cpus, [6, 7])
+        self.assertEqual(plan.usable_cpus, 8)
+
+
+class ModelRegistryVerifyTests(TestCase):
+    """verify() trusts an unchanged stat and re-hashes anything else"""
+
+    def setUp(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        source = os.path.join(root.name, "weights.pth")
+        with open(source, "wb") as f:
+            f.write(b"weights-v1")
+        self.registry = ModelRegistry(os.path.join(root.name, "registry"))
+        self.version = self.registry.add(source)
+        self.path = os.path.join(self.registry.root, self.registry.load()["versions"][self.version]["file"])
+
+    def touch(self):
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    def test_unchanged_file_is_returned(self):
+        self.assertEqual(self.registry.verify(self.version), self.path)
+
+    def test_unknown_version_and_missing_file_are_rejected(self):
+        with self.assertRaisesMessage(RegistryError, "Unknown model version v9"):
+            self.registry.verify("v9")
+        os.remove(self.path)
+        with self.assertRaisesMessage(RegistryError, "is missing"):
+            self.registry.verify(self.version)
+
+    def test_touched_file_with_same_content_refreshes_the_stat(self):
+        self.touch()
+        self.assertEqual(self.registry.verify(self.version), self.path)
+        entry = self.registry.load()["versions"][self.version]
+        self.assertEqual(entry["mtime_ns"], os.stat(self.path).st_mtime_ns)
+
+    def test_modified_content_is_a_checksum_mismatch(self):
+        with open(self.path, "wb") as f:
+            f.write(b"weights-v2")  # same size
+        self.touch()
+        with self.assertRaisesMessage(RegistryError, "Checksum mismatch"):
+            self.registry.verify(self.version)
+
+    def test_resized_file_is_a_checksum_mismatch(self):
+        with open(self.path, "ab") as f:
+            f.write(b"!")
+        with self.assertRaisesMessage(RegistryError, "Checksum mismatch"):
+            self.registry.verify(self.version)
+
+
+    def test_stat_refresh_waits_for_the_lock_and_keeps_a_concurrent_activation(self):
+        stale = self.registry.load()
+        source = os.path.join(os.path.dirname(self.registry.root), "weights.pth")
+        other = self.registry.add(source, activate=True)
+        self.touch()
+        done = threading.Event()
+        with self.registry.locked():
+            threading.Thread(target=lambda: (self.registry.verify(self.version, stale), done.set())).start()
+            self.assertFalse(done.wait(0.2))
+        self.assertTrue(done.wait(5))
+        manifest = self.registry.load()
+        self.assertEqual(manifest["active"], other)
+        self.assertEqual(manifest["versions"][self.version]["mtime_ns"], os.stat(self.path).st_mtime_ns)
+
+    def test_each_version_has_its_own_int8_model(self):
+        service = MLModelService.__new__(MLModelService)
+        with override_settings(ML_MODEL_REGISTRY_DIR=self.registry.root, ML_QUANTIZED_MODEL_PATH="/srv/int8.pt"):
+            self.assertEqual(service.quantized_model_path("default"), "/srv/int8.pt")
+            self.assertEqual(service.quantized_model_path(self.version),
+                             os.path.join(os.path.dirname(self.path), "best_model_int8.pt"))
+            self.assertNotEqual(service.quantized_model_path("v1"), service.quantized_model_path("v2"))
+
+@override_settings(ML_JOB_INLINE_WORKER=False)
+class JobWorkerTests(TestCase):
+    """Queued jobs are claimed in batches and run through predict_many"""
+
+    def setUp(self):
+        self.calls = []
+        for target in ("attach_upload", "record_prediction"):
+            patcher = mock.patch.object(jobs, target, side_effect=lambda result, *args, **kwargs: result)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(jobs, "get_admission_controller", return_value=AdmissionController(0))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def predict_many(self, images, dates=None):
+        self.calls.append(list(images))
+        return [{"predicted_class": image.decode(), "success": True} for image in images]
+
+    def submit(self, count):
+        return [jobs.submit_job(None, f"image-{index}".encode()) for index in range(count)]
+
+    def test_queued_jobs_run_as_one_batch(self):
+        submitted = self.submit(3)
+        worker = jobs.JobWorker(mock.Mock(predict_many=self.predict_many), batch_size=8)
+        self.assertTrue(worker.run_once())
+        self.assertEqual(self.calls, [[b"image-0", b"image-1", b"image-2"]])
+        for job in submitted:
+            job.refresh_from_db()
+            self.assertEqual(job.status, PredictionJob.DONE)
+            self.assertEqual(job.image, b"")
+        self.assertFalse(worker.run_once())
+
+    def test_batches_are_capped_at_batch_size(self):
+        self.submit(5)
+        worker = jobs.JobWorker(mock.Mock(predict_many=self.predict_many), batch_size=2)
+        while worker.run_once():
+            pass
+        self.assertEqual([len(call) for call in self.calls], [2, 2, 1])
+
+    def test_overloaded_batch_is_requeued_without_using_an_attempt(self):
+        submitted = self.submit(2)
+        controller = mock.Mock()
+        controller.reserve.side_effect = Overloaded("queue full", 1)
+        worker = jobs.JobWorker(mock.Mock(predict_many=self.predict_many))
+        jobs.get_admission_controller.return_value = controller
+        with self.assertRaises(Overloaded):
+            worker.run_once()
+        for job in submitted:
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts), (PredictionJob.QUEUED, 0))
+
+    def test_submit_wakes_the_worker_on_commit(self):
+        jobs._job_queued.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.submit(1)
+            self.assertFalse(jobs._job_queued.is_set())
+        self.assertTrue(jobs._job_queued.is_set())
+
+    def test_status_poll_waits_no_longer_than_the_cap(self):
+        user = User.objects.create_user("poller", password="secret")
+        job = jobs.submit_job(user, b"image")
+        self.client.force_login(user)
+        started = time.monotonic()
+        with override_settings(ML_JOB_LONG_POLL_MAX=0.2, ML_JOB_POLL_INTERVAL=0.05):
+            response = self.client.get(f"/predict-api/jobs/{job.id}", {"wait": 25})
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(response.json()["status"], PredictionJob.QUEUED)
+
+    def test_long_poll_wakes_when_this_process_finishes_a_job(self):
+        async def wait():
+            threading.Timer(0.05, jobs._notify_finished).start()
+            started = time.monotonic()
+            await jobs.wait_for_finished_jobs(5)
+            return time.monotonic() - started
+
+        self.assertLess(asyncio.run(wait()), 2)
+
+
+def thread_free_writer(**kwargs):
+    """A PredictionLogWriter without its background thread; tests call ``flush()`` themselves"""
+    writer = PredictionLogWriter(**kwargs)
+    writer._ensure_thread = lambda: None
+    writer._pid = os.getpid()
+    return writer
+
+
+class ResultIdTests(TestCase):
+    """A returned result_id resolves once the writer has run, and none is returned if it could not"""
+
+    def setUp(self):
+        location = tempfile.TemporaryDirectory()
+        self.addCleanup(location.cleanup)
+        caches = {
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+            "results": {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": location.name},
+        }
+        override = override_settings(CACHES=caches, ML_RESULT_CACHE_ALIAS="results", ML_PREDICTION_LOG_ENABLED=False)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.writer = thread_free_writer(max_queue=2)
+        patcher = mock.patch.object(prediction_log, "_writer", self.writer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def result(self):
+        return {"success": True, "predicted_class": "Psoriasis", "confidence": 91.5, "image_digest": "ab" * 20}
+
+    def test_recording_never_touches_the_cache(self):
+        result = self.result()
+        with mock.patch("django.core.cache.backends.filebased.FileBasedCache.set", side_effect=AssertionError):
+            self.assertTrue(record_prediction(result, user_id=7, source="api"))
+        self.assertIn("result_id", result)
+
+    def test_result_resolves_without_any_row_written(self):
+        result = self.result()
+        record_prediction(result, user_id=7, source="api")
+        self.writer.flush()
+        self.assertEqual(Prediction.objects.count(), 0)
+        found = find_result(result["result_id"], 7)
+        self.assertEqual((found.predicted_class, found.confidence), ("Psoriasis", 91.5))
+
+    def test_result_of_another_user_is_not_found(self):
+        result = self.result()
+        record_prediction(result, user_id=7)
+        self.writer.flush()
+        self.assertIsNone(find_result(result["result_id"], 8))
+
+    def test_written_rows_are_found_after_the_cache_entry_is_gone(self):
+        Prediction.objects.create(
+            user_id=None, created_at=timezone.now(), result_id="stored", predicted_class="Psoriasis", confidence=90.0,
+        )
+        self.assertEqual(find_result("stored", None).predicted_class, "Psoriasis")
+
+    def test_no_result_id_without_a_shared_cache(self):
+        for alias in ("default", "missing"):
+            with self.subTest(alias=alias), override_settings(ML_RESULT_CACHE_ALIAS=alias):
+                result = self.result()
+                record_prediction(result, user_id=7)
+                self.assertNotIn("result_id", result)
+
+    def test_no_result_id_when_the_row_is_dropped(self):
+        results = [self.result() for _ in range(3)]
+        for result in results:
+            record_prediction(result, user_id=7)
+        self.assertEqual(["result_id" in result for result in results], [True, True, False])
+
+
+@override_settings(ML_ANALYTICS_CACHE_ALIAS="default")
+class AnalyticsTests(TestCase):
+    """Keyset history pages, daily rollups and the analytics endpoints (uncached: 'default' is LocMem)"""
+
+    def setUp(self):
+        self.user = User.objects.create_user("history", password="secret")
+
+    def predict(self, created_at, predicted_class="Psoriasis", confidence=80.0, severity="mild"):
+        return Prediction.objects.create(
+            user=self.user, created_at=created_at, predicted_class=predicted_class,
+            confidence=confidence, stage_info={"severity": severity},
+        )
+
+    def test_cursor_round_trip(self):
+        created_at = timezone.now().replace(microsecond=123456)
+        cursor = encode_cursor({"created_at": created_at, "id": 42})
+        self.assertEqual(decode_cursor(cursor), (created_at, 42))
+
+    def test_pages_break_ties_on_equal_created_at_by_id(self):
+        same = timezone.now().replace(microsecond=0)
+        rows = [self.predict(same) for _ in range(3)] + [self.predict(same - timedelta(seconds=1))]
+        seen, cursor = [], None
+        while True:
+            page = history_page(self.user.pk, cursor=cursor, limit=1)
+            seen += [item["id"] for item in page["results"]]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+        self.assertEqual(seen, [rows[2].pk, rows[1].pk, rows[0].pk, rows[3].pk])
+
+    def test_malformed_cursor_is_rejected(self):
+        for cursor in ("not base64!", encode_cursor({"created_at": timezone.now(), "id": 1})[:-6], "bm9waXBl"):
+            with self.subTest(cursor=cursor), self.assertRaisesMessage(ValueError, "Invalid cursor"):
+                decode_cursor(cursor)
+        self.client.force_login(self.user)
+        response = self.client.get("/predict-api/history", {"cursor": "bm9waXBl"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_update_rollups_creates_then_increments(self):
+        now = timezone.now()
+        rows = [self.predict(now, confidence=80.0), self.predict(now, confidence=90.0)]
+        update_rollups(rows[:1])
+        update_rollups(rows[1:] + [self.predict(now, predicted_class="Tinea Capitis", confidence=70.0)])
+        rollups = {
+            rollup.predicted_class: (rollup.count, rollup.confidence_sum)
+            for rollup in DailyPredictionRollup.objects.all()
+        }
+        self.assertEqual(rollups, {"Psoriasis": (2, 170.0), "Tinea Capitis": (1, 70.0)})
+
+    def test_analytics_is_staff_only(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get("/predict-api/analytics").status_code, 403)
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get("/predict-api/analytics")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["total"], 0)
+
+
+class CountingSingleFlight(SingleFlight):
+    """Lets a test wait until a number of callers have joined a flight"""
+
+    def __init__(self):
+        super().__init__()
+        self.begun = threading.Semaphore(0)
+
+    def begin(self, key):
+        flight = super().begin(key)
+        self.begun.release()
+        return flight
+
+
+class SingleFlightTests(TestCase):
+    """Concurrent calls for one key share a single run of its function"""
+
+    callers = 8
+
+    def run_concurrently(self, fn):
+        flight = CountingSingleFlight()
+        gate = threading.Event()
+        outcomes = [None] * self.callers
+
+        def call(index):
+            try:
+                outcomes[index] = flight.do("key", lambda: fn(gate))
+            except Exception as e:
+                outcomes[index] = e
+
+        threads = [threading.Thread(target=call, args=(index,)) for index in range(self.callers)]
+        for thread in threads:
+            thread.start()
+        # Release the leader only once every caller has joined its flight
+        for _ in range(self.callers):
+            self.assertTrue(flight.begun.acquire(timeout=5))
+        gate.set()
+        for thread in threads:
+            thread.join(timeout=5)
+        self.assertEqual(flight.in_flight(), 0)
+        return outcomes
+
+    def test_concurrent_calls_run_once_and_share_the_result(self):
+        calls = []
+
+        def fn(gate):
+            calls.append(1)
+            gate.wait(5)
+            return {"probs": [0.9, 0.1]}
+
+        outcomes = self.run_concurrently(fn)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(outcomes, [{"probs": [0.9, 0.1]}] * self.callers)
+
+    def test_leader_exception_reaches_every_waiter(self):
+        def fn(gate):
+            gate.wait(5)
+            raise RuntimeError("forward pass failed")
+
+        outcomes = self.run_concurrently(fn)
+        self.assertTrue(all(isinstance(outcome, RuntimeError) for outcome in outcomes))
+        self.assertEqual({str(outcome) for outcome in outcomes}, {"forward pass failed"})
+
+
+@override_settings(
+    ML_MODEL_WATCH_INTERVAL=0, ML_QUALITY_GATE_ENABLED=False, ML_BATCHING_ENABLED=False,
+    ML_PREDICTION_CACHE_ALIAS="", ML_BATCH_MAX_SIZE=8,
+)
+class PredictManyWaiterTests(TestCase):
+    """predict_many resolves every in-flight key it leads, even when a chunk fails"""
+
+    def setUp(self):
+        self.service = MLModelService()
+        self.service._load_attempted = True
+        self.images = []
+        for shade in (40, 120):
+            buffer = io.BytesIO()
+            Image.new("RGB", (64, 64), (shade, shade, shade)).save(buffer, "PNG")
+            self.images.append(buffer.getvalue())
+
+    def use_model(self, model):
+        self.service.bundle = ModelBundle(model, "eager", "cpu", "test", None)
+
+    def key(self, data):
+        return self.service._cache_key(image_digest(data), self.service.bundle)
+
+    def join_flight(self, data):
+        """Another request for ``data`` arriving while predict_many runs it"""
+        future, leader = self.service.inflight.begin(self.key(data))
+        self.assertFalse(leader)
+        return future
+
+    def test_failed_chunk_fails_its_waiters(self):
+        waiters = []
+
+        def model(batch):
+            waiters.append(self.join_flight(self.images[1]))
+            raise RuntimeError("forward pass failed")
+
+        self.use_model(model)
+        results = self.service.predict_many(self.images)
+        self.assertEqual([result["success"] for result in results], [False, False])
+        with self.assertRaisesMessage(RuntimeError, "forward pass failed"):
+            waiters[0].result(timeout=1)
+        self.assertEqual(self.service.inflight.in_flight(), 0)
+
+    def test_aborted_batch_never_leaves_waiters_hanging(self):
+        waiters = []
+
+        def model(batch):
+            waiters.append(self.join_flight(self.images[1]))
+            return np.zeros((len(batch), len(self.service.class_names)), dtype=np.float32)
+
+        self.use_model(model)
+        with mock.patch.object(self.service.cache, "set", side_effect=OSError("cache unavailable")):
+            with self.assertRaises(OSError):
+                self.service.predict_many(self.images)
+        with self.assertRaisesMessage(RuntimeError, "Batch prediction aborted"):
+            waiters[0].result(timeout=1)
+        self.assertEqual(self.service.inflight.in_flight(), 0)
+
+    def test_successful_batch_shares_its_result(self):
+        waiters = []
+
+        def model(batch):
+            waiters.append(self.join_flight(self.images[0]))
+            return np.zeros((len(batch), len(self.service.class_names)), dtype=np.float32)
+
+        self.use_model(model)
+        results = self.service.predict_many(self.images)
+        self.assertTrue(all(result["success"] for result in results))
+        probs, tier = waiters[0].result(timeout=1)
+        self.assertEqual(len(probs), len(self.service.class_names))
+
+
+class PredictionCacheStatsTests(TestCase):
+    """The cache-stats endpoint answers 503 while the inference server is unreachable"""
+
+    def test_unreachable_inference_server_is_a_503(self):
+        self.client.force_login(User.objects.create_user("stats"))
+        with mock.patch.object(views, "predictor") as predictor:
+            predictor.cache_stats.side_effect = ConnectionError("Inference server unavailable")
+            response = self.client.get("/predict-api/cache-stats")
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json(), {"error": "Inference server unavailable", "success": False})
+
+
+class ServeUploadTests(TestCase):
+    """Uploads are only served to users whose predictions stored them"""
+
+    def setUp(self):
+        location = tempfile.TemporaryDirectory()
+        self.addCleanup(location.cleanup)
+        override = override_settings(ML_UPLOAD_DIR=location.name, ML_THUMBNAIL_SIZES=[256])
+        override.enable()
+        self.addCleanup(override.disable)
+        buffer = io.BytesIO()
+        Image.new("RGB", (64, 48), "red").save(buffer, format="JPEG")
+        self.name = store_upload(buffer.getvalue())
+        self.owner = User.objects.create_user("owner")
+        Prediction.objects.create(user=self.owner, created_at=timezone.now(), image_name=self.name,
+                                  predicted_class="Psoriasis", confidence=90.0)
+
+    def get(self, user, name):
+        self.client.force_login(user)
+        response = self.client.get(f"/uploads/{name}")
+        if hasattr(response, "streaming_content"):
+            b"".join(response.streaming_content)
+            response.close()
+        return response.status_code
+
+    def test_owner_gets_the_original_and_its_thumbnail(self):
+        self.assertEqual(self.get(self.owner, self.name), 200)
+        self.assertEqual(self.get(self.owner, thumbnail_name(self.name, 256)), 200)
+
+    def test_other_users_get_a_404(self):
+        other = User.objects.create_user("other")
+        self.assertEqual(self.get(other, self.name), 404)
+        self.assertEqual(self.get(other, thumbnail_name(self.name, 256)), 404)
+
+    def test_owner_is_known_from_the_result_cache_before_the_row_is_written(self):
+        other = User.objects.create_user("other")
+        with tempfile.TemporaryDirectory() as location, override_settings(
+            CACHES={
+                "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+                "results": {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": location},
+            },
+            ML_RESULT_CACHE_ALIAS="results",
+        ):
+            prediction_log.cache_results([Prediction(user_id=other.id, image_name=self.name)])
+            self.assertEqual(self.get(other, self.name), 200)
+
+
+@override_settings(ML_BATCH_MAX_SIZE=2)
+class PredictBatchApiTests(TestCase):
+    """Batch results come back in upload order, with rejected files in their own slots"""
+
+    def setUp(self):
+        self.calls = []
+        for target, value in (("attach_upload", lambda result, data: result), ("record_prediction", None)):
+            patcher = mock.patch.object(views, target, side_effect=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(views, "admission", AdmissionController(0))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(views, "predictor")
+        self.predictor = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.predictor.predict_many.side_effect = self.predict_many
+        self.client.force_login(User.objects.create_user("batch"))
+
+    def predict_many(self, images, dates):
+        self.calls.append(len(images))
+        return [{"success": True, "image": image.decode(), "date": date} for image, date in zip(images, dates)]
+
+    def test_results_follow_upload_order(self):
+        names = ["a", "b", "notes", "c", "d", "e"]
+        files = [
+            SimpleUploadedFile(f"{name}.txt" if name == "notes" else f"{name}.jpg", name.encode(),
+                               content_type="text/plain" if name == "notes" else "image/jpeg")
+            for name in names
+        ]
+        response = self.client.post("/predict-api/batch", {"files": files, "symptom_start_date": "2026-01-02"})
+        results = response.json()["results"]
+
+        self.assertEqual(self.calls, [2, 2, 1])
+        self.assertEqual([item["filename"] for item in results], ["a.jpg", "b.jpg", "notes.txt", "c.jpg", "d.jpg", "e.jpg"])
+        self.assertEqual([item.get("image") for item in results], ["a", "b", None, "c", "d", "e"])
+        self.assertEqual(results[2], {"error": "File must be an image", "success": False, "filename": "notes.txt"})
+        self.assertTrue(all(item["date"] == "2026-01-02" for item in results if item["success"]))
+
+
+class PredictionCacheTests(TestCase):
+    """The per-process tier is an LRU with a TTL; the shared tier serves other processes' entries"""
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = PredictionCache(max_entries=2)
+        cache.set("a", [0.1])
+        cache.set("b", [0.2])
+        cache.get("a")
+        cache.set("c", [0.3])
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), ([0.1], None))
+        self.assertEqual(cache.get("c"), ([0.3], None))
+        self.assertEqual(cache.stats()["size"], 2)
+
+    def test_entries_expire_after_the_ttl(self):
+        cache = PredictionCache(ttl=0.05)
+        cache.set("a", [0.5], "full")
+        self.assertEqual(cache.get("a"), ([0.5], "full"))
+        time.sleep(0.1)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual((cache.stats()["hits"], cache.stats()["misses"], cache.stats()["size"]), (1, 1, 0))
+
+    def test_shared_tier_serves_another_process_entries(self):
+        with tempfile.TemporaryDirectory() as location, override_settings(CACHES={
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+            "predictions": {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": location},
+        }):
+            self.assertIsNone(shared_cache("default"))
+            writer = PredictionCache(shared_cache=shared_cache("predictions"))
+            reader = PredictionCache(shared_cache=shared_cache("predictions"))
+            writer.set("a", np.array([0.25, 0.75]), "first_stage")
+            self.assertEqual(reader.get("a"), ([0.25, 0.75], "first_stage"))
+            self.assertEqual(reader.stats()["size"], 1)
+
+
+class InferenceSocketTests(TestCase):
+    """Requests and error frames survive a round trip through the inference server's socket"""
+
+    class Service:
+        def predict(self, data, symptom_start_date=None):
+            if data == b"boom":
+                raise RuntimeError("decode failed")
+            return {"success": True, "size": len(data), "date": symptom_start_date}
+
+        def predict_many(self, images, symptom_start_dates=None):
+            return [{"success": True, "image": image.decode()} for image in images]
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "inference.sock")
+        server = InferenceServer(path, self.Service())
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.client = InferenceClient(path, timeout=5)
+        self.addCleanup(self.client._reset)
+
+    def test_predictions_round_trip(self):
+        self.assertEqual(self.client.predict(b"\x00" * 3000, "2026-01-02"),
+                         {"success": True, "size": 3000, "date": "2026-01-02"})
+        self.assertEqual(self.client.predict_many([b"a", b"bcd", b""]),
+                         [{"success": True, "image": "a"}, {"success": True, "image": "bcd"},
+                          {"success": True, "image": ""}])
+
+    def test_errors_come_back_as_error_frames_on_a_live_connection(self):
+        self.assertEqual(self.client.predict(b"boom"),
+                         {"error": "Inference server error: decode failed", "success": False})
+        self.assertEqual(self.client.call({"op": "reboot"}), {"error": "Unknown operation: reboot", "success": False})
+        self.assertEqual(self.client.predict(b"ok")["size"], 2)
+
+
+@skipUnless(find_spec("torchvision"), "torchvision is not installed")
+class PreprocessingTests(TestCase):
+    """The LUT-fused pipeline matches Resize -> ToTensor -> Normalize"""
+
+    def test_matches_the_torchvision_transform(self):
+        from torchvision import transforms
+        rng = np.random.default_rng(8)
+        image = Image.fromarray(rng.integers(0, 256, (300, 400, 3), dtype=np.uint8))
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        reference = transforms.Compose([
+            transforms.Resize(IMAGE_SIZE),
+            transforms.ToTensor(),
+            transforms.Normalize(IMAGE_MEAN.tolist(), IMAGE_STD.tolist()),
+        ])(image).numpy()
+
+        out = new_batch(2)
+        preprocess_image(io.BytesIO(buffer.getvalue()), out=out[1], draft=False)
+        self.assertEqual(out[1].shape, reference.shape)
+        np.testing.assert_allclose(out[1], reference, atol=1e-5)
+
+
+@override_settings(
+    ML_MODEL_WATCH_INTERVAL=0, ML_BATCHING_ENABLED=False, ML_PREDICTION_CACHE_ALIAS="",
+    ML_CASCADE_ARCH="mobilenet_v3_small", ML_CASCADE_THRESHOLD=0.9, ML_TTA_ENABLED=False,
+)
+class CascadeTests(TestCase):
+    """Only images the first stage is unsure about reach ResNet50"""
+
+    def test_images_below_the_threshold_are_escalated(self):
+        service = MLModelService()
+        classes = len(service.class_names)
+        batch = new_batch(3)
+        batch[:] = 0
+        seen = []
+
+        def first_stage(images):
+            logits = np.zeros((len(images), classes), dtype=np.float32)
+            logits[[0, 2], 1] = 10  # confident about images 0 and 2 only
+            return logits
+
+        def model(images):
+            seen.append(len(images))
+            logits = np.zeros((len(images), classes), dtype=np.float32)
+            logits[:, 4] = 10
+            return logits
+
+        outputs = service._run_batch(batch, ModelBundle(model, "eager", "cpu", "test", first_stage))
+
+        self.assertEqual(seen, [1])
+        self.assertEqual([tier for _, tier in outputs], ["mobilenet_v3_small", "resnet50", "mobilenet_v3_small"])
+        self.assertEqual([int(probs.argmax()) for probs, _ in outputs], [1, 4, 1])
+
+
+class QualityGateTests(TestCase):
+    """A blurred copy of an acceptable photo is rejected as blurry, and only as blurry"""
+
+    def test_blurred_image_is_rejected(self):
+        rng = np.random.default_rng(19)
+        sharp = Image.fromarray(rng.integers(60, 200, (400, 400, 3), dtype=np.uint8))
+        self.assertTrue(assess_quality(sharp).ok)
+
+        report = assess_quality(sharp.filter(ImageFilter.GaussianBlur(8)))
+        self.assertFalse(report.ok)
+        self.assertEqual(report.issues, ["blurry"])
+        self.assertEqual(retake_response(report)["advice"], [RETAKE_ADVICE["blurry"]])
+
+
+@override_settings(
+    ML_MODEL_WATCH_INTERVAL=0, ML_BATCHING_ENABLED=False, ML_PREDICTION_CACHE_ALIAS="",
+    ML_TTA_ENABLED=True, ML_TTA_THRESHOLD=0.70,
+)
+class TestTimeAugmentationTests(TestCase):
+    """Uncertain images are re-scored over all their views in one extra forward pass"""
+
+    def test_uncertain_image_averages_its_views(self):
+        service = MLModelService()
+        classes = len(service.class_names)
+        batch = new_batch(2)
+        batch[:] = 0
+        seen = []
+
+        def model(images):
+            seen.append(len(images))
+            logits = np.zeros((len(images), classes), dtype=np.float32)
+            if len(seen) == 1:
+                logits[0, 2] = 10  # image 0 is certain, image 1 uniform
+            else:
+                logits[:, 3] = np.log(9.0 * (classes - 1))  # every view: 90% class 3
+            return logits
+
+        outputs = service._run_batch(batch, ModelBundle(model, "eager", "cpu", "test", None))
+
+        self.assertEqual(seen, [2, TTA_VIEW_COUNT])
+        self.assertEqual([tier for _, tier in outputs], ["resnet50", "resnet50+tta"])
+        expected = np.full(classes, 0.1 / (classes - 1))
+        expected[3] = 0.9
+        expected = (np.full(classes, 1.0 / classes) + TTA_VIEW_COUNT * expected) / (TTA_VIEW_COUNT + 1)
+        np.testing.assert_allclose(outputs[1][0], expected, rtol=1e-5)
+        self.assertEqual(int(outputs[0][0].argmax()), 2)
+
+
+@override_settings(ML_PREDICTION_LOG_ENABLED=True, ML_RESULT_CACHE_ALIAS="")
+class PredictionLogWriterTests(TestCase):
+    """Queued rows reach the table on flush; a full queue drops new rows instead of blocking"""
+
+    def row(self, index):
+        return Prediction(created_at=timezone.now(), predicted_class="Psoriasis", confidence=float(index))
+
+    def test_shutdown_flush_writes_every_queued_row(self):
+        writer = thread_free_writer(batch_size=2)
+        for index in range(5):
+            self.assertTrue(writer.put(self.row(index)))
+        writer.flush()  # registered with atexit for the module's writer
+        self.assertEqual(sorted(Prediction.objects.values_list("confidence", flat=True)), [0, 1, 2, 3, 4])
+        self.assertEqual(DailyPredictionRollup.objects.get().count, 5)
+        self.assertTrue(writer.queue.empty())
+
+    def test_full_queue_drops_rows_until_it_is_flushed(self):
+        writer = thread_free_writer(max_queue=2)
+        self.assertEqual([writer.put(self.row(index)) for index in range(3)], [True, True, False])
+        writer.flush()
+        self.assertTrue(writer.put(self.row(3)))
+        writer.flush()
+        self.assertEqual(sorted(Prediction.objects.values_list("confidence", flat=True)), [0, 1, 3])
+
+
+@override_settings(SESSION_IDLE_TIMEOUT=1800, SESSION_ACTIVITY_UPDATE_INTERVAL=60)
+class SessionTimeoutMiddlewareTests(TestCase):
+    """last_activity is rewritten at most once per interval, and idle sessions still expire"""
+
+    def setUp(self):
+        self.user = User.objects.create_user("session")
+        self.middleware = SessionTimeoutMiddleware(lambda request: HttpResponse("ok"))
+
+    def request_at(self, now, last_activity):
+        request = RequestFactory().get("/predict")
+        request.session = import_module(settings.SESSION_ENGINE).SessionStore()
+        request.session["last_activity"] = last_activity
+        request.session.modified = False
+        request.user = self.user
+        request._messages = FallbackStorage(request)
+        with mock.patch.object(middleware.time, "time", return_value=now):
+            response = self.middleware(request)
+        return request, response
+
+    def test_activity_writes_are_coalesced(self):
+        request, response = self.request_at(1030, last_activity=1000)
+        self.assertEqual(response.content, b"ok")
+        self.assertFalse(request.session.modified)
+        self.assertEqual(request.session["last_activity"], 1000)
+
+        request, response = self.request_at(1060, last_activity=1000)
+        self.assertTrue(request.session.modified)
+        self.assertEqual(request.session["last_activity"], 1060)
+
+    def test_idle_session_still_expires(self):
+        request, response = self.request_at(1000 + 1801, last_activity=1000)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.url, "/login")
+        self.assertFalse(request.user.is_authenticated)
+
+
+class ReadyEndpointTests(TestCase):
+    """/ready answers 503 (and starts loading) until the model is warm, then 200"""
+
+    def setUp(self):
+        for name in ("readiness", "prepare_in_background"):
+            patcher = mock.patch.object(views.predictor, name)
+            setattr(self, name, patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def state(self, ready, load_failed=False):
+        return {"model_loaded": ready, "load_failed": load_failed, "warm": ready, "ready": ready}
+
+    def test_probe_starts_loading_then_turns_ready(self):
+        self.readiness.side_effect = [self.state(False), self.state(True)]
+        response = self.client.get("/ready")
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(response.json()["ready"])
+        self.prepare_in_background.assert_called_once_with()
+
+        response = self.client.get("/ready")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()["ready"])
+        self.prepare_in_background.assert_called_once_with()
+
+    def test_failed_load_is_not_retried_by_the_probe(self):
+        self.readiness.return_value = self.state(False, load_failed=True)
+        self.assertEqual(self.client.get("/ready").status_code, 503)
+        self.prepare_in_background.assert_not_called()
+
+
+class MetricsEndpointTests(TestCase):
+    """/metrics needs the bearer token or a staff user"""
+
+    def test_anonymous_scrapes_are_refused_without_a_token(self):
+        with override_settings(ML_METRICS_TOKEN=""):
+            self.assertEqual(self.client.get("/metrics").status_code, 403)
+            self.client.force_login(User.objects.create_user("user"))
+            self.assertEqual(self.client.get("/metrics").status_code, 403)
+            self.client.force_login(User.objects.create_user("staff", is_staff=True))
+            self.assertEqual(self.client.get("/metrics").status_code, 200)
+
+    def test_bearer_token_is_accepted(self):
+        with override_settings(ML_METRICS_TOKEN="secret"):
+            self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer wrong").status_code, 403)
+            self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret").status_code, 200)
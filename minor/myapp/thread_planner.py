@@ -0,0 +1,120 @@
+# myapp/thread_planner.py
+"""
+Per-worker CPU thread planning.
+
+Every gunicorn worker runs its own model, and by default each one would start
+as many intra-op threads as the host has cores, so four workers on an 8-core
+box fight over 32 threads. The planner divides the CPUs this process may use
+(its affinity mask, capped by the cgroup CPU quota) between the workers,
+optionally pins each worker to its own core set, and logs the layout.
+
+Workers learn their index and the worker count from ``ML_WORKER_INDEX`` and
+``ML_WORKER_PROCESSES`` (set by the gunicorn ``pre_fork``/``post_fork`` hooks),
+falling back to ``WEB_CONCURRENCY`` and index 0. The gunicorn master never
+plans or pins itself: its mask is inherited by every worker it forks.
+"""
+import logging
+import math
+import os
+from collections import namedtuple
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+ThreadPlan = namedtuple("ThreadPlan", "workers worker_index usable_cpus intra_op inter_op cpus")
+
+
+# The affinity mask from before apply_affinity() first pinned this process (or
+# the process it was forked from), so re-planning is not confined to one share
+_unpinned_cpus = None
+
+
+def available_cpus():
+    """CPU ids this process may run on, before any pinning by ``apply_affinity``"""
+    if _unpinned_cpus is not None:
+        return list(_unpinned_cpus)
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        return list(range(os.cpu_count() or 1))
+
+
+def cgroup_cpu_limit():
+    """CPU quota from cgroup v2 ``cpu.max`` or v1 CFS files, in cores; None if unlimited"""
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        if quota != "max":
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def plan_threads(workers, worker_index=0, pin=False, intra_op=0, inter_op=1, cpus=None, cpu_limit=None):
+    """Split the usable CPUs between ``workers`` processes and return this one's share.
+
+    ``intra_op`` overrides the computed per-worker thread count when non-zero.
+    With ``pin`` each worker gets a contiguous, non-overlapping core set (only
+    when there are at least as many cores as workers).
+    """
+    cpus = list(cpus) if cpus is not None else available_cpus()
+    workers = max(1, int(workers))
+    worker_index = int(worker_index) % workers
+    usable = len(cpus)
+    if cpu_limit:
+        usable = min(usable, max(1, math.floor(cpu_limit)))
+
+    threads = intra_op or max(1, usable // workers)
+
+    pinned = None
+    if pin and len(cpus) >= workers:
+        per_worker = max(1, min(threads, len(cpus) // workers))
+        start = worker_index * per_worker
+        pinned = cpus[start:start + per_worker]
+
+    return ThreadPlan(workers, worker_index, usable, threads, max(1, int(inter_op)), pinned)
+
+
+def current_plan():
+    """The plan for this process, from the environment and ``ML_*`` settings"""
+    workers = os.environ.get("ML_WORKER_PROCESSES") or os.environ.get("WEB_CONCURRENCY") or 1
+    return plan_threads(
+        workers,
+        worker_index=os.environ.get("ML_WORKER_INDEX", 0),
+        pin=getattr(settings, "ML_PIN_CPUS", False),
+        intra_op=getattr(settings, "ML_TORCH_THREADS", 0),
+        inter_op=getattr(settings, "ML_TORCH_INTEROP_THREADS", 1),
+        cpu_limit=cgroup_cpu_limit(),
+    )
+
+
+def apply_affinity(plan):
+    """Pin this process to ``plan.cpus`` when the plan has a core set"""
+    global _unpinned_cpus
+    if plan.cpus:
+        if _unpinned_cpus is None:
+            _unpinned_cpus = available_cpus()
+        try:
+            os.sched_setaffinity(0, plan.cpus)
+        except (AttributeError, OSError) as e:
+            logger.warning("Could not pin worker %d to CPUs %s: %s", plan.worker_index, plan.cpus, e)
+
+
+def log_plan(plan):
+    logger.info(
+        "Thread plan: worker %d/%d, %d usable CPUs, %d intra-op / %d inter-op threads, CPUs %s",
+        plan.worker_index + 1, plan.workers, plan.usable_cpus, plan.intra_op, plan.inter_op,
+        plan.cpus if plan.cpus else "unpinned",
+    )
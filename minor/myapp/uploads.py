@@ -0,0 +1,158 @@
+# myapp/uploads.py
+"""
+Content-addressed storage for uploaded images.
+
+The pages used to keep every upload as a multi-megabyte data URL in
+``localStorage``. Now the prediction endpoints store the upload once under
+``ML_UPLOAD_DIR``, named after its digest:
+
+    <ML_UPLOAD_DIR>/ab/abcdef....jpg          original bytes
+    <ML_UPLOAD_DIR>/ab/abcdef...-256.webp     downscaled WebP thumbnails
+
+Identical uploads map to the same file, so nothing is written twice. The
+thumbnails are rendered by a background thread after the response has been
+sent (or on first request if that has not happened yet). Because a name
+never changes content, ``serve_upload`` lets browsers cache them for a year.
+"""
+import io
+import logging
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from PIL import Image
+
+from .prediction_cache import image_digest
+
+logger = logging.getLogger(__name__)
+
+# <digest>.<ext> or <digest>-<size>.webp
+UPLOAD_NAME_RE = re.compile(r"^(?P<digest>[0-9a-f]{40})(?:\.(?P<ext>[a-z0-9]{2,5})|-(?P<size>\d{2,4})\.webp)$")
+EXTENSIONS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp", "GIF": "gif", "BMP": "bmp", "TIFF": "tif", "MPO": "jpg"}
+
+_executor = None
+_executor_pid = None
+_lock = threading.Lock()
+
+
+def upload_dir():
+    return str(getattr(settings, "ML_UPLOAD_DIR", os.path.join(settings.MEDIA_ROOT, "uploads")))
+
+
+def thumbnail_sizes():
+    return getattr(settings, "ML_THUMBNAIL_SIZES", [256, 768])
+
+
+def upload_path(name):
+    return os.path.join(upload_dir(), name[:2], name)
+
+
+def upload_url(name):
+    return f"/uploads/{name}"
+
+
+def _write_atomic(path, write):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".upload-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def store_upload(data, digest=None):
+    """Store image bytes once under their digest and return the file name"""
+    digest = digest or image_digest(data)
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            ext = EXTENSIONS.get(img.format, "img")
+    except Exception:
+        ext = "img"
+    name = f"{digest}.{ext}"
+    path = upload_path(name)
+    if not os.path.exists(path):
+        _write_atomic(path, lambda f: f.write(data))
+    return name
+
+
+def find_upload(digest):
+    """Name of the stored original with this digest, or None"""
+    try:
+        candidates = os.listdir(os.path.join(upload_dir(), digest[:2]))
+    except FileNotFoundError:
+        return None
+    return next((name for name in candidates if name.startswith(digest + ".")), None)
+
+
+def thumbnail_name(name, size):
+    return f"{name.split('.', 1)[0]}-{size}.webp"
+
+
+def render_thumbnail(name, size):
+    """Write the ``size`` px WebP thumbnail of upload ``name`` if it does not exist yet"""
+    target = upload_path(thumbnail_name(name, size))
+    if os.path.exists(target):
+        return target
+    with Image.open(upload_path(name)) as img:
+        if img.format == "JPEG":
+            img.draft("RGB", (size, size))
+        img = img.convert("RGB")
+        img.thumbnail((size, size), Image.LANCZOS)
+        _write_atomic(target, lambda f: img.save(f, "WEBP", quality=80, method=4))
+    return target
+
+
+def _render_thumbnails(name):
+    for size in thumbnail_sizes():
+        try:
+            render_thumbnail(name, size)
+        except Exception:
+            logger.exception("Could not render %dpx thumbnail of %s", size, name)
+
+
+def get_thumbnail_executor():
+    """Single background thread for thumbnails, created on first use (and after fork)"""
+    global _executor, _executor_pid
+    with _lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="thumbnails")
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def attach_upload(result, data):
+    """Store a successful prediction's image and add the image URLs to the result.
+
+    The original is written synchronously (once per distinct image); the
+    thumbnails are queued for the background thread.
+    """
+    if not result.get("success"):
+        return result
+    name = ""
+    if getattr(settings, "ML_UPLOAD_STORAGE_ENABLED", True):
+        try:
+            name = store_upload(data, result.get("image_digest"))
+            get_thumbnail_executor().submit(_render_thumbnails, name)
+        except Exception:
+            logger.exception("Could not store uploaded image")
+            name = ""
+    result["image_name"] = name
+    result.update(upload_urls(name))
+    return result
+
+
+def upload_urls(name):
+    """``image_url`` plus one ``thumbnail_urls`` entry per configured size"""
+    if not name:
+        return {"image_url": None, "thumbnail_urls": {}}
+    return {
+        "image_url": upload_url(name),
+        "thumbnail_urls": {str(size): upload_url(thumbnail_name(name, size)) for size in thumbnail_sizes()},
+    }
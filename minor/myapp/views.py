@@ -1,7 +1,7 @@
 from django.shortcuts import render, redirect
-from django.http import HttpResponse, JsonResponse
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, JsonResponse
 from django.contrib import messages
-from myapp.models import User
+from myapp.models import PredictionJob, User
 from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
 from django.contrib.auth.decorators import login_required
@@ -11,7 +11,29 @@ from django.core.files.base import ContentFile
 import json
 import os
 import time
-from .ml_service import ml_service
+from django.conf import settings
+from asgiref.sync import sync_to_async
+from .admission import Overloaded, get_admission_controller
+from .analytics import daily_summary, history_page
+from .executors import run_in_inference_pool
+from .inference_server import get_predictor
+from .jobs import job_payload, submit_job, wait_for_finished_jobs
+from .metrics import REGISTRY, stage_timer
+from .prediction_log import find_result, owns_upload, record_prediction
+from .uploads import (
+    UPLOAD_NAME_RE, attach_upload, find_upload, render_thumbnail, thumbnail_sizes, upload_path, upload_urls,
+)
+
+# In-process MLModelService, or a client for the out-of-process inference server
+predictor = get_predictor()
+admission = get_admission_controller()
+
+
+def overloaded_response(exc):
+    """429 telling the client when to retry"""
+    response = JsonResponse({'error': str(exc), 'success': False}, status=429)
+    response['Retry-After'] = str(exc.retry_after)
+    return response
 
 # Create your views here.
 def home(request):
@@ -96,14 +118,10 @@ def logout_view(request):
 
 @login_required(login_url='login')
 def predict(request):
-    # Update session activity time
-    request.session['last_activity'] = time.time()
     return render(request, 'predict.html')
 
 @login_required(login_url='login')
 def camera_capture(request):
-    # Update session activity time
-    request.session['last_activity'] = time.time()
     return render(request, 'camera_capture.html')
 
 @csrf_exempt
@@ -112,9 +130,6 @@ def predict_api(request):
     """API endpoint for ML prediction"""
     if request.method == 'POST':
         try:
-            # Update session activity time
-            request.session['last_activity'] = time.time()
-            
             # Get the uploaded file
             if 'file' not in request.FILES:
                 return JsonResponse({'error': 'No file uploaded'}, status=400)
@@ -129,22 +144,314 @@ def predict_api(request):
             symptom_start_date = request.POST.get('symptom_start_date')
             
             # Make prediction
-            result = ml_service.predict(file, symptom_start_date)
-            
-            if 'error' in result:
-                return JsonResponse(result, status=500)
+            data = file.read()
+            with admission.admit():
+                result = predictor.predict(data, symptom_start_date)
+            attach_upload(result, data)
+            record_prediction(result, request.user, source='api')
             
-            return JsonResponse(result)
+            with stage_timer('serialize'):
+                if result.get('retake'):
+                    return JsonResponse(result, status=422)
+                if 'error' in result:
+                    return JsonResponse(result, status=500)
+                return JsonResponse(result)
             
+        except Overloaded as e:
+            return overloaded_response(e)
         except Exception as e:
             return JsonResponse({'error': f'Server error: {str(e)}'}, status=500)
     
     return JsonResponse({'error': 'Method not allowed'}, status=405)
 
+@csrf_exempt
+@login_required(login_url='login')
+async def predict_api_async(request):
+    """Async API endpoint for ML prediction (serve with an ASGI server such as uvicorn).
+
+    The upload is read without blocking the event loop and decode + inference
+    run on the bounded inference pool, so one worker can keep many uploads
+    in flight.
+    """
+    if request.method == 'POST':
+        try:
+            # Reserve a queue place before the body is parsed so overload fails fast
+            ticket = admission.reserve()
+        except Overloaded as e:
+            return overloaded_response(e)
+        try:
+            # Parsing the multipart body is blocking I/O
+            files = await sync_to_async(lambda: request.FILES, thread_sensitive=False)()
+            if 'file' not in files:
+                return JsonResponse({'error': 'No file uploaded'}, status=400)
+
+            file = files['file']
+            if not file.content_type.startswith('image/'):
+                return JsonResponse({'error': 'File must be an image'}, status=400)
+
+            symptom_start_date = request.POST.get('symptom_start_date')
+            data = await sync_to_async(file.read, thread_sensitive=False)()
+
+            result = await run_in_inference_pool(
+                admission.call, ticket, predictor.predict, data, symptom_start_date
+            )
+            await sync_to_async(attach_upload, thread_sensitive=False)(result, data)
+            record_prediction(result, await request.auser(), source='async')
+
+            with stage_timer('serialize'):
+                if result.get('retake'):
+                    return JsonResponse(result, status=422)
+                if 'error' in result:
+                    return JsonResponse(result, status=500)
+                return JsonResponse(result)
+
+        except Overloaded as e:
+            return overloaded_response(e)
+        except Exception as e:
+            return JsonResponse({'error': f'Server error: {str(e)}'}, status=500)
+        finally:
+            # No-op once admission.call has released it
+            ticket.release()
+
+    return JsonResponse({'error': 'Method not allowed'}, status=405)
+
+@csrf_exempt
+@login_required(login_url='login')
+def predict_batch_api(request):
+    """API endpoint for predicting many uploaded images in one request"""
+    if request.method == 'POST':
+        try:
+            files = request.FILES.getlist('files') or request.FILES.getlist('file')
+            if not files:
+                return JsonResponse({'error': 'No files uploaded'}, status=400)
+
+            max_files = getattr(settings, 'ML_BATCH_UPLOAD_MAX_FILES', 50)
+            if len(files) > max_files:
+                return JsonResponse({'error': f'Too many files (maximum {max_files})'}, status=400)
+
+            # One symptom start date for all files, or one per file in upload order
+            dates = request.POST.getlist('symptom_start_date')
+            if len(dates) == 1:
+                dates = dates * len(files)
+            dates = [date or None for date in dates]
+
+            results = [None] * len(files)
+            valid_indices = []
+            uploads = {}
+            for index, file in enumerate(files):
+                if file.content_type and file.content_type.startswith('image/'):
+                    valid_indices.append(index)
+                    uploads[index] = file.read()
+                else:
+                    results[index] = {'error': 'File must be an image', 'success': False}
+
+            # Each forward pass takes its own running slot, so a large upload
+            # is charged like that many single-image requests
+            predictions = []
+            chunk_size = getattr(settings, 'ML_BATCH_MAX_SIZE', 8)
+            ticket = admission.reserve()
+            try:
+                for start in range(0, len(valid_indices), chunk_size):
+                    chunk = valid_indices[start:start + chunk_size]
+                    with ticket.running():
+                        predictions.extend(predictor.predict_many(
+                            [uploads[i] for i in chunk],
+                            [dates[i] if i < len(dates) else None for i in chunk],
+                        ))
+            finally:
+                ticket.release()
+            user = request.user
+            for index, prediction in zip(valid_indices, predictions):
+                results[index] = attach_upload(prediction, uploads[index])
+                record_prediction(prediction, user, source='batch')
+
+            for file, item in zip(files, results):
+                item['filename'] = file.name
+
+            with stage_timer('serialize'):
+                return JsonResponse({
+                    'results': results,
+                    'count': len(results),
+                    'success': any(item.get('success') for item in results),
+                })
+
+        except Overloaded as e:
+            return overloaded_response(e)
+        except Exception as e:
+            return JsonResponse({'error': f'Server error: {str(e)}'}, status=500)
+
+    return JsonResponse({'error': 'Method not allowed'}, status=405)
+
+@csrf_exempt
+@login_required(login_url='login')
+def prediction_job_submit(request):
+    """Queue uploaded image(s) for prediction and return job ids immediately (202)"""
+    if request.method == 'POST':
+        try:
+            files = request.FILES.getlist('files') or request.FILES.getlist('file')
+            if not files:
+                return JsonResponse({'error': 'No file uploaded'}, status=400)
+
+            max_files = getattr(settings, 'ML_BATCH_UPLOAD_MAX_FILES', 50)
+            if len(files) > max_files:
+                return JsonResponse({'error': f'Too many files (maximum {max_files})'}, status=400)
+            if any(not (file.content_type or '').startswith('image/') for file in files):
+                return JsonResponse({'error': 'File must be an image'}, status=400)
+
+            symptom_start_date = request.POST.get('symptom_start_date')
+            jobs = []
+            for file in files:
+                job = submit_job(request.user, file.read(), file.name, symptom_start_date)
+                payload = job_payload(job)
+                payload['status_url'] = f'/predict-api/jobs/{job.id}'
+                jobs.append(payload)
+
+            if 'files' in request.FILES:
+                return JsonResponse({'jobs': jobs, 'count': len(jobs)}, status=202)
+            return JsonResponse(jobs[0], status=202)
+
+        except Exception as e:
+            return JsonResponse({'error': f'Server error: {str(e)}'}, status=500)
+
+    return JsonResponse({'error': 'Method not allowed'}, status=405)
+
+@login_required(login_url='login')
+async def prediction_job_status(request, job_id):
+    """Poll a prediction job; ``?wait=N`` waits up to N seconds (capped at ML_JOB_LONG_POLL_MAX) for it to finish.
+
+    Under WSGI a waiting poll holds a worker thread, so the cap is kept to a
+    few hundred milliseconds and clients back off between polls instead.
+    """
+    user = await request.auser()
+    try:
+        wait = min(float(request.GET.get('wait', 0)), getattr(settings, 'ML_JOB_LONG_POLL_MAX', 0.5))
+    except ValueError:
+        return JsonResponse({'error': 'wait must be a number of seconds'}, status=400)
+
+    deadline = time.monotonic() + max(0.0, wait)
+    interval = getattr(settings, 'ML_JOB_POLL_INTERVAL', 0.5)
+    while True:
+        job = await PredictionJob.objects.filter(pk=job_id, user=user).defer('image').afirst()
+        if job is None:
+            return JsonResponse({'error': 'Job not found'}, status=404)
+        if job.finished or time.monotonic() >= deadline:
+            return JsonResponse(job_payload(job))
+        # Woken early when this process finishes a job; jobs run by other
+        # workers are picked up on the next poll
+        await wait_for_finished_jobs(min(interval, max(0.0, deadline - time.monotonic())))
+
+@login_required(login_url='login')
+def prediction_history(request):
+    """The signed-in user's predictions, newest first; pass ``?cursor=`` from the previous page"""
+    try:
+        limit = int(request.GET.get('limit', getattr(settings, 'ML_HISTORY_PAGE_SIZE', 20)))
+    except ValueError:
+        return JsonResponse({'error': 'limit must be an integer'}, status=400)
+    limit = max(1, min(limit, getattr(settings, 'ML_HISTORY_MAX_PAGE_SIZE', 100)))
+    try:
+        page = history_page(
+            request.user.pk,
+            cursor=request.GET.get('cursor') or None,
+            limit=limit,
+            predicted_class=request.GET.get('class') or None,
+        )
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse(page)
+
+@login_required(login_url='login')
+def prediction_analytics(request):
+    """Daily prediction counts by class and severity for the dashboard (``?days=``, default 30); staff only"""
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Staff only'}, status=403)
+    try:
+        days = min(int(request.GET.get('days', 30)), 366)
+    except ValueError:
+        return JsonResponse({'error': 'days must be an integer'}, status=400)
+    return JsonResponse(daily_summary(days))
+
+@login_required(login_url='login')
+def prediction_result(request, result_id):
+    """A stored prediction by the short ``result_id`` returned from the prediction endpoints"""
+    prediction = find_result(result_id, request.user.pk)
+    if prediction is None:
+        return JsonResponse({'error': 'Result not found'}, status=404)
+    return JsonResponse({
+        'result_id': prediction.result_id,
+        'created_at': prediction.created_at.isoformat(),
+        'predicted_class': prediction.predicted_class,
+        'confidence': prediction.confidence,
+        'probabilities': prediction.probabilities,
+        'stage_info': prediction.stage_info,
+        'symptom_start_date': prediction.symptom_start_date or None,
+        'model_version': prediction.model_version,
+        'model_tier': prediction.model_tier,
+        'success': True,
+        **upload_urls(prediction.image_name),
+    })
+
+@login_required(login_url='login')
+def serve_upload(request, name):
+    """Stored upload or thumbnail of one of the user's predictions.
+
+    Names are content-addressed, so they can be cached for good.
+    """
+    match = UPLOAD_NAME_RE.match(name)
+    if match is None or not owns_upload(request.user.id, name):
+        raise Http404
+    etag = f'"{name}"'
+    if request.headers.get('If-None-Match') == etag:
+        response = HttpResponseNotModified()
+    else:
+        path = upload_path(name)
+        if match['size'] and not os.path.exists(path):
+            # The background thumbnail has not been rendered yet
+            original = find_upload(match['digest'])
+            if original is None or int(match['size']) not in thumbnail_sizes():
+                raise Http404
+            render_thumbnail(original, int(match['size']))
+        try:
+            response = FileResponse(open(path, 'rb'))
+        except FileNotFoundError:
+            raise Http404
+    response['ETag'] = etag
+    response['Cache-Control'] = f"private, max-age={getattr(settings, 'ML_UPLOAD_CACHE_MAX_AGE', 31536000)}, immutable"
+    return response
+
+@login_required(login_url='login')
+def prediction_cache_stats(request):
+    """API endpoint exposing this worker's prediction cache counters"""
+    try:
+        return JsonResponse(predictor.cache_stats())
+    except ConnectionError as e:
+        # InferenceClient: the inference server is down or timed out
+        return JsonResponse({'error': str(e), 'success': False}, status=503)
+
+def ready(request):
+    """Readiness probe: 200 once this worker's model is loaded and warm, 503 until then"""
+    status = predictor.readiness()
+    if not status['ready'] and not status.get('load_failed'):
+        # Start loading now so the probe itself brings the worker up
+        predictor.prepare_in_background()
+    return JsonResponse(status, status=200 if status['ready'] else 503)
+
+def metrics(request):
+    """Prometheus scrape endpoint for hot-path timings and counters (bearer token or staff only)"""
+    token = getattr(settings, 'ML_METRICS_TOKEN', '')
+    has_token = bool(token) and request.headers.get('Authorization') == f'Bearer {token}'
+    if not has_token and not request.user.is_staff:
+        return HttpResponse(status=403)
+
+    remote = {}
+    if hasattr(predictor, 'metrics_snapshot'):
+        try:
+            remote['inference_server'] = predictor.metrics_snapshot()
+        except Exception:
+            pass
+    return HttpResponse(REGISTRY.render(remote), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @login_required(login_url='login')
 def result(request):
-    # Update session activity time
-    request.session['last_activity'] = time.time()
     return render(request, 'result.html')
 
 def check_auth_status(request):